@@ -20,12 +20,13 @@ import os
 import hashlib
 import json
 import datetime
+from collections import defaultdict
 
 from pyfaf.actions import Action
 from pyfaf.common import FafError
 from pyfaf.problemtypes import problemtypes
-from pyfaf.queries import get_reports_by_type, get_report
-from pyfaf.storage import ReportHash
+from pyfaf.queries import get_crash_threads, get_reports_by_type, get_report
+from pyfaf.storage import ReportBacktrace, ReportHash
 
 
 class AddCompatHashes(Action):
@@ -40,18 +41,22 @@ class AddCompatHashes(Action):
 
         return offset
 
-    def _hash_backtrace(self, db_backtrace, hashbase=None, offset=False):
+    def _hash_backtrace(self, crashthreads, hashbase=None, offset=False):
+        """
+        Hash the crash thread of a backtrace, `crashthreads` being the list
+        of its crash threads loaded by pyfaf.queries.get_crash_threads.
+        """
+
         if hashbase is None:
             hashbase = []
 
-        crashthreads = [t for t in db_backtrace.threads if t.crashthread]
         if len(crashthreads) < 1:
             raise FafError("No crash thread found")
 
         if len(crashthreads) > 1:
             raise FafError("Multiple crash threads found")
 
-        frames = [f for f in crashthreads[0].frames if not f.inlined][:16]
+        frames = [f for f in crashthreads[0].get_frames() if not f.inlined][:16]
 
         hasnames = all([f.symbolsource.symbol is not None and
                         f.symbolsource.symbol.name is not None and
@@ -109,49 +114,70 @@ class AddCompatHashes(Action):
             db_reports = get_reports_by_type(db, ptype)
 
             j = 0
-            for db_report in db_reports:
-                j += 1
-
-                self.log_info("  [{0} / {1}] Processing report #{2}"
-                              .format(j, len(db_reports), db_report.id))
-
-                hashes = set()
-                k = 0
-                for db_backtrace in db_report.backtraces:
-                    k += 1
-
-                    self.log_debug("    [{0} / {1}] Processing backtrace #{2}"
-                                   .format(k, len(db_report.backtraces),
-                                           db_backtrace.id))
-                    try:
-                        component = db_report.component.name
-                        include_offset = ptype.lower() == "python"
-                        bthash = self._hash_backtrace(db_backtrace,
-                                                      hashbase=[component],
-                                                      offset=include_offset)
-                        self.log_debug("    {0}".format(bthash))
-                        db_dup = get_report(db, bthash)
-                        if db_dup is None:
-                            self.log_info("    Adding hash '{0}'"
-                                          .format(bthash))
-                            if not bthash in hashes:
-                                db_reporthash = ReportHash()
-                                db_reporthash.report = db_report
-                                db_reporthash.hash = bthash
-                                db.session.add(db_reporthash)
-                                hashes.add(bthash)
-                        elif db_dup == db_report:
-                            self.log_debug("    Hash '{0}' already assigned"
-                                           .format(bthash))
-                        else:
-                            self.log_warn(("    Conflict! Skipping hash '{0}'"
-                                           " (report #{1})").format(bthash,
-                                                                    db_dup.id))
-                    except FafError as ex:
-                        self.log_warn("    {0}".format(str(ex)))
-                        continue
-
-                db.session.flush()
+            chunk_size = 100
+            for start in xrange(0, len(db_reports), chunk_size):
+                chunk = db_reports[start:start + chunk_size]
+
+                # report id -> backtrace ids
+                backtrace_ids = defaultdict(list)
+                for backtrace_id, report_id in (
+                        db.session.query(ReportBacktrace.id,
+                                         ReportBacktrace.report_id)
+                        .filter(ReportBacktrace.report_id.in_(
+                            [db_report.id for db_report in chunk]))
+                        .order_by(ReportBacktrace.id)):
+                    backtrace_ids[report_id].append(backtrace_id)
+
+                crash_threads = get_crash_threads(
+                    db, [backtrace_id for ids in backtrace_ids.values()
+                         for backtrace_id in ids])
+
+                for db_report in chunk:
+                    j += 1
+
+                    self.log_info("  [{0} / {1}] Processing report #{2}"
+                                  .format(j, len(db_reports), db_report.id))
+
+                    self._add_hashes(db, ptype, db_report,
+                                     backtrace_ids[db_report.id],
+                                     crash_threads)
+                    db.session.flush()
+
+    def _add_hashes(self, db, ptype, db_report, backtrace_ids, crash_threads):
+        hashes = set()
+        k = 0
+        for backtrace_id in backtrace_ids:
+            k += 1
+
+            self.log_debug("    [{0} / {1}] Processing backtrace #{2}"
+                           .format(k, len(backtrace_ids), backtrace_id))
+            try:
+                component = db_report.component.name
+                include_offset = ptype.lower() == "python"
+                bthash = self._hash_backtrace(
+                    crash_threads.get(backtrace_id, []),
+                    hashbase=[component], offset=include_offset)
+                self.log_debug("    {0}".format(bthash))
+                db_dup = get_report(db, bthash)
+                if db_dup is None:
+                    self.log_info("    Adding hash '{0}'"
+                                  .format(bthash))
+                    if not bthash in hashes:
+                        db_reporthash = ReportHash()
+                        db_reporthash.report = db_report
+                        db_reporthash.hash = bthash
+                        db.session.add(db_reporthash)
+                        hashes.add(bthash)
+                elif db_dup == db_report:
+                    self.log_debug("    Hash '{0}' already assigned"
+                                   .format(bthash))
+                else:
+                    self.log_warn(("    Conflict! Skipping hash '{0}'"
+                                   " (report #{1})").format(bthash,
+                                                            db_dup.id))
+            except FafError as ex:
+                self.log_warn("    {0}".format(str(ex)))
+                continue
 
     def tweak_cmdline_parser(self, parser):
         parser.add_problemtype(multiple=True)
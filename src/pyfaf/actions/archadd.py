@@ -18,6 +18,7 @@
 
 from pyfaf.actions import Action
 from pyfaf.queries import get_arch_by_name
+from pyfaf.refcache import refcache
 from pyfaf.storage.opsys import Arch
 
 
@@ -43,5 +44,7 @@ class ArchAdd(Action):
             db.session.add(new)
             db.session.flush()
 
+        refcache.invalidate()
+
     def tweak_cmdline_parser(self, parser):
         parser.add_argument("NAME", nargs="+", help="name of new architecture")
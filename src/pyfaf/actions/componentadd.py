@@ -19,6 +19,7 @@
 from pyfaf.actions import Action
 from pyfaf.opsys import systems
 from pyfaf.queries import get_component_by_name, get_component_by_name_release, get_opsys_by_name, get_osrelease
+from pyfaf.refcache import refcache
 from pyfaf.storage import OpSysComponent, OpSysReleaseComponent
 
 
@@ -76,6 +77,7 @@ class ComponentAdd(Action):
                 db.session.add(db_relcomponent)
 
         db.session.flush()
+        refcache.invalidate()
 
     def tweak_cmdline_parser(self, parser):
         parser.add_opsys()
@@ -16,20 +16,45 @@
 # You should have received a copy of the GNU General Public License
 # along with faf.  If not, see <http://www.gnu.org/licenses/>.
 
+import multiprocessing
 import satyr
 from collections import defaultdict
 from operator import itemgetter
+from sqlalchemy import exists, func, select
 from pyfaf.actions import Action
 from pyfaf.problemtypes import problemtypes
 from pyfaf.queries import (get_problems,
                            get_problem_component,
                            get_empty_problems,
+                           get_problem_representatives,
                            get_report_by_id,
+                           get_report_problem_ids,
+                           get_reports_by_problem_ids,
                            get_reports_by_type,
+                           get_unclustered_reports_by_type,
                            remove_problem_from_low_count_reports_by_type)
 from pyfaf.storage import Problem, ProblemComponent, Report
 
 
+# Clusters of threads being cut by the process pool. Set before the pool
+# is forked so that the workers inherit the threads and only cluster
+# indices and results need to be passed around.
+_pool_clusters = []
+
+
+def _cut_cluster(index):
+    """
+    Compute the distances and the dendrogram of the cluster at `index` of
+    `_pool_clusters` and return its cut as lists of thread indices.
+    """
+
+    cluster = _pool_clusters[index]
+    distances = satyr.Distances(cluster, len(cluster))
+    dendrogram = satyr.Dendrogram(distances)
+
+    return [list(dups) for dups in dendrogram.cut(0.3, 1)]
+
+
 class HashableSet(set):
     """
     A standard set object that hashes under its memory address.
@@ -161,27 +186,33 @@ class CreateProblems(Action):
 
         return clusters
 
-    def _find_problem_matches(self, db_problems, db_reports):
+    def _find_problem_matches(self, report_problems, problems_dict,
+                              db_reports):
         """
         Returns a list of possible matches between old problems and a new one.
         The list items are tuples in the form `(match_metric, db_reports, db_problem)`
         Higher `match_metric` means better match.
+        `report_problems` maps report ids to ids of the problems they were
+        assigned to, `problems_dict` problem ids to the candidate problems.
         """
-        matches = []
-        for db_problem in db_problems:
-            match = sum(1 for db_report in db_reports
-                        if db_report in db_problem.reports)
+        match_counts = defaultdict(int)
+        for db_report in db_reports:
+            problem_id = report_problems.get(db_report.id, None)
+            if problem_id in problems_dict:
+                match_counts[problem_id] += 1
 
-            if match > 0:
-                # Ratio of problems matched
-                match_metric = float(match)/len(db_reports)
-                self.log_debug("Found possible match #{0} ({1:.2f})"
-                               .format(db_problem.id, match_metric))
-                matches.append((match_metric, db_reports, db_problem))
+        matches = []
+        for problem_id, match in sorted(match_counts.items()):
+            db_problem = problems_dict[problem_id]
+            # Ratio of problems matched
+            match_metric = float(match)/len(db_reports)
+            self.log_debug("Found possible match #{0} ({1:.2f})"
+                           .format(problem_id, match_metric))
+            matches.append((match_metric, db_reports, db_problem))
 
         return matches
 
-    def _iter_problems(self, db, problems, db_problems, problems_dict,
+    def _iter_problems(self, db, problems, report_problems, problems_dict,
                        reuse_problems):
         """
         Yields (problem, db_problem, reports_changed) tuples.
@@ -217,7 +248,8 @@ class CreateProblems(Action):
                 self.log_debug("Looked up existing problem #{0}"
                                .format(db_problem.id))
             else:
-                matches = self._find_problem_matches(db_problems, problem)
+                matches = self._find_problem_matches(report_problems,
+                                                     problems_dict, problem)
                 if len(matches) == 0:
                     # No possible match found, must be a new problem
                     db_problem = Problem()
@@ -264,16 +296,12 @@ class CreateProblems(Action):
         self.log_debug("Total: {0}  Looked up: {1}  Found: {2}  Created: {3}"
                        .format(i, lookedup_count, found_count, created_count))
 
-    def _create_problems(self, db, problemplugin, report_min_count=0):
-        db_reports = get_reports_by_type(db, problemplugin.name,
-                                         min_count=report_min_count)
-        db_problems = get_problems(db)
+    def _get_reuse_problems(self, db_reports):
+        """
+        Return a dictionary sorted tuple of report ids -> problem id
+        of the problems `db_reports` are assigned to.
+        """
 
-        # dict to get db_problem by problem_id
-        self.log_debug("Creating problem reuse dict")
-        problems_dict = {}
-        for db_problem in db_problems:
-            problems_dict[db_problem.id] = db_problem
         # dict to get report_ids by problem_id
         problem_report = defaultdict(list)
         for db_report in db_reports:
@@ -284,6 +312,73 @@ class CreateProblems(Action):
         for (problem_id, report_ids) in problem_report.items():
             reuse_problems[tuple(sorted(report_ids))] = problem_id
 
+        return reuse_problems
+
+    def _cut_clusters(self, clusters, jobs=1):
+        """
+        Cut every cluster of threads by the distances of its threads.
+        Returns a list of the cuts in the order of `clusters`, a cut being
+        a list of lists of indices to its cluster. With `jobs` > 1 the
+        clusters are cut in a pool of `jobs` processes.
+        """
+
+        global _pool_clusters
+
+        if jobs < 2 or len(clusters) < 2:
+            cuts = []
+            i = 0
+            for cluster in clusters:
+                i += 1
+                self.log_debug("[{0} / {1}] Computing distances"
+                               .format(i, len(clusters)))
+                distances = satyr.Distances(cluster, len(cluster))
+
+                self.log_debug("Getting dendrogram")
+                dendrogram = satyr.Dendrogram(distances)
+                cuts.append(dendrogram.cut(0.3, 1))
+
+            return cuts
+
+        jobs = min(jobs, len(clusters))
+        self.log_debug("Computing distances and dendrograms of {0} clusters "
+                       "in {1} processes".format(len(clusters), jobs))
+
+        # The workers never touch the database and exit without cleaning
+        # up, the connections they inherit stay usable by this process.
+        _pool_clusters = clusters
+        pool = multiprocessing.Pool(jobs)
+        try:
+            # Biggest clusters first so that they don't end up last
+            # in a single worker
+            order = sorted(range(len(clusters)),
+                           key=lambda i: len(clusters[i]), reverse=True)
+            cuts = [None] * len(clusters)
+            done = 0
+            for index, cut in zip(order, pool.imap(_cut_cluster, order)):
+                done += 1
+                self.log_debug("[{0} / {1}] Cut cluster of {2} threads"
+                               .format(done, len(clusters),
+                                       len(clusters[index])))
+                cuts[index] = cut
+
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _pool_clusters = []
+
+        return cuts
+
+    def _cluster_reports(self, db, problemplugin, db_reports, jobs=1):
+        """
+        Cluster `db_reports` by similarity of their stacktraces. Returns
+        a tuple `(problems, invalid_report_ids)`, problems being a list
+        of collections of reports, invalid_report_ids ids of the reports
+        assigned to a problem whose stacktrace can not be loaded.
+        """
+
         invalid_report_ids_to_clean = []
         problems = []
         if len(db_reports) < 1:
@@ -295,13 +390,9 @@ class CreateProblems(Action):
         else:
             report_map = {}
             _satyr_reports = []
-            i = 0
-            for db_report in db_reports:
-                i += 1
-                self.log_debug("[{0} / {1}] Loading report #{2}"
-                               .format(i, len(db_reports), db_report.id))
-
-                _satyr_report = problemplugin._db_report_to_satyr(db_report)
+            self.log_debug("Loading {0} reports".format(len(db_reports)))
+            loaded = problemplugin.db_reports_to_satyr(db, db_reports)
+            for db_report, _satyr_report in zip(db_reports, loaded):
                 if _satyr_report is None:
                     self.log_debug("Unable to create satyr report")
                     if db_report.problem_id is not None:
@@ -317,20 +408,11 @@ class CreateProblems(Action):
             # Threads that share no function with another thread
             unique_func_threads = set(_satyr_reports) - set().union(*clusters)
 
-            dendrograms = []
-            i = 0
-            for cluster in clusters:
-                i += 1
-                self.log_debug("[{0} / {1}] Computing distances"
-                               .format(i, len(clusters)))
-                distances = satyr.Distances(cluster, len(cluster))
-
-                self.log_debug("Getting dendrogram")
-                dendrograms.append(satyr.Dendrogram(distances))
+            cuts = self._cut_clusters(clusters, jobs)
 
-            for dendrogram, cluster in zip(dendrograms, clusters):
+            for cut, cluster in zip(cuts, clusters):
                 problem = []
-                for dups in dendrogram.cut(0.3, 1):
+                for dups in cut:
                     reports = set(report_map[cluster[dup]] for dup in dups)
                     problem.append(reports)
 
@@ -340,9 +422,162 @@ class CreateProblems(Action):
             for thread in unique_func_threads:
                 problems.append(set([report_map[thread]]))
 
+        return problems, invalid_report_ids_to_clean
+
+    def _create_problems(self, db, problemplugin, report_min_count=0, jobs=1):
+        db_reports = get_reports_by_type(db, problemplugin.name,
+                                         min_count=report_min_count)
+        db_problems = get_problems(db)
+
+        self.log_debug("Creating problem reuse dict")
+        reuse_problems = self._get_reuse_problems(db_reports)
+
+        problems, invalid_report_ids = self._cluster_reports(db, problemplugin,
+                                                             db_reports, jobs)
+
+        self._save_problems(db, problemplugin, problems, db_problems,
+                            reuse_problems, invalid_report_ids,
+                            report_min_count)
+
+    def _update_problem_occurrences(self, db, report_type, report_min_count=0):
+        """
+        Move the last occurrence of problems to the last occurrence
+        of their reports of `report_type` that occurred again since the
+        problems were created.
+        """
+
+        problems = Problem.__table__
+        reports = Report.__table__
+
+        newer = (exists()
+                 .where(reports.c.problem_id == problems.c.id)
+                 .where(reports.c.type == report_type)
+                 .where(reports.c.last_occurrence >
+                        problems.c.last_occurrence))
+        last_occurrence = (select([func.max(reports.c.last_occurrence)])
+                           .where(reports.c.problem_id == problems.c.id))
+        if report_min_count > 0:
+            newer = newer.where(reports.c.count >= report_min_count)
+            last_occurrence = last_occurrence.where(
+                reports.c.count >= report_min_count)
+
+        result = db.session.execute(
+            problems.update()
+            .where(newer)
+            .values(last_occurrence=last_occurrence.as_scalar()))
+
+        self.log_debug("Updated last occurrence of {0} problems"
+                       .format(result.rowcount))
+
+    def _create_problems_incremental(self, db, problemplugin,
+                                     report_min_count=0, representatives=3,
+                                     jobs=1):
+        """
+        Cluster only the reports not assigned to a problem yet. These are
+        clustered together with up to `representatives` reports of each
+        existing problem first. Problems whose representatives end up with
+        a new report are then recomputed from all their reports and the new
+        ones, new reports matching no representative form new problems.
+        The other problems are left as they are.
+
+        Reports that occurred again since the last run only move the last
+        occurrence of their problems, the stacktrace of a report does not
+        change with a new occurrence. A full run is needed to pick up
+        stacktraces changed by retracing.
+        """
+
+        self._update_problem_occurrences(db, problemplugin.name,
+                                         report_min_count)
+
+        db_new_reports = get_unclustered_reports_by_type(
+            db, problemplugin.name, min_count=report_min_count)
+
+        problems = []
+        db_problems = []
+        reuse_problems = {}
+        invalid_report_ids = []
+        if len(db_new_reports) < 1:
+            self.log_info("No new reports found")
+        else:
+            db_representatives = get_problem_representatives(
+                db, problemplugin.name, limit=representatives,
+                min_count=report_min_count)
+
+            self.log_info("Matching {0} new reports against {1} "
+                          "representatives of existing problems"
+                          .format(len(db_new_reports),
+                                  len(db_representatives)))
+
+            # reports are expired by _cluster_reports
+            new_reports = set(db_new_reports)
+            representative_problems = dict(
+                (db_report, db_report.problem_id)
+                for db_report in db_representatives)
+
+            matches, invalid_report_ids = self._cluster_reports(
+                db, problemplugin, db_new_reports + db_representatives, jobs)
+
+            affected_problem_ids = set()
+            db_affected_new_reports = []
+            for problem in matches:
+                db_reports = [db_report for db_report in problem
+                              if db_report in new_reports]
+                if not db_reports:
+                    continue
+
+                problem_ids = set(representative_problems[db_report]
+                                  for db_report in problem
+                                  if db_report in representative_problems)
+                if problem_ids:
+                    affected_problem_ids |= problem_ids
+                    db_affected_new_reports.extend(db_reports)
+                else:
+                    problems.append(set(db_reports))
+
+            self.log_info("{0} new problems, recomputing {1} existing "
+                          "problems".format(len(problems),
+                                            len(affected_problem_ids)))
+
+            if affected_problem_ids:
+                db_affected_reports = get_reports_by_problem_ids(
+                    db, list(affected_problem_ids), report_type=problemplugin.name,
+                    min_count=report_min_count)
+                db_problems = (db.session.query(Problem)
+                               .filter(Problem.id.in_(list(affected_problem_ids)))
+                               .all())
+
+                reuse_problems = self._get_reuse_problems(db_affected_reports)
+
+                affected, invalid = self._cluster_reports(
+                    db, problemplugin,
+                    db_affected_new_reports + db_affected_reports, jobs)
+                problems.extend(affected)
+                invalid_report_ids = sorted(set(invalid_report_ids) |
+                                            set(invalid))
+
+        self._save_problems(db, problemplugin, problems, db_problems,
+                            reuse_problems, invalid_report_ids,
+                            report_min_count)
+
+    def _save_problems(self, db, problemplugin, problems, db_problems,
+                       reuse_problems, invalid_report_ids_to_clean,
+                       report_min_count=0):
+        """
+        Assign reports to problems from the clustered `problems`, reusing
+        `db_problems` where possible.
+        """
+
+        # dict to get db_problem by problem_id
+        problems_dict = {}
+        for db_problem in db_problems:
+            problems_dict[db_problem.id] = db_problem
+
+        # report id -> problem id of the reports before this run
+        report_problems = get_report_problem_ids(db, problemplugin.name)
+
         self.log_info("Creating problems from clusters")
         for problem, db_problem, reports_changed in self._iter_problems(
-                db, problems, db_problems, problems_dict, reuse_problems):
+                db, problems, report_problems, problems_dict, reuse_problems):
 
             comps = {}
 
@@ -415,7 +650,13 @@ class CreateProblems(Action):
             self.log_info("[{0} / {1}] Processing problem type: {2}"
                           .format(i, len(ptypes), problemplugin.nice_name))
 
-            self._create_problems(db, problemplugin, cmdline.report_min_count)
+            if cmdline.incremental:
+                self._create_problems_incremental(
+                    db, problemplugin, cmdline.report_min_count,
+                    cmdline.representatives, cmdline.jobs)
+            else:
+                self._create_problems(db, problemplugin,
+                                      cmdline.report_min_count, cmdline.jobs)
 
         self._remove_empty_problems(db)
 
@@ -424,3 +665,14 @@ class CreateProblems(Action):
         parser.add_argument("--report-min-count", type=int,
                             default=-1,
                             help="Ignore reports with count less than this.")
+        parser.add_argument("--incremental", action="store_true",
+                            default=False,
+                            help="Only cluster reports not assigned to "
+                                 "a problem yet.")
+        parser.add_argument("--representatives", type=int, default=3,
+                            help="Number of reports of each problem new "
+                                 "reports are matched against in the "
+                                 "incremental mode.")
+        parser.add_argument("--jobs", type=int, default=1, metavar="N",
+                            help="Compute distances and dendrograms of "
+                                 "clusters in N processes.")
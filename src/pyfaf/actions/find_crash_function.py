@@ -19,7 +19,7 @@
 import satyr
 from pyfaf.actions import Action
 from pyfaf.problemtypes import problemtypes
-from pyfaf.queries import get_backtraces_by_type
+from pyfaf.queries import get_backtraces_by_type, get_crash_threads
 from pyfaf.retrace import demangle
 from pyfaf.storage import ReportBacktrace, column_len
 
@@ -35,11 +35,39 @@ class FindCrashFunction(Action):
                                                query_all=query_all)
         db_backtraces_count = db_backtraces.count()
         i = 0
+        batch = []
         for db_backtrace in db_backtraces.yield_per(100):
+            batch.append(db_backtrace)
+            if len(batch) >= 100:
+                i = self._find_crashfn_batch(db, problemplugin, batch, i,
+                                             db_backtraces_count)
+                batch = []
+
+        if batch:
+            self._find_crashfn_batch(db, problemplugin, batch, i,
+                                     db_backtraces_count)
+
+    def _find_crashfn_batch(self, db, problemplugin, db_backtraces, i,
+                            db_backtraces_count):
+        """
+        Update the crash function of `db_backtraces`, their crash threads
+        are loaded in bulk. Returns the number of backtraces processed so
+        far, `i` being the count before the batch.
+        """
+
+        crash_threads = get_crash_threads(db, [db_backtrace.id for
+                                               db_backtrace in db_backtraces])
+        for db_backtrace in db_backtraces:
             i += 1
+            threads = crash_threads.get(db_backtrace.id, [])
+            if len(threads) != 1:
+                self.log_warn("Backtrace #{0} has {1} crash threads"
+                              .format(db_backtrace.id, len(threads)))
+                continue
+
             try:
-                crashfn = (demangle(problemplugin.find_crash_function(
-                           db_backtrace))[:column_len(ReportBacktrace, "crashfn")])
+                crashfn = (demangle(problemplugin.find_thread_crash_function(
+                           threads[0]))[:column_len(ReportBacktrace, "crashfn")])
             except Exception as ex:
                 self.log_warn("Unable to find crash function: {0}"
                               .format(str(ex)))
@@ -55,11 +83,10 @@ class FindCrashFunction(Action):
                               .format(i, db_backtraces_count, db_backtrace.id,
                                       db_backtrace.crashfn))
 
-            if (i % 100) == 0:
-                db.session.flush()
-
         db.session.flush()
 
+        return i
+
     def run(self, cmdline, db):
         if len(cmdline.problemtype) < 1:
             ptypes = problemtypes.keys()
@@ -0,0 +1,142 @@
+# Copyright (C) 2016  ABRT Team
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This file is part of faf.
+#
+# faf is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# faf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with faf.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+from pyfaf.actions import Action
+from pyfaf.common import FafError, ensure_dirs
+from pyfaf.config import paths
+from pyfaf.spool import SegmentSpool, SpoolCounter, segment_spool_enabled
+
+
+class MigrateSpool(Action):
+    name = "migrate-spool"
+
+    def __init__(self):
+        super(MigrateSpool, self).__init__()
+
+        self.dir_report_incoming = paths["reports_incoming"]
+        self.dir_report_deferred = paths["reports_deferred"]
+        self.dir_report_segments = paths["reports_segments"]
+
+        try:
+            ensure_dirs([self.dir_report_incoming, self.dir_report_deferred,
+                         self.dir_report_segments])
+        except FafError as ex:
+            self.log_error("Required directories can't be created: {0}"
+                           .format(str(ex)))
+            raise
+
+    def _migrate_dir(self, spool, directory, dry_run=False):
+        """
+        Append the uReports stored as files in `directory` to `spool` and
+        remove the files. Return the number of migrated uReports.
+        """
+
+        # keep the order save-reports would process them in
+        fnames = []
+        for fname in os.listdir(directory):
+            if fname.startswith("."):
+                continue
+
+            filename = os.path.join(directory, fname)
+            fnames.append((os.path.getmtime(filename), fname))
+
+        fnames.sort()
+
+        i = 0
+        for mtime, fname in fnames:
+            i += 1
+
+            filename = os.path.join(directory, fname)
+            self.log_info("[{0} / {1}] Migrating file '{2}'"
+                          .format(i, len(fnames), filename))
+
+            with open(filename, "rb") as fil:
+                data = fil.read()
+
+            if dry_run:
+                continue
+
+            segment, number = spool.append(data, timestamp=mtime)
+            os.unlink(filename)
+
+            self.log_debug("Stored as record {0}/{1}".format(segment, number))
+
+        return len(fnames)
+
+    def _requeue_deferred(self, spool, dry_run=False):
+        """
+        Requeue the deferred records of `spool`. Return their number.
+        """
+
+        spool.lock_reader()
+        try:
+            records = spool.deferred()
+            for record in records:
+                self.log_info("Requeueing record {0}/{1}"
+                              .format(record.segment, record.number))
+
+            if not dry_run:
+                spool.requeue(records)
+        finally:
+            spool.unlock_reader()
+
+        return len(records)
+
+    def run(self, cmdline, db):
+        if not segment_spool_enabled():
+            self.log_warn("uReport.SpoolFormat is not 'segments', the "
+                          "migrated uReports will not be saved until it is "
+                          "changed")
+
+        spool = SegmentSpool(self.dir_report_segments)
+
+        migrated = self._migrate_dir(spool, self.dir_report_incoming,
+                                     dry_run=cmdline.dry_run)
+
+        if not cmdline.dry_run:
+            # the depth of the file spool
+            SpoolCounter(paths["reports_depth"]).add(-migrated)
+            self.log_info("Migrated {0} uReports to '{1}'"
+                          .format(migrated, self.dir_report_segments))
+
+        if cmdline.deferred:
+            try:
+                requeued = self._requeue_deferred(spool,
+                                                  dry_run=cmdline.dry_run)
+            except FafError as ex:
+                self.log_error("Can't requeue deferred records: {0}"
+                               .format(str(ex)))
+                return 1
+
+            requeued += self._migrate_dir(spool, self.dir_report_deferred,
+                                          dry_run=cmdline.dry_run)
+
+            if not cmdline.dry_run:
+                self.log_info("Requeued {0} deferred uReports"
+                              .format(requeued))
+
+    def tweak_cmdline_parser(self, parser):
+        parser.add_argument("--dry-run", action="store_true", default=False,
+                            help="only list the uReports to be migrated")
+        parser.add_argument("--deferred", action="store_true", default=False,
+                            help="also requeue deferred uReports, both "
+                            "records of the segment spool and files in the "
+                            "deferred directory; save-reports must not be "
+                            "running")
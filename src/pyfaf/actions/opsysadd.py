@@ -18,6 +18,7 @@
 
 from pyfaf.actions import Action
 from pyfaf.queries import get_opsys_by_name
+from pyfaf.refcache import refcache
 from pyfaf.storage.opsys import OpSys
 
 
@@ -41,6 +42,7 @@ class OpSysAdd(Action):
         new.name = cmdline.NAME
         db.session.add(new)
         db.session.flush()
+        refcache.invalidate()
 
     def tweak_cmdline_parser(self, parser):
         parser.add_argument('NAME', help='name of new operating system')
@@ -18,6 +18,7 @@
 
 from pyfaf.actions import Action
 from pyfaf.queries import get_opsys_by_name
+from pyfaf.refcache import refcache
 
 
 class OpSysDel(Action):
@@ -47,6 +48,7 @@ class OpSysDel(Action):
 
         db.session.delete(opsys)
         db.session.flush()
+        refcache.invalidate()
 
     def tweak_cmdline_parser(self, parser):
         parser.add_argument('NAME', help='name of new operating system')
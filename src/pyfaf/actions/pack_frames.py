@@ -0,0 +1,78 @@
+# Copyright (C) 2016  ABRT Team
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This file is part of faf.
+#
+# faf is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# faf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with faf.  If not, see <http://www.gnu.org/licenses/>.
+
+from sqlalchemy.orm import joinedload
+
+from pyfaf.actions import Action
+from pyfaf.problemtypes import problemtypes
+from pyfaf.storage import Report, ReportBacktrace, ReportBtThread
+
+
+class PackFrames(Action):
+    name = "pack-frames"
+
+    def __init__(self):
+        super(PackFrames, self).__init__()
+
+    def run(self, cmdline, db):
+        query = db.session.query(ReportBtThread.id)
+        if cmdline.unpack:
+            query = query.filter(ReportBtThread.packed_frames != None)
+        else:
+            query = query.filter(ReportBtThread.packed_frames == None)
+
+        if cmdline.problemtype:
+            ptypes = [problemtypes[ptype].name
+                      for ptype in cmdline.problemtype]
+            query = (query.join(ReportBacktrace)
+                     .join(Report)
+                     .filter(Report.type.in_(ptypes)))
+
+        thread_ids = [thread_id for (thread_id,) in
+                      query.order_by(ReportBtThread.id)]
+
+        for start in xrange(0, len(thread_ids), cmdline.chunk_size):
+            chunk = thread_ids[start:start + cmdline.chunk_size]
+
+            db_threads = (db.session.query(ReportBtThread)
+                          .options(joinedload(ReportBtThread.frames))
+                          .filter(ReportBtThread.id.in_(chunk))
+                          .all())
+
+            for db_thread in db_threads:
+                if cmdline.unpack:
+                    db_thread.unpack_frames()
+                else:
+                    db_thread.pack_frames()
+
+            db.session.flush()
+            # the deleted frames are kept in the thread collections
+            db.session.expunge_all()
+
+            self.log_info("[{0} / {1}] {2} threads"
+                          .format(start + len(chunk), len(thread_ids),
+                                  "Unpacked" if cmdline.unpack else "Packed"))
+
+        return 0
+
+    def tweak_cmdline_parser(self, parser):
+        parser.add_problemtype(multiple=True)
+        parser.add_argument("--unpack", action="store_true", default=False,
+                            help="move packed frames back to frame rows")
+        parser.add_argument("--chunk-size", type=int, default=1000,
+                            help="number of threads processed at once")
@@ -0,0 +1,172 @@
+# Copyright (C) 2016  ABRT Team
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This file is part of faf.
+#
+# faf is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# faf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with faf.  If not, see <http://www.gnu.org/licenses/>.
+
+from sqlalchemy import case, exists, func, or_, select
+
+from pyfaf.actions import Action
+from pyfaf.problemtypes import problemtypes
+from pyfaf.storage import (Report,
+                           ReportBacktrace,
+                           ReportBtFrame,
+                           ReportBtTaintFlag,
+                           ReportBtThread,
+                           Symbol,
+                           SymbolSource)
+
+
+class RecomputeQuality(Action):
+    name = "recompute-quality"
+
+    def __init__(self):
+        super(RecomputeQuality, self).__init__()
+
+    def _quality(self):
+        """
+        Return SQL expression computing quality of a backtrace the same
+        way as ReportBacktrace.compute_quality does.
+        """
+
+        backtraces = ReportBacktrace.__table__
+        threads = ReportBtThread.__table__
+        frames = ReportBtFrame.__table__
+        ssources = SymbolSource.__table__
+        symbols = Symbol.__table__
+
+        crash_frames = (frames
+                        .join(threads, frames.c.thread_id == threads.c.id)
+                        .join(ssources,
+                              frames.c.symbolsource_id == ssources.c.id)
+                        .outerjoin(symbols,
+                                   ssources.c.symbol_id == symbols.c.id))
+
+        crash_frames_filter = ((threads.c.backtrace_id == backtraces.c.id) &
+                               (threads.c.crashthread == True))
+
+        penalty = (
+            case([(or_(symbols.c.id == None, symbols.c.name == "??"), 1)],
+                 else_=0) +
+            case([(or_(ssources.c.source_path == None,
+                       ssources.c.source_path == ""), 1)], else_=0) +
+            case([(or_(ssources.c.line_number == None,
+                       ssources.c.line_number == 0), 1)], else_=0) +
+            case([(frames.c.reliable == False, 1)], else_=0))
+
+        frames_penalty = (select([func.coalesce(func.sum(penalty), 0)])
+                          .select_from(crash_frames)
+                          .where(crash_frames_filter)
+                          .as_scalar())
+
+        frames_count = (select([func.count(frames.c.order)])
+                        .select_from(crash_frames)
+                        .where(crash_frames_filter)
+                        .as_scalar())
+
+        taintflags = ReportBtTaintFlag.__table__
+        taintflags_count = (select([func.count(taintflags.c.taintflag_id)])
+                            .where(taintflags.c.backtrace_id ==
+                                   backtraces.c.id)
+                            .as_scalar())
+
+        return (-taintflags_count - frames_penalty -
+                case([(frames_count == 0, 100)], else_=0))
+
+    def _recompute_packed(self, db, ptypes):
+        """
+        Recompute quality of backtraces with packed crash threads, their
+        frames can not be read by SQL.
+        """
+
+        query = (db.session.query(ReportBacktrace)
+                 .filter(ReportBacktrace.id.in_(
+                     db.session.query(ReportBtThread.backtrace_id)
+                     .filter(ReportBtThread.crashthread == True)
+                     .filter(ReportBtThread.packed_frames != None))))
+        if ptypes:
+            query = query.join(Report).filter(Report.type.in_(ptypes))
+
+        total = 0
+        for db_backtrace in query.yield_per(100):
+            quality = db_backtrace.compute_quality()
+            if db_backtrace.quality != quality:
+                db_backtrace.quality = quality
+
+            total += 1
+            if total % 100 == 0:
+                db.session.flush()
+
+        db.session.flush()
+        return total
+
+    def run(self, cmdline, db):
+        backtraces = ReportBacktrace.__table__
+        threads = ReportBtThread.__table__
+
+        query = db.session.query(func.min(ReportBacktrace.id),
+                                 func.max(ReportBacktrace.id))
+        if cmdline.problemtype:
+            ptypes = [problemtypes[ptype].name
+                      for ptype in cmdline.problemtype]
+            query = (query.join(Report)
+                     .filter(Report.type.in_(ptypes)))
+        else:
+            ptypes = None
+
+        min_id, max_id = query.one()
+        if min_id is None:
+            self.log_info("No backtraces found")
+            return 0
+
+        quality = self._quality()
+        total = 0
+        for start in xrange(min_id, max_id + 1, cmdline.chunk_size):
+            end = min(start + cmdline.chunk_size, max_id + 1)
+
+            # backtraces are updated directly in SQL,
+            # no backtrace is loaded into the session
+            update = (backtraces.update()
+                      .where(backtraces.c.id >= start)
+                      .where(backtraces.c.id < end)
+                      .where(~exists()
+                             .where(threads.c.backtrace_id == backtraces.c.id)
+                             .where(threads.c.crashthread == True)
+                             .where(threads.c.packed_frames != None))
+                      .values(quality=quality))
+            if ptypes:
+                update = update.where(
+                    backtraces.c.report_id.in_(
+                        select([Report.id]).where(Report.type.in_(ptypes))))
+
+            result = db.session.execute(update)
+            total += result.rowcount
+            self.log_info("[{0} / {1}] Recomputed quality of {2} backtraces"
+                          .format(end - 1, max_id, result.rowcount))
+
+        packed = self._recompute_packed(db, ptypes)
+        if packed:
+            self.log_info("Recomputed quality of {0} backtraces with packed "
+                          "frames".format(packed))
+            total += packed
+
+        self.log_info("Recomputed quality of {0} backtraces".format(total))
+        return 0
+
+    def tweak_cmdline_parser(self, parser):
+        parser.add_problemtype(multiple=True)
+        parser.add_argument("--chunk-size", type=int, default=10000,
+                            help="number of backtrace ids updated by "
+                                 "a single statement")
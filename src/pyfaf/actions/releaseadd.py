@@ -19,6 +19,7 @@
 from pyfaf.actions import Action
 from pyfaf.opsys import systems
 from pyfaf.queries import get_opsys_by_name, get_osrelease
+from pyfaf.refcache import refcache
 from pyfaf.storage import OpSysRelease, OpSysReleaseStatus
 
 
@@ -64,6 +65,7 @@ class ReleaseAdd(Action):
         db.session.add(db_release)
 
         db.session.flush()
+        refcache.invalidate()
 
     def tweak_cmdline_parser(self, parser):
         parser.add_opsys()
@@ -19,6 +19,7 @@
 from pyfaf.actions import Action
 from pyfaf.opsys import systems
 from pyfaf.queries import get_opsys_by_name, get_osrelease
+from pyfaf.refcache import refcache
 from pyfaf.storage import OpSysRelease, OpSysReleaseStatus
 
 
@@ -63,6 +64,7 @@ class ReleaseModify(Action):
             db_release.status = cmdline.status
 
         db.session.flush()
+        refcache.invalidate()
 
     def tweak_cmdline_parser(self, parser):
         parser.add_opsys()
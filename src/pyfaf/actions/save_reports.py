@@ -18,6 +18,9 @@
 
 import os
 import json
+import multiprocessing
+import Queue
+import collections
 import datetime
 import time
 import glob
@@ -25,12 +28,27 @@ import hashlib
 import signal
 import sys
 
+try:
+    import pyinotify
+except ImportError:
+    # Invalid name "pyinotify" for type constant
+    # pylint: disable-msg=C0103
+    pyinotify = None
+
+from sqlalchemy.exc import IntegrityError
+
 from pyfaf.actions import Action
 from pyfaf.common import FafError, ensure_dirs
 from pyfaf.opsys import systems
+from pyfaf.problemtypes import problemtypes
 from pyfaf.queries import get_unknown_opsys
+from pyfaf.spool import (CoalescedReports, SegmentSpool, SpoolCounter,
+                         parse_record, record_body, record_count,
+                         segment_spool_enabled, set_record_count)
 from pyfaf.storage import UnknownOpSys
-from pyfaf.ureport import save, save_attachment, validate, validate_attachment
+from pyfaf.ureport import (get_dedupe_key, get_report_hash, save,
+                           save_attachments, save_batch, validate,
+                           validate_attachment)
 from pyfaf.utils.parse import str2bool
 from pyfaf.config import paths
 
@@ -38,6 +56,10 @@ from pyfaf.config import paths
 class SaveReports(Action):
     name = "save-reports"
 
+    # times a uReport is saved before a unique constraint violation is
+    # considered permanent
+    save_attempts = 3
+
     def __init__(self):
         super(SaveReports, self).__init__()
 
@@ -48,6 +70,10 @@ class SaveReports(Action):
                                  ["ureport.createcomponents"],
                                  False, callback=str2bool)
 
+        self.load_config_to_self("bug_download_threads",
+                                 ["ureport.bugdownloadthreads"],
+                                 4, callback=int)
+
         # Instance of 'SaveReports' has no 'basedir' member
         # pylint: disable-msg=E1101
 
@@ -61,46 +87,144 @@ class SaveReports(Action):
         self.dir_attach_saved = paths["attachments_saved"]
         self.dir_attach_deferred = paths["attachments_deferred"]
 
+        dirs = [self.dir_report_incoming, self.dir_report_saved,
+                self.dir_report_deferred, self.dir_attach_incoming,
+                self.dir_attach_saved, self.dir_attach_deferred]
+
+        self.dir_report_coalesced = paths["reports_coalesced"]
+        dirs.append(self.dir_report_coalesced)
+
+        self.segments = None
+        if segment_spool_enabled():
+            dirs.append(paths["reports_segments"])
+
         try:
-            ensure_dirs([self.dir_report_incoming, self.dir_report_saved,
-                         self.dir_report_deferred, self.dir_attach_incoming,
-                         self.dir_attach_saved, self.dir_attach_deferred])
+            ensure_dirs(dirs)
         except FafError as ex:
             self.log_error("Required directories can't be created: {0}"
                            .format(str(ex)))
             raise
 
-    def _move_report_to_saved(self, filename):
+        if segment_spool_enabled():
+            self.segments = SegmentSpool()
+            self.depth = self.segments.depth
+        else:
+            self.depth = SpoolCounter(paths["reports_depth"])
+
+        self.coalesced = CoalescedReports(self.dir_report_coalesced)
+
+        # files queued by --daemon in the order they were noticed
+        self._pending = collections.deque()
+        self._queued = set()
+        self._last_scan = 0
+
+    def _move_report(self, filename, dir_to, target):
+        """
+        Move `filename` from incoming to `dir_to`. Return True on success.
+        """
+
         path_from = os.path.join(self.dir_report_incoming, filename)
-        path_to = os.path.join(self.dir_report_saved, filename)
+        path_to = os.path.join(dir_to, filename)
 
-        self.log_debug("Moving file '{0}' to saved".format(path_from))
+        self.log_debug("Moving file '{0}' to {1}".format(path_from, target))
 
         try:
             os.rename(path_from, path_to)
         except OSError as ex:
-            self.log_warn("Can't move file '{0}' to saved: {1}"
-                          .format(path_from, str(ex)))
+            self.log_warn("Can't move file '{0}' to {1}: {2}"
+                          .format(path_from, target, str(ex)))
+            return False
+
+        return True
+
+    def _move_report_to_saved(self, filename):
+        self._move_reports_to_saved([filename])
 
     def _move_reports_to_saved(self, filenames):
-        for filename in filenames:
-            self._move_report_to_saved(filename)
+        moved = sum(self._move_report(filename, self.dir_report_saved,
+                                      "saved")
+                    for filename in filenames)
+        self.depth.add(-moved)
 
     def _move_report_to_deferred(self, filename):
-        path_from = os.path.join(self.dir_report_incoming, filename)
-        path_to = os.path.join(self.dir_report_deferred, filename)
+        self._move_reports_to_deferred([filename])
 
-        self.log_debug("Moving file '{0}' to deferred".format(path_from))
+    def _move_reports_to_deferred(self, filenames):
+        moved = sum(self._move_report(filename, self.dir_report_deferred,
+                                      "deferred")
+                    for filename in filenames)
+        self.depth.add(-moved)
+
+    def _sync_depth(self, fnames=None):
+        """
+        Set the depth counter of the spool to the real number of waiting
+        uReports, correcting updates lost by crashed processes. `fnames`
+        is the listing of the incoming directory if already known.
+        """
+
+        if self.segments is not None:
+            depth = self.segments.count_pending()
+        else:
+            if fnames is None:
+                fnames = os.listdir(self.dir_report_incoming)
+
+            depth = sum(1 for fname in fnames if not fname.startswith("."))
+
+        self.depth.set(depth)
+
+    def _save_coalesced(self, db, batch_size=0):
+        """
+        Save the uReports merged by the web tier while the spool was over
+        its high-water mark, each counted as many times as it was received.
+        """
+
+        taken = self.coalesced.take()
+        if not taken:
+            return
+
+        self.log_info("Saving {0} coalesced uReports".format(len(taken)))
+
+        entries = []
+        deferred = []
+        for name, data, count in taken:
+            parsed = self._parse_report(db, data)
+            if parsed is None:
+                deferred.append((name, data, count))
+                continue
 
-        try:
-            os.rename(path_from, path_to)
-        except OSError as ex:
-            self.log_warn("Can't move file '{0}' to deferred: {1}"
-                          .format(path_from, str(ex)))
+            ureport, report_hash, received, header_count = parsed
+            if received is None:
+                received = time.time()
 
-    def _move_reports_to_deferred(self, filenames):
-        for filename in filenames:
-            self._move_report_to_deferred(filename)
+            timestamp = datetime.datetime.fromtimestamp(received)
+            entries.append(([(name, data, count)], ureport, timestamp,
+                            count * header_count, report_hash))
+
+        failed = self._save_entries(db, entries, batch_size=batch_size)
+        for i in failed:
+            deferred.extend(entries[i][0])
+
+        # keep the uReports that could not be saved for inspection, with
+        # their count so that they are saved as many times when requeued
+        for name, data, count in deferred:
+            path_to = os.path.join(self.dir_report_deferred, name)
+            self.log_debug("Writing coalesced uReport to '{0}'"
+                           .format(path_to))
+
+            try:
+                data = set_record_count(data, count * record_count(data))
+            except ValueError as ex:
+                self.log_warn("Can't store the count of '{0}': {1}"
+                              .format(name, str(ex)))
+
+            try:
+                with open(path_to, "wb") as fil:
+                    fil.write(data)
+            except (IOError, OSError) as ex:
+                self.log_warn("Can't write file '{0}': {1}"
+                              .format(path_to, str(ex)))
+
+        self.coalesced.done([name for name, data, count in taken])
 
     def _move_attachment_to_saved(self, filename):
         path_from = os.path.join(self.dir_attach_incoming, filename)
@@ -144,6 +268,113 @@ class SaveReports(Action):
         db_unknown_opsys.count += 1
         db.session.flush()
 
+    def _parse_report(self, db, data):
+        """
+        Parse and validate the uReport in `data`. Return a (ureport,
+        report hash, receive timestamp, count) tuple or None if it is not
+        valid. Spool records written by the web tier have already been
+        validated and carry the report hash and the receive timestamp, these
+        are None for plain uReports. Count is the number of received
+        uReports a record of coalesced uReports stands for, 1 otherwise.
+        """
+
+        try:
+            record = parse_record(data)
+            if record is not None:
+                header, ureport = record
+                return (ureport, header["hash"], header["received"],
+                        header.get("count", 1))
+
+            ureport = json.loads(data)
+        except (KeyError, ValueError) as ex:
+            self.log_warn("Failed to load uReport: {0}".format(str(ex)))
+            return None
+
+        try:
+            validate(ureport)
+        except FafError as ex:
+            self.log_warn("uReport is invalid: {0}".format(str(ex)))
+
+            if ("os" in ureport and
+                "name" in ureport["os"] and
+                ureport["os"]["name"] not in systems and
+                ureport["os"]["name"].lower() not in systems):
+                self._save_unknown_opsys(db, ureport["os"])
+
+            return None
+
+        return ureport, None, None, 1
+
+    def _load_report(self, db, fname):
+        """
+        Load and validate the uReport stored in `fname` in the incoming
+        directory. Return a (ureport, timestamp, report hash, count) tuple
+        or None if the file has been moved to deferred.
+        """
+
+        filename = os.path.join(self.dir_report_incoming, fname)
+
+        try:
+            with open(filename, "r") as fil:
+                data = fil.read()
+        except (IOError, OSError) as ex:
+            self.log_warn("Failed to load uReport: {0}".format(str(ex)))
+            self._move_report_to_deferred(fname)
+            return None
+
+        parsed = self._parse_report(db, data)
+        if parsed is None:
+            self._move_report_to_deferred(fname)
+            return None
+
+        ureport, report_hash, received, count = parsed
+        if received is None:
+            received = os.path.getmtime(filename)
+
+        timestamp = datetime.datetime.fromtimestamp(received)
+
+        return ureport, timestamp, report_hash, count
+
+    def _load_records(self, db, records):
+        """
+        Parse and validate SpoolRecords of the segment spool. Return a list
+        of ([(segment, number)], ureport, timestamp, count, report hash)
+        entries, invalid records are marked as deferred.
+        """
+
+        entries = []
+        deferred = []
+        for record in records:
+            key = (record.segment, record.number)
+            self.log_debug("Loading record {0}/{1}".format(*key))
+
+            parsed = self._parse_report(db, record.data)
+            if parsed is None:
+                deferred.append(key)
+                continue
+
+            ureport, report_hash, received, count = parsed
+            if received is None:
+                received = record.timestamp
+
+            timestamp = datetime.datetime.fromtimestamp(received)
+            entries.append(([key], ureport, timestamp, count, report_hash))
+
+        self.segments.mark(deferred, SegmentSpool.DEFERRED)
+
+        return entries
+
+    def _retire_segments(self):
+        """
+        Remove the processed segments of the segment spool, writing their
+        deferred records to the deferred directory.
+        """
+
+        retired = self.segments.retire(self.dir_report_deferred)
+        if retired:
+            self.log_info("Retired {0} processed segments"
+                          .format(len(retired)))
+
     def _save_reports(self, db):
         self.log_info("Saving reports")
 
@@ -157,42 +388,381 @@ class SaveReports(Action):
             self.log_info("[{0} / {1}] Processing file '{2}'"
                           .format(i, len(report_filenames), filename))
 
-            try:
-                with open(filename, "r") as fil:
-                    ureport = json.load(fil)
-            except (OSError, ValueError) as ex:
-                self.log_warn("Failed to load uReport: {0}".format(str(ex)))
-                self._move_report_to_deferred(fname)
+            loaded = self._load_report(db, fname)
+            if loaded is None:
                 continue
 
+            ureport, timestamp, report_hash, count = loaded
+
             try:
-                validate(ureport)
+                save(db, ureport, create_component=self.create_components,
+                     timestamp=timestamp, count=count,
+                     report_hash=report_hash)
             except FafError as ex:
-                self.log_warn("uReport is invalid: {0}".format(str(ex)))
-
-                if ("os" in ureport and
-                    "name" in ureport["os"] and
-                    ureport["os"]["name"] not in systems and
-                    ureport["os"]["name"].lower() not in systems):
-                    self._save_unknown_opsys(db, ureport["os"])
-
+                self.log_warn("Failed to save uReport: {0}".format(str(ex)))
                 self._move_report_to_deferred(fname)
                 continue
 
-            mtime = os.path.getmtime(filename)
-            timestamp = datetime.datetime.fromtimestamp(mtime)
+            self._move_report_to_saved(fname)
+
+    def _move_entries(self, entries, failed):
+        """
+        Move the files of `entries` to deferred if their index is in `failed`
+        and to saved otherwise. With the segment spool the records of
+        `entries` are marked instead.
+        """
+
+        saved = []
+        deferred = []
+        for i, (keys, ureport, timestamp, count,
+                report_hash) in enumerate(entries):
+            if i in failed:
+                deferred.extend(keys)
+            else:
+                saved.extend(keys)
+
+        if self.segments is not None:
+            self.segments.mark(deferred, SegmentSpool.DEFERRED)
+            self.segments.mark(saved, SegmentSpool.SAVED)
+        else:
+            self._move_reports_to_deferred(deferred)
+            self._move_reports_to_saved(saved)
+
+    def _save_batch(self, db, entries, progress=None):
+        """
+        Save `entries`, a list of (filenames, ureport, timestamp, count,
+        report hash) tuples, in a single transaction. Fall back to saving
+        them one by one if the batch can't be saved as a whole. Return the
+        set of indices of entries that failed to save. `progress` is called
+        as described in `_save_entries`.
+        """
 
+        try:
+            failed = save_batch(db, [entry[1:] for entry in entries],
+                                create_component=self.create_components)
+        except (FafError, IntegrityError) as ex:
+            self.log_warn("Failed to save batch: {0}".format(str(ex)))
+            self.log_info("Saving {0} uReports one by one"
+                          .format(len(entries)))
+
+            return self._save_entries(db, entries, progress=progress)
+
+        failed_idx = set()
+        for i, ex in failed:
+            self.log_warn("Failed to save uReport: {0}".format(str(ex)))
+            failed_idx.add(i)
+
+        if progress is not None:
+            progress([(i, i in failed_idx) for i in xrange(len(entries))])
+
+        return failed_idx
+
+    def _save_entry(self, db, ureport, timestamp, count, report_hash):
+        """
+        Save a single uReport. Symbols, symbol sources, builds, packages
+        and components are shared by uReports of different reports and may
+        be created by another process at the same time. If that makes the
+        insert fail on a unique constraint, the uReport is saved again and
+        finds the row created by the other process.
+        """
+
+        attempt = 1
+        while True:
             try:
                 save(db, ureport, create_component=self.create_components,
-                     timestamp=timestamp)
-            except FafError as ex:
+                     timestamp=timestamp, count=count,
+                     report_hash=report_hash)
+                return
+            except IntegrityError as ex:
+                if attempt >= self.save_attempts:
+                    raise
+
+                self.log_debug("Conflict while saving uReport, trying "
+                               "again: {0}".format(str(ex)))
+                attempt += 1
+
+    def _save_entries(self, db, entries, batch_size=0, progress=None):
+        """
+        Save `entries`, a list of (filenames, ureport, timestamp, count,
+        report hash) tuples, one by one or in batches of `batch_size`. Return the set
+        of indices of entries that failed to save. `progress`, if given,
+        is called with a list of (index, failed) tuples as soon as entries
+        are saved or rejected.
+        """
+
+        failed = set()
+
+        if batch_size > 0:
+            for start in xrange(0, len(entries), batch_size):
+                batch = entries[start:start + batch_size]
+
+                def batch_progress(done, start=start):
+                    if progress is not None:
+                        progress([(start + i, fail) for i, fail in done])
+
+                self.log_info("Saving batch of {0} uReports"
+                              .format(len(batch)))
+                failed.update(start + i
+                              for i in self._save_batch(
+                                  db, batch, progress=batch_progress))
+
+            return failed
+
+        for i, (filenames, ureport, timestamp, count,
+                report_hash) in enumerate(entries):
+            try:
+                self._save_entry(db, ureport, timestamp, count, report_hash)
+            except (FafError, IntegrityError) as ex:
                 self.log_warn("Failed to save uReport: {0}".format(str(ex)))
-                self._move_report_to_deferred(fname)
+                failed.add(i)
+
+            if progress is not None:
+                progress([(i, i in failed)])
+
+        return failed
+
+    def _dedupe_entries(self, entries):
+        """
+        Merge `entries` with the same `get_dedupe_key` into a single entry
+        with the sum of their counts and the latest timestamp.
+        """
+
+        groups = collections.OrderedDict()
+        for i, (keys, ureport, timestamp, count,
+                report_hash) in enumerate(entries):
+            try:
+                if report_hash is None:
+                    report_hash = get_report_hash(ureport)
+
+                key = get_dedupe_key(ureport, timestamp, report_hash)
+            except FafError as ex:
+                self.log_warn("Unable to deduplicate uReport: {0}"
+                              .format(str(ex)))
+                key = i
+
+            group = groups.get(key)
+            if group is None:
+                groups[key] = [list(keys), ureport, timestamp, count,
+                               report_hash]
                 continue
 
-            self._move_report_to_saved(fname)
+            group[0].extend(keys)
+            group[2] = max(group[2], timestamp)
+            group[3] += count
+
+        self.log_info("Deduplicated {0} uReports to {1}"
+                      .format(len(entries), len(groups)))
+
+        return [tuple(group) for group in groups.values()]
+
+    def _log_cache_stats(self):
+        for problemplugin in problemtypes.values():
+            problemplugin.log_cache_stats()
 
-    def _save_reports_speedup(self, db):
+    def _save_shard(self, db, shard, entries, batch_size, results):
+        """
+        Worker process saving `entries` of one shard. Puts (shard, done)
+        to the `results` queue as soon as entries are committed or
+        rejected, done being a list of (index, failed) tuples, and
+        (shard, None) once the worker has finished. Entries never reported
+        were not committed.
+        """
+
+        # without autocommit nothing is committed before the end
+        committed = []
+
+        def progress(done):
+            if db.session.autocommit:
+                results.put((shard, done))
+            else:
+                committed.extend(done)
+
+        try:
+            self._save_entries(db, entries, batch_size=batch_size,
+                               progress=progress)
+
+            if not db.session.autocommit:
+                db.session.commit()
+                results.put((shard, committed))
+        except Exception as ex:
+            self.log_error("Worker #{0} failed: {1}".format(shard, str(ex)))
+
+            if not db.session.autocommit:
+                db.session.rollback()
+        finally:
+            db.dispose()
+
+        self._log_cache_stats()
+
+        results.put((shard, None))
+
+    def _save_entries_workers(self, db, entries, workers, batch_size=0):
+        """
+        Split `entries` into `workers` shards by report hash and save each
+        shard in a separate process. uReports of the same report always
+        land in the same shard so no two workers update the same report.
+        Files are moved to saved or deferred here once the workers are done,
+        files of uReports a failed worker did not get to stay in incoming.
+        """
+
+        shards = [[] for i in xrange(workers)]
+        for entry in entries:
+            report_hash = entry[4]
+            if report_hash is None:
+                report_hash = get_report_hash(entry[1])
+            shards[int(report_hash, 16) % workers].append(entry)
+
+        # make sure everything is written before the workers take over and
+        # that they don't inherit the connections of this process
+        if not db.session.autocommit:
+            db.session.commit()
+        db.dispose()
+
+        results = multiprocessing.Queue()
+        procs = []
+        for shard, shard_entries in enumerate(shards):
+            if not shard_entries:
+                continue
+
+            self.log_info("Spawning worker #{0} for {1} uReports"
+                          .format(shard, len(shard_entries)))
+            proc = multiprocessing.Process(target=self._save_shard,
+                                           args=(db, shard, shard_entries,
+                                                 batch_size, results))
+            proc.start()
+            procs.append(proc)
+
+        # shard -> {index: failed}
+        done = collections.defaultdict(dict)
+        finished = set()
+        while len(finished) < len(procs):
+            wait = any(proc.is_alive() for proc in procs)
+            try:
+                shard, shard_done = results.get(wait, 1)
+            except Queue.Empty:
+                if wait:
+                    continue
+
+                break
+
+            if shard_done is None:
+                finished.add(shard)
+            else:
+                done[shard].update(shard_done)
+
+        for proc in procs:
+            proc.join()
+
+        for shard, shard_entries in enumerate(shards):
+            if not shard_entries:
+                continue
+
+            indices = sorted(done[shard])
+            if len(indices) < len(shard_entries):
+                self.log_warn("Worker #{0} did not finish, leaving {1} "
+                              "uReports in incoming"
+                              .format(shard,
+                                      len(shard_entries) - len(indices)))
+
+            self._move_entries([shard_entries[i] for i in indices],
+                               set(j for j, i in enumerate(indices)
+                                   if done[shard][i]))
+
+    def _save_reports_batch(self, db, batch_size):
+        self.log_info("Saving reports (--batch {0})".format(batch_size))
+
+        report_filenames = sorted(fname for fname
+                                  in os.listdir(self.dir_report_incoming)
+                                  if not fname.startswith("."))
+
+        entries = []
+        i = 0
+        for fname in report_filenames:
+            i += 1
+
+            filename = os.path.join(self.dir_report_incoming, fname)
+            self.log_info("[{0} / {1}] Loading file '{2}'"
+                          .format(i, len(report_filenames), filename))
+
+            loaded = self._load_report(db, fname)
+            if loaded is None:
+                continue
+
+            ureport, timestamp, report_hash, count = loaded
+            entries.append(([fname], ureport, timestamp, count, report_hash))
+
+            if len(entries) >= batch_size:
+                self.log_info("Saving batch of {0} uReports"
+                              .format(len(entries)))
+                self._move_entries(entries, self._save_batch(db, entries))
+                entries = []
+
+        if entries:
+            self.log_info("Saving batch of {0} uReports".format(len(entries)))
+            self._move_entries(entries, self._save_batch(db, entries))
+
+    def _save_reports_workers(self, db, workers, batch_size=0):
+        self.log_info("Saving reports (--workers {0})".format(workers))
+
+        report_filenames = sorted(fname for fname
+                                  in os.listdir(self.dir_report_incoming)
+                                  if not fname.startswith("."))
+
+        entries = []
+        i = 0
+        for fname in report_filenames:
+            i += 1
+
+            filename = os.path.join(self.dir_report_incoming, fname)
+            self.log_info("[{0} / {1}] Loading file '{2}'"
+                          .format(i, len(report_filenames), filename))
+
+            loaded = self._load_report(db, fname)
+            if loaded is None:
+                continue
+
+            ureport, timestamp, report_hash, count = loaded
+            entries.append(([fname], ureport, timestamp, count, report_hash))
+
+        self._save_entries_workers(db, entries, workers,
+                                   batch_size=batch_size)
+
+    def _save_reports_segments(self, db, batch_size=0, workers=0,
+                               dedupe=False):
+        self.log_info("Saving reports from the segment spool")
+
+        if batch_size > 0 and workers < 1 and not dedupe:
+            limit = batch_size
+        else:
+            limit = 1000
+
+        self.segments.lock_reader()
+        try:
+            while True:
+                records = self.segments.pending(limit=limit)
+                if not records:
+                    break
+
+                self.log_info("Loaded {0} records".format(len(records)))
+                entries = self._load_records(db, records)
+                if dedupe:
+                    entries = self._dedupe_entries(entries)
+
+                if workers > 0:
+                    self._save_entries_workers(db, entries, workers,
+                                               batch_size=batch_size)
+                else:
+                    self._move_entries(entries,
+                                       self._save_entries(
+                                           db, entries,
+                                           batch_size=batch_size))
+
+            self._retire_segments()
+        finally:
+            self.segments.unlock_reader()
+
+    def _save_reports_speedup(self, db, batch_size=0, workers=0,
+                              dedupe=False):
         self.log_info("Saving reports (--speedup)")
 
         # This creates a lock file and only works on file modified between the
@@ -251,69 +821,255 @@ class SaveReports(Action):
                     stat = os.stat(filename)
                     contents = fil.read()
                     h = hashlib.sha1()
-                    h.update(contents)
+                    # records of the same uReport differ in the header
+                    h.update(record_body(contents))
                     h.update(datetime.date.fromtimestamp(stat.st_mtime)
                              .isoformat())
                     digest = h.digest()
+                    count = record_count(contents)
                     if digest in reports:
                         reports[digest]["filenames"].append(fname)
+                        reports[digest]["count"] += count
                         if reports[digest]["mtime"] < stat.st_mtime:
                             reports[digest]["mtime"] = stat.st_mtime
                         self.log_debug("Duplicate")
                     else:
                         reports[digest] = {
-                            "ureport": json.loads(contents),
+                            "contents": contents,
                             "filenames": [fname],
+                            "count": count,
                             "mtime": stat.st_mtime,
                         }
                         self.log_debug("Original")
 
-            except (OSError, ValueError) as ex:
+            except (IOError, OSError, ValueError) as ex:
                 self.log_warn("Failed to load uReport: {0}".format(str(ex)))
                 self._move_report_to_deferred(fname)
                 continue
 
+        entries = []
         i = 0
         for unique in reports.values():
             i += 1
             self.log_info("[{0} / {1}] Processing unique file '{2}'"
                           .format(i, len(reports), unique["filenames"][0]))
-            ureport = unique["ureport"]
-            try:
-                validate(ureport)
-            except FafError as ex:
-                self.log_warn("uReport is invalid: {0}".format(str(ex)))
-
-                if ("os" in ureport and
-                    "name" in ureport["os"] and
-                    ureport["os"]["name"] not in systems and
-                    ureport["os"]["name"].lower() not in systems):
-                    self._save_unknown_opsys(db, ureport["os"])
 
+            parsed = self._parse_report(db, unique["contents"])
+            if parsed is None:
                 self._move_reports_to_deferred(unique["filenames"])
                 continue
 
+            ureport, report_hash, received, count = parsed
+
             mtime = unique["mtime"]
             timestamp = datetime.datetime.fromtimestamp(mtime)
 
-            try:
-                save(db, ureport, create_component=self.create_components,
-                     timestamp=timestamp, count=len(unique["filenames"]))
-            except FafError as ex:
-                self.log_warn("Failed to save uReport: {0}".format(str(ex)))
-                self._move_reports_to_deferred(unique["filenames"])
-                continue
+            entries.append((unique["filenames"], ureport, timestamp,
+                            unique["count"], report_hash))
+
+        if dedupe:
+            entries = self._dedupe_entries(entries)
 
-            self._move_reports_to_saved(unique["filenames"])
+        if workers > 0:
+            self._save_entries_workers(db, entries, workers,
+                                       batch_size=batch_size)
+        else:
+            self._move_entries(entries,
+                               self._save_entries(db, entries,
+                                                  batch_size=batch_size))
 
         self.log_debug("Removing lock {0}".format(self.lock_filename))
         os.remove(self.lock_filename)
 
+    def _handle_stop_signals(self):
+        """
+        Make SIGTERM and Ctrl-C set self._stop instead of exiting.
+        """
+
+        self._stop = False
+
+        def handle_term(sig, frame):
+            self.log_info("Signal caught, exiting after the current batch")
+            self._stop = True
+        signal.signal(signal.SIGTERM, handle_term)
+        signal.signal(signal.SIGINT, handle_term)
+
+    def _add_pending(self, fname):
+        """
+        Queue `fname` in the incoming directory to be saved by the daemon.
+        """
+
+        if not fname.startswith(".") and fname not in self._queued:
+            self._queued.add(fname)
+            self._pending.append(fname)
+
+    def _handle_event(self, event):
+        self._add_pending(event.name)
+
+    def _watch_incoming(self):
+        """
+        Return a pyinotify Notifier of files written to or moved to the
+        incoming directory or None if pyinotify is not available.
+        """
+
+        if pyinotify is None:
+            return None
+
+        watches = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(watches, self._handle_event)
+        watches.add_watch(self.dir_report_incoming,
+                          pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO)
+
+        return notifier
+
+    def _daemon_step(self, db, batch_size, rescan_interval, notifier=None,
+                     attachments=True):
+        """
+        One iteration of the --daemon loop. Rescans the incoming directory
+        if it is due, then saves at most `batch_size` pending uReports or
+        waits for new ones for up to a second.
+        """
+
+        if time.time() - self._last_scan >= rescan_interval:
+            fnames = os.listdir(self.dir_report_incoming)
+            for fname in fnames:
+                self._add_pending(fname)
+            self._sync_depth(fnames)
+            self._last_scan = time.time()
+
+            self._save_coalesced(db, batch_size=batch_size)
+            if attachments:
+                self._save_attachments(db)
+
+        if not self._pending:
+            timeout = max(0, min(1, self._last_scan + rescan_interval -
+                                 time.time()))
+            if notifier is None:
+                time.sleep(timeout)
+            elif notifier.check_events(int(timeout * 1000)):
+                notifier.read_events()
+                notifier.process_events()
+
+            return
+
+        batch = [self._pending.popleft()
+                 for i in xrange(min(batch_size, len(self._pending)))]
+        self._queued.difference_update(batch)
+
+        entries = []
+        for fname in batch:
+            # saved meanwhile by another process
+            if not os.path.isfile(os.path.join(self.dir_report_incoming,
+                                               fname)):
+                continue
+
+            loaded = self._load_report(db, fname)
+            if loaded is None:
+                continue
+
+            ureport, timestamp, report_hash, count = loaded
+            entries.append(([fname], ureport, timestamp, count,
+                            report_hash))
+
+        if not entries:
+            return
+
+        self.log_info("Saving {0} uReports".format(len(entries)))
+        if len(entries) > 1:
+            failed = self._save_batch(db, entries)
+        else:
+            failed = self._save_entries(db, entries)
+
+        self._move_entries(entries, failed)
+
+    def _save_reports_daemon(self, db, batch_size, rescan_interval,
+                             attachments=True):
+        """
+        Keep saving uReports as they arrive until SIGTERM or Ctrl-C.
+        New files are picked up through inotify, the incoming directory
+        is rescanned every `rescan_interval` seconds in case an event was
+        missed. Pending files are saved in micro-batches of at most
+        `batch_size` uReports, so that latency stays low under load.
+        """
+
+        if self.segments is not None:
+            self._save_segments_daemon(db, batch_size, rescan_interval,
+                                       attachments=attachments)
+            return
+
+        self.log_info("Saving reports (--daemon)")
+
+        self._handle_stop_signals()
+
+        self._pending.clear()
+        self._queued.clear()
+        self._last_scan = 0
+
+        notifier = self._watch_incoming()
+        if notifier is None:
+            self.log_warn("pyinotify is not available, new uReports are "
+                          "picked up every {0} seconds"
+                          .format(rescan_interval))
+
+        try:
+            while not self._stop:
+                self._daemon_step(db, batch_size, rescan_interval,
+                                  notifier=notifier, attachments=attachments)
+        finally:
+            if notifier is not None:
+                notifier.stop()
+
+    def _save_segments_daemon(self, db, batch_size, rescan_interval,
+                              attachments=True):
+        """
+        The --daemon mode for the segment spool. The segments are polled
+        for new records, reading only the index entries appended since
+        the last poll.
+        """
+
+        self.log_info("Saving reports from the segment spool (--daemon)")
+
+        self._handle_stop_signals()
+
+        self.segments.lock_reader()
+        try:
+            last_scan = 0
+            while not self._stop:
+                if time.time() - last_scan >= rescan_interval:
+                    last_scan = time.time()
+                    self._retire_segments()
+                    self._sync_depth()
+
+                    self._save_coalesced(db, batch_size=batch_size)
+                    if attachments:
+                        self._save_attachments(db)
+
+                records = self.segments.pending(limit=batch_size)
+                if not records:
+                    time.sleep(0.2)
+                    continue
+
+                entries = self._load_records(db, records)
+                if not entries:
+                    continue
+
+                self.log_info("Saving {0} uReports".format(len(entries)))
+                if len(entries) > 1:
+                    failed = self._save_batch(db, entries)
+                else:
+                    failed = self._save_entries(db, entries)
+
+                self._move_entries(entries, failed)
+        finally:
+            self.segments.unlock_reader()
+
     def _save_attachments(self, db):
         self.log_info("Saving attachments")
 
         attachment_filenames = os.listdir(self.dir_attach_incoming)
 
+        fnames = []
+        attachments = []
         i = 0
         for fname in sorted(attachment_filenames):
             i += 1
@@ -337,28 +1093,82 @@ class SaveReports(Action):
                 self._move_attachment_to_deferred(fname)
                 continue
 
-            try:
-                save_attachment(db, attachment)
-            except FafError as ex:
-                self.log_warn("Failed to save attachment: {0}".format(str(ex)))
-                self._move_attachment_to_deferred(fname)
-                continue
+            fnames.append(fname)
+            attachments.append(attachment)
+
+        if not attachments:
+            return
 
-            self._move_attachment_to_saved(fname)
+        # bugs missing in the storage are downloaded concurrently
+        failed = dict(save_attachments(db, attachments,
+                                       self.bug_download_threads))
+
+        for i, fname in enumerate(fnames):
+            if i in failed:
+                self.log_warn("Failed to save attachment: {0}"
+                              .format(str(failed[i])))
+                self._move_attachment_to_deferred(fname)
+            else:
+                self._move_attachment_to_saved(fname)
 
     def run(self, cmdline, db):
+        if cmdline.daemon:
+            unsupported = [option for option, used
+                           in [("--no-reports", cmdline.no_reports),
+                               ("--speedup", cmdline.speedup),
+                               ("--dedupe", cmdline.dedupe),
+                               ("--workers", cmdline.workers > 0)]
+                           if used]
+            if unsupported:
+                self.log_error("{0} can't be used with --daemon"
+                               .format(", ".join(unsupported)))
+                return 1
+
+            batch_size = cmdline.batch
+            if batch_size < 1:
+                batch_size = 50
+
+            self._save_reports_daemon(db, batch_size,
+                                      cmdline.rescan_interval,
+                                      attachments=not cmdline.no_attachments)
+            self._log_cache_stats()
+            return
+
         if not cmdline.no_reports:
-            if cmdline.speedup:
+            self._sync_depth()
+
+            if self.segments is not None:
+                if cmdline.speedup:
+                    self.log_warn("--speedup is not supported by the segment "
+                                  "spool, ignoring")
+
+                self._save_reports_segments(db, batch_size=cmdline.batch,
+                                            workers=cmdline.workers,
+                                            dedupe=cmdline.dedupe)
+            elif cmdline.speedup or cmdline.dedupe:
                 try:
-                    self._save_reports_speedup(db)
+                    self._save_reports_speedup(db, batch_size=cmdline.batch,
+                                               workers=cmdline.workers,
+                                               dedupe=cmdline.dedupe)
                 except:
                     self.log_debug("Uncaught exception. Removing lock {0}"
                                    .format(self.lock_filename))
                     os.remove(self.lock_filename)
                     raise
+            elif cmdline.workers > 0:
+                self._save_reports_workers(db, cmdline.workers,
+                                           batch_size=cmdline.batch)
+            elif cmdline.batch > 0:
+                self._save_reports_batch(db, cmdline.batch)
             else:
                 self._save_reports(db)
 
+            self._save_coalesced(db, batch_size=cmdline.batch)
+
+            # the workers log their own
+            if cmdline.workers < 1:
+                self._log_cache_stats()
+
         if not cmdline.no_attachments:
             self._save_attachments(db)
 
@@ -370,3 +1180,23 @@ class SaveReports(Action):
         parser.add_argument("--speedup", action="store_true",
                             default=False, help="Speedup the processing. "
                             "May be less accurate.")
+        parser.add_argument("--dedupe", action="store_true", default=False,
+                            help="save uReports of the same report, "
+                            "operating system release, architecture and "
+                            "packages received on the same day as one. "
+                            "Implies --speedup.")
+        parser.add_argument("--batch", type=int, default=0, metavar="N",
+                            help="save N reports at a time in a single "
+                            "transaction")
+        parser.add_argument("--workers", type=int, default=0, metavar="N",
+                            help="save reports in N processes, sharded by "
+                            "report hash")
+        parser.add_argument("--daemon", action="store_true", default=False,
+                            help="keep running and save reports as they "
+                            "arrive, in batches of at most --batch (50 by "
+                            "default) reports; can't be combined with "
+                            "--workers, --speedup, --dedupe or --no-reports")
+        parser.add_argument("--rescan-interval", type=int, default=60,
+                            metavar="SECONDS",
+                            help="with --daemon, rescan the incoming "
+                            "directory every SECONDS seconds")
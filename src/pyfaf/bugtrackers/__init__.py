@@ -17,12 +17,13 @@
 # along with faf.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import threading
 from pyfaf.common import FafError, Plugin, import_dir, load_plugins, log
 from pyfaf.queries import get_bugtracker_by_name
 
 from pyfaf.storage.bugtracker import Bugtracker
 
-__all__ = ["BugTracker", "bugtrackers"]
+__all__ = ["BugTracker", "bugtrackers", "thread_local"]
 
 # Invalid name "bugtrackers" for type constant
 # pylint: disable-msg=C0103
@@ -30,6 +31,22 @@ bugtrackers = {}
 # pylint: enable-msg=C0103
 
 
+def thread_local(name, default=None):
+    """
+    Return a property of a BugTracker holding a separate value for every
+    thread. Used for connections to the bug tracker, as bugs may be
+    downloaded by several threads at once.
+    """
+
+    def fget(self):
+        return getattr(self._thread_local(), name, default)
+
+    def fset(self, value):
+        setattr(self._thread_local(), name, value)
+
+    return property(fget, fset)
+
+
 class BugTracker(Plugin):
     """
     A common superclass for bug tracker plugins.
@@ -76,6 +93,14 @@ class BugTracker(Plugin):
         raise NotImplementedError("list_bugs is not implemented for "
                                   "{0}".format(self.__class__.__name__))
 
+    def _thread_local(self):
+        # the constructor of the superclass is not always called
+        local = self.__dict__.get("_local")
+        if local is None:
+            local = self.__dict__.setdefault("_local", threading.local())
+
+        return local
+
     def download_bug_to_storage(self, db, bug_id):
         """
         Downloads the bug with given ID into storage or updates
@@ -85,6 +110,26 @@ class BugTracker(Plugin):
         raise NotImplementedError("download_bug_to_storage is not implemented "
                                   "for {0}".format(self.__class__.__name__))
 
+    def download_bug(self, bug_id):
+        """
+        Downloads the bug with given ID without touching the storage and
+        returns it in the form accepted by `save_bug`. May be called from
+        several threads at once.
+        """
+
+        raise NotImplementedError("download_bug is not implemented for "
+                                  "{0}".format(self.__class__.__name__))
+
+    def save_bug(self, db, bug):
+        """
+        Saves the bug returned by `download_bug` into storage or updates
+        it if it already exists in storage. Returns the storage object
+        of the bug or None if it can not be saved.
+        """
+
+        raise NotImplementedError("save_bug is not implemented for "
+                                  "{0}".format(self.__class__.__name__))
+
     def create_bug(self, contents):
         """
         Creates a new bug with given contents.
@@ -37,7 +37,7 @@ from pyfaf.storage.bugzilla import (BzBug,
                                     BzAttachment,
                                     BzBugHistory)
 
-from pyfaf.bugtrackers import BugTracker
+from pyfaf.bugtrackers import BugTracker, thread_local
 from xmlrpclib import Fault
 
 __all__ = ["Bugzilla"]
@@ -53,6 +53,10 @@ class Bugzilla(BugTracker):
 
     report_backref_name = "bz_bugs"
 
+    # every thread has its own connection
+    bz = thread_local("bz")
+    connected = thread_local("connected", False)
+
     def __init__(self):
         """
         Load required configuration based on instance name.
@@ -100,27 +104,38 @@ class Bugzilla(BugTracker):
 
         self.connected = True
 
-    def download_bug_to_storage_no_retry(self, db, bug_id):
-        """
-        Download and save single bug identified by `bug_id`.
-        """
-
+    def _download_bug(self, bug_id):
         self.log_debug(u"Downloading bug #{0}".format(bug_id))
         self._connect()
         try:
-            bug = self.bz.getbug(bug_id)
+            return self.bz.getbug(bug_id)
         except Fault as ex:
             if int(ex.faultCode) == 102:
                 # Access denied to a private bug
                 raise FafError(ex.faultString)
             else:
                 raise
-        return self._save_bug(db, bug)
+
+    def download_bug_to_storage_no_retry(self, db, bug_id):
+        """
+        Download and save single bug identified by `bug_id`.
+        """
+
+        return self._save_bug(db, self._download_bug(bug_id))
 
     @retry(3, delay=10, backoff=3, verbose=True)
     def download_bug_to_storage(self, db, bug_id):
         return self.download_bug_to_storage_no_retry(db, bug_id)
 
+    @retry(3, delay=10, backoff=3, verbose=True)
+    def download_bug(self, bug_id):
+        """
+        Download single bug identified by `bug_id` together with its
+        history. Return the dictionary accepted by `save_bug`.
+        """
+
+        return self._preprocess_bug(self._download_bug(bug_id))
+
     def list_bugs(self, from_date=datetime.date.today(),
                   to_date=datetime.date(2000, 1, 1),
                   step=7,
@@ -272,6 +287,13 @@ class Bugzilla(BugTracker):
         return bug_dict
 
     def _save_bug(self, db, bug):
+        """
+        Save python-bugzilla `bug` to the database.
+        """
+
+        return self.save_bug(db, self._preprocess_bug(bug))
+
+    def save_bug(self, db, bug_dict):
         """
         Save bug represented by `bug_dict` to the database.
 
@@ -279,7 +301,6 @@ class Bugzilla(BugTracker):
         as well.
         """
 
-        bug_dict = self._preprocess_bug(bug)
         if not bug_dict:
             self.log_error("Bug pre-processing failed")
             return
@@ -26,7 +26,7 @@ from pyfaf.utils.decorators import retry
 
 from pyfaf.storage.mantisbt import MantisBug
 
-from pyfaf.bugtrackers import BugTracker
+from pyfaf.bugtrackers import BugTracker, thread_local
 
 __all__ = ["Mantis"]
 
@@ -60,6 +60,11 @@ class Mantis(BugTracker):
 
     report_backref_name = "mantis_bugs"
 
+    # every thread has its own connection
+    mantis_client = thread_local("mantis_client")
+    mc = thread_local("mc")
+    connected = thread_local("connected", False)
+
     def __init__(self):
         """
         Load required configuration based on instance name.
@@ -98,16 +103,27 @@ class Mantis(BugTracker):
 
         self.connected = True
 
+    def _download_bug(self, bug_id):
+        self.log_debug(u"Downloading bug #{0}".format(bug_id))
+        self._connect()
+        return self.mc.mc_issue_get(self.user, self.password, bug_id)
+
     @retry(3, delay=10, backoff=3, verbose=True)
     def download_bug_to_storage(self, db, bug_id):
         """
         Download and save single bug identified by `bug_id`.
         """
 
-        self.log_debug(u"Downloading bug #{0}".format(bug_id))
-        self._connect()
-        bug = self.mc.mc_issue_get(self.user, self.password, bug_id)
-        return self._save_bug(db, bug)
+        return self._save_bug(db, self._download_bug(bug_id))
+
+    @retry(3, delay=10, backoff=3, verbose=True)
+    def download_bug(self, bug_id):
+        """
+        Download single bug identified by `bug_id`. Return the dictionary
+        accepted by `save_bug`.
+        """
+
+        return self._preprocess_bug(self._download_bug(bug_id))
 
     def _preprocess_bug(self, bug):
         """
@@ -144,6 +160,13 @@ class Mantis(BugTracker):
         return bug_dict
 
     def _save_bug(self, db, bug):
+        """
+        Save suds `bug` to the database.
+        """
+
+        return self.save_bug(db, self._preprocess_bug(bug))
+
+    def save_bug(self, db, bug_dict):
         """
         Save bug represented by `bug_dict` to the database.
 
@@ -151,7 +174,6 @@ class Mantis(BugTracker):
         as well.
         """
 
-        bug_dict = self._preprocess_bug(bug)
         if not bug_dict:
             self.log_error("Bug pre-processing failed")
             return
@@ -40,10 +40,53 @@ class CheckError(FafError):
     pass
 
 
+class _Generator(object):
+    """
+    Source code of a compiled checker. Checkers nested in dictionaries and
+    lists are inlined, the prefixes of nested error messages are computed
+    once at compile time.
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.namespace = {"CheckError": CheckError, "Integral": Integral}
+        self._nvars = 0
+
+    def const(self, value):
+        """
+        Bind `value` to a new name in the namespace of the compiled code.
+        """
+
+        name = "c{0}".format(len(self.namespace))
+        self.namespace[name] = value
+        return name
+
+    def var(self):
+        self._nvars += 1
+        return "v{0}".format(self._nvars)
+
+    def emit(self, indent, line):
+        self.lines.append("    " * indent + line)
+
+    def fail(self, indent, prefix, message):
+        """
+        Raise CheckError with the message built by the `message` expression
+        prepended with the constant `prefix`.
+        """
+
+        if prefix:
+            message = "{0} + {1}".format(self.const(prefix), message)
+
+        self.emit(indent, "raise CheckError({0})".format(message))
+
+
 class Checker(object):
     """
     Generic checker. Checks that the object is of the required type
     and gives the possibility to specify allowed values whitelist.
+
+    The checker is compiled into a single function the first time `check`
+    is called, so it must not be modified afterwards.
     """
 
     def __init__(self, checktype, allowed=None, mandatory=True):
@@ -63,16 +106,81 @@ class Checker(object):
         self.checktype = checktype
         self.allowed = allowed
         self.mandatory = mandatory
+        self._compiled = None
+
+    def compile(self):
+        """
+        Return a function raising CheckError for objects that do not pass
+        the check. The function is built only once.
+        """
+
+        if self._compiled is None:
+            gen = _Generator()
+            gen.emit(0, "def check(v0):")
+            self._generate(gen, "v0", "", 1)
+            gen.emit(1, "return None")
+
+            code = compile("\n".join(gen.lines) + "\n",
+                           "<{0}>".format(self.__class__.__name__), "exec")
+            # Use of the exec statement
+            # pylint: disable-msg=W0122
+            exec(code, gen.namespace)
+            # pylint: enable-msg=W0122
+            self._compiled = gen.namespace["check"]
+
+        return self._compiled
 
     def check(self, obj):
-        if not isinstance(obj, self.checktype):
-            raise CheckError("Expected '{0}', got '{1}'"
-                             .format(self.checktype.__name__,
-                                     type(obj).__name__))
-
-        if len(self.allowed) > 0 and obj not in self.allowed:
-            raise CheckError("Only the following values are allowed: {0}"
-                             .format(", ".join(self.allowed)))
+        self.compile()(obj)
+
+    def _generate_nested(self, gen, var, prefix, indent):
+        """
+        Generate the check of a nested checker. Checkers of other classes
+        overriding `check` are called as they are.
+        """
+
+        # unbound methods are created on each attribute access on Python 2,
+        # compare the underlying functions
+        check = type(self).check
+        if getattr(check, "__func__", check) is _CHECK_FUNC:
+            self._generate(gen, var, prefix, indent)
+            return
+
+        if not prefix:
+            gen.emit(indent, "{0}({1})".format(gen.const(self.check), var))
+            return
+
+        gen.emit(indent, "try:")
+        gen.emit(indent + 1, "{0}({1})".format(gen.const(self.check), var))
+        gen.emit(indent, "except CheckError as ex:")
+        gen.fail(indent + 1, prefix, "str(ex)")
+
+    def _generate(self, gen, var, prefix, indent):
+        if self.checktype is not object:
+            if self.checktype is Integral:
+                # isinstance() of an abstract base class is slow
+                cond = ("type({0}) is not int and not isinstance({0}, "
+                        "Integral)".format(var))
+            else:
+                cond = "not isinstance({0}, {1})".format(
+                    var, gen.const(self.checktype))
+
+            gen.emit(indent, "if {0}:".format(cond))
+            gen.fail(indent + 1, prefix,
+                     "{0}.format({1}, type({2}).__name__)".format(
+                         gen.const("Expected '{0}', got '{1}'"),
+                         gen.const(self.checktype.__name__), var))
+
+        if len(self.allowed) > 0:
+            allowed = gen.const(self.allowed)
+            gen.emit(indent, "if {0} not in {1}:".format(var, allowed))
+            gen.fail(indent + 1, prefix, "{0}.format(\", \".join({1}))".format(
+                gen.const("Only the following values are allowed: {0}"),
+                allowed))
+
+
+# the function generated inline for nested checkers
+_CHECK_FUNC = getattr(Checker.check, "__func__", Checker.check)
 
 
 class IntChecker(Checker):
@@ -88,16 +196,22 @@ class IntChecker(Checker):
         self.minval = minval
         self.maxval = maxval
 
-    def check(self, obj):
-        super(IntChecker, self).check(obj)
+    def _generate(self, gen, var, prefix, indent):
+        super(IntChecker, self)._generate(gen, var, prefix, indent)
 
-        if self.minval is not None and obj < self.minval:
-            raise CheckError("Expected number greater or equal to {0}, "
-                             "got {1}".format(self.minval, obj))
+        if self.minval is not None:
+            gen.emit(indent, "if {0} < {1}:".format(var,
+                                                     gen.const(self.minval)))
+            gen.fail(indent + 1, prefix, "{0}.format({1}, {2})".format(
+                gen.const("Expected number greater or equal to {0}, "
+                          "got {1}"), gen.const(self.minval), var))
 
-        if self.maxval is not None and obj > self.maxval:
-            raise CheckError("Expected number lesser or equal to {0}, "
-                             "got {1}".format(self.maxval, obj))
+        if self.maxval is not None:
+            gen.emit(indent, "if {0} > {1}:".format(var,
+                                                     gen.const(self.maxval)))
+            gen.fail(indent + 1, prefix, "{0}.format({1}, {2})".format(
+                gen.const("Expected number lesser or equal to {0}, "
+                          "got {1}"), gen.const(self.maxval), var))
 
 
 class StringChecker(Checker):
@@ -116,19 +230,22 @@ class StringChecker(Checker):
 
         self.maxlen = maxlen
 
-    def check(self, obj):
-        super(StringChecker, self).check(obj)
+    def _generate(self, gen, var, prefix, indent):
+        super(StringChecker, self)._generate(gen, var, prefix, indent)
 
-        if self.maxlen > 0 and len(obj) > self.maxlen:
-            raise CheckError("String '{0}' is too long, the limit is {1} "
-                             "characters".format(obj.encode("utf-8"),
-                                                 self.maxlen))
+        if self.maxlen > 0:
+            gen.emit(indent, "if len({0}) > {1}:".format(var, self.maxlen))
+            gen.fail(indent + 1, prefix,
+                     "{0}.format({1}.encode(\"utf-8\"), {2})".format(
+                         gen.const("String '{0}' is too long, the limit is "
+                                   "{1} characters"), var, self.maxlen))
 
         if self.re is not None:
-            match = self.re.match(obj)
-            if not match:
-                raise CheckError("String '{0}' does not match the pattern "
-                                 " '{1}'".format(obj, self.re.pattern))
+            gen.emit(indent, "if not {0}({1}):".format(
+                gen.const(self.re.match), var))
+            gen.fail(indent + 1, prefix, "{0}.format({1}, {2})".format(
+                gen.const("String '{0}' does not match the pattern  '{1}'"),
+                var, gen.const(self.re.pattern)))
 
 
 class ListChecker(Checker):
@@ -147,23 +264,30 @@ class ListChecker(Checker):
         self.minlen = minlen
         self.maxlen = maxlen
 
-    def check(self, obj):
-        super(ListChecker, self).check(obj)
+    def _generate(self, gen, var, prefix, indent):
+        super(ListChecker, self)._generate(gen, var, prefix, indent)
 
-        if self.minlen > 0 and len(obj) < self.minlen:
-            raise CheckError("The list must contain at least {0} elements"
-                             .format(self.minlen))
+        if self.minlen > 0:
+            gen.emit(indent, "if len({0}) < {1}:".format(var, self.minlen))
+            gen.fail(indent + 1, prefix, gen.const(
+                "The list must contain at least {0} elements"
+                .format(self.minlen)))
 
-        if self.maxlen > 0 and len(obj) > self.maxlen:
-            raise CheckError("The list must contain at most {0} elements"
-                             .format(self.maxlen))
+        if self.maxlen > 0:
+            gen.emit(indent, "if len({0}) > {1}:".format(var, self.maxlen))
+            gen.fail(indent + 1, prefix, gen.const(
+                "The list must contain at most {0} elements"
+                .format(self.maxlen)))
 
-        for elem in obj:
-            try:
-                self.elemchecker.check(elem)
-            except CheckError as ex:
-                raise CheckError("List element is invalid: {0}"
-                                 .format(str(ex)))
+        elem = gen.var()
+        loop = len(gen.lines)
+        gen.emit(indent, "for {0} in {1}:".format(elem, var))
+        self.elemchecker._generate_nested(
+            gen, elem, prefix + "List element is invalid: ", indent + 1)
+
+        # nothing to check in the elements
+        if len(gen.lines) == loop + 1:
+            gen.lines.pop()
 
 
 class DictChecker(Checker):
@@ -181,16 +305,19 @@ class DictChecker(Checker):
 
         self.elements = elements
 
-    def check(self, obj):
-        super(DictChecker, self).check(obj)
+    def _generate(self, gen, var, prefix, indent):
+        super(DictChecker, self)._generate(gen, var, prefix, indent)
 
         for name, checker in self.elements.items():
-            if name in obj:
-                try:
-                    checker.check(obj[name])
-                except CheckError as ex:
-                    raise CheckError("Element '{0}' is invalid: {1}"
-                                     .format(name, str(ex)))
-
-            elif checker.mandatory:
-                raise CheckError("Element '{0}' is missing".format(name))
+            key = gen.const(name)
+            elem = gen.var()
+            gen.emit(indent, "if {0} in {1}:".format(key, var))
+            gen.emit(indent + 1, "{0} = {1}[{2}]".format(elem, var, key))
+            checker._generate_nested(
+                gen, elem, prefix + "Element '{0}' is invalid: ".format(name),
+                indent + 1)
+
+            if checker.mandatory:
+                gen.emit(indent, "else:")
+                gen.fail(indent + 1, prefix, gen.const(
+                    "Element '{0}' is missing".format(name)))
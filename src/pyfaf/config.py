@@ -112,6 +112,9 @@ def load_paths(config):
         "reports_deferred": os.path.join(spool_dir, "reports", "deferred"),
         "reports_incoming": os.path.join(spool_dir, "reports", "incoming"),
         "reports_saved": os.path.join(spool_dir, "reports", "saved"),
+        "reports_segments": os.path.join(spool_dir, "reports", "segments"),
+        "reports_coalesced": os.path.join(spool_dir, "reports", "coalesced"),
+        "reports_depth": os.path.join(spool_dir, "reports", "depth"),
         "attachments": os.path.join(spool_dir, "attachments"),
         "attachments_deferred": os.path.join(spool_dir, "attachments",
                                              "deferred"),
@@ -119,6 +122,8 @@ def load_paths(config):
                                              "incoming"),
         "attachments_saved": os.path.join(spool_dir, "attachments", "saved"),
         "dumpdir": dump_dir,
+        "refcache_stamp": os.path.join(spool_dir, "refcache.stamp"),
+        "reportindex_log": os.path.join(spool_dir, "reportindex.log"),
     }
 
 # read config on import
@@ -74,6 +74,76 @@ class System(Plugin):
         raise NotImplementedError("save_ureport is not implemented for {0}"
                                   .format(self.__class__.__name__))
 
+    def _save_packages(self, db, db_report, packages, count=1):
+        """
+        Add `count` to the package rows of `db_report` for the `packages`
+        of a valid uReport. All packages are resolved by NEVRA with a single
+        query, packages not found in storage are saved as unknown.
+        """
+
+        # pyfaf.queries imports this module
+        from pyfaf.queries import (get_packages_by_nevras,
+                                   upsert_report_packages,
+                                   upsert_report_unknown_packages)
+        from pyfaf.refcache import refcache
+
+        nevras = []
+        for package in packages:
+            role = "RELATED"
+            if "package_role" in package:
+                if package["package_role"] == "affected":
+                    role = "CRASHED"
+                elif package["package_role"] == "selinux_policy":
+                    role = "SELINUX_POLICY"
+
+            nevras.append((role, (package["name"], package["epoch"],
+                                  package["version"], package["release"],
+                                  package["architecture"])))
+
+        db_packages = get_packages_by_nevras(db, set(n for r, n in nevras))
+
+        reportpackages = {}
+        unknown_packages = {}
+        for role, nevra in nevras:
+            db_package = db_packages.get(nevra)
+            if db_package is None:
+                self.log_warn("Package {0}-{1}:{2}-{3}.{4} not found in "
+                              "storage".format(*nevra))
+
+                db_arch = refcache.get_arch(db, nevra[4])
+                if db_arch is None:
+                    continue
+
+                key = (role,) + nevra[:4] + (db_arch.id,)
+                unknown_packages[key] = unknown_packages.get(key, 0) + count
+                continue
+
+            if db_package.id in reportpackages:
+                reportpackages[db_package.id][1] += count
+            else:
+                reportpackages[db_package.id] = [role, count]
+
+        if not reportpackages and not unknown_packages:
+            return
+
+        if db_report.id is None:
+            db.session.flush()
+
+        upsert_report_packages(db, db_report.id,
+                               [(package_id, role, pkg_count)
+                                for package_id, (role, pkg_count)
+                                in reportpackages.items()])
+        upsert_report_unknown_packages(db, db_report.id,
+                                       [key + (pkg_count,) for key, pkg_count
+                                        in unknown_packages.items()])
+
+        # the upserts bypass the session, reload the rows when accessed
+        for key in ["packages", "unknown_packages"]:
+            for db_reportpackage in db_report.__dict__.get(key, []):
+                db.session.expire(db_reportpackage)
+
+        db.session.expire(db_report, ["packages", "unknown_packages"])
+
     def get_releases(self):
         """
         Get a list of releases of the operating system. Return a dictionary
@@ -23,20 +23,14 @@ from datetime import datetime
 from pyfaf.opsys import System
 from pyfaf.checker import DictChecker, IntChecker, ListChecker, StringChecker
 from pyfaf.common import FafError, log
-from pyfaf.queries import (get_arch_by_name,
-                           get_opsys_by_name,
-                           get_osrelease,
-                           get_package_by_nevra,
-                           get_reportpackage,
-                           get_report_release_desktop,
-                           get_unknown_package)
+from pyfaf.queries import (get_opsys_by_name,
+                           get_report_release_desktop)
+from pyfaf.refcache import refcache
 from pyfaf.storage import (Arch,
                            Build,
                            OpSys,
                            Package,
                            ReportReleaseDesktop,
-                           ReportPackage,
-                           ReportUnknownPackage,
                            column_len)
 from pyfaf.utils.parse import str2bool
 
@@ -109,67 +103,6 @@ class Fedora(System):
         self.load_config_to_self("koji_url",
                                  ["fedora.koji-url"], None)
 
-    def _save_packages(self, db, db_report, packages, count=1):
-        for package in packages:
-            role = "RELATED"
-            if "package_role" in package:
-                if package["package_role"] == "affected":
-                    role = "CRASHED"
-                elif package["package_role"] == "selinux_policy":
-                    role = "SELINUX_POLICY"
-
-            db_package = get_package_by_nevra(db,
-                                              name=package["name"],
-                                              epoch=package["epoch"],
-                                              version=package["version"],
-                                              release=package["release"],
-                                              arch=package["architecture"])
-            if db_package is None:
-                self.log_warn("Package {0}-{1}:{2}-{3}.{4} not found in "
-                              "storage".format(package["name"],
-                                               package["epoch"],
-                                               package["version"],
-                                               package["release"],
-                                               package["architecture"]))
-
-                db_unknown_pkg = get_unknown_package(db,
-                                                     db_report,
-                                                     role,
-                                                     package["name"],
-                                                     package["epoch"],
-                                                     package["version"],
-                                                     package["release"],
-                                                     package["architecture"])
-                if db_unknown_pkg is None:
-                    db_arch = get_arch_by_name(db, package["architecture"])
-                    if db_arch is None:
-                        continue
-
-                    db_unknown_pkg = ReportUnknownPackage()
-                    db_unknown_pkg.report = db_report
-                    db_unknown_pkg.name = package["name"]
-                    db_unknown_pkg.epoch = package["epoch"]
-                    db_unknown_pkg.version = package["version"]
-                    db_unknown_pkg.release = package["release"]
-                    db_unknown_pkg.arch = db_arch
-                    db_unknown_pkg.type = role
-                    db_unknown_pkg.count = 0
-                    db.session.add(db_unknown_pkg)
-
-                db_unknown_pkg.count += count
-                continue
-
-            db_reportpackage = get_reportpackage(db, db_report, db_package)
-            if db_reportpackage is None:
-                db_reportpackage = ReportPackage()
-                db_reportpackage.report = db_report
-                db_reportpackage.installed_package = db_package
-                db_reportpackage.count = 0
-                db_reportpackage.type = role
-                db.session.add(db_reportpackage)
-
-            db_reportpackage.count += count
-
     def validate_ureport(self, ureport):
         Fedora.ureport_checker.check(ureport)
         return True
@@ -186,7 +119,8 @@ class Fedora(System):
 
     def save_ureport(self, db, db_report, ureport, packages, flush=False, count=1):
         if "desktop" in ureport:
-            db_release = get_osrelease(db, Fedora.nice_name, ureport["version"])
+            db_release = refcache.get_osrelease(db, Fedora.nice_name,
+                                                ureport["version"])
             if db_release is None:
                 self.log_warn("Release '{0} {1}' not found"
                               .format(Fedora.nice_name, ureport["version"]))
@@ -197,7 +131,7 @@ class Fedora(System):
                 if db_reldesktop is None:
                     db_reldesktop = ReportReleaseDesktop()
                     db_reldesktop.report = db_report
-                    db_reldesktop.release = db_release
+                    db_reldesktop.release_id = db_release.id
                     db_reldesktop.desktop = ureport["desktop"]
                     db_reldesktop.count = 0
                     db.session.add(db_reldesktop)
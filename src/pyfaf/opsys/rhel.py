@@ -21,18 +21,12 @@ import re
 from pyfaf.opsys import System
 from pyfaf.checker import DictChecker, IntChecker, ListChecker, StringChecker
 from pyfaf.common import FafError, log
-from pyfaf.queries import (get_arch_by_name,
-                           get_opsys_by_name,
-                           get_package_by_nevra,
-                           get_reportpackage,
-                           get_unknown_package)
+from pyfaf.queries import get_opsys_by_name
 from pyfaf.storage import (Arch,
                            Build,
                            OpSys,
                            OpSysReleaseStatus,
                            Package,
-                           ReportPackage,
-                           ReportUnknownPackage,
                            column_len)
 
 __all__ = ["RHEL"]
@@ -85,67 +79,6 @@ class RHEL(System):
     def __init__(self):
         super(RHEL, self).__init__()
 
-    def _save_packages(self, db, db_report, packages, count=1):
-        for package in packages:
-            role = "RELATED"
-            if "package_role" in package:
-                if package["package_role"] == "affected":
-                    role = "CRASHED"
-                elif package["package_role"] == "selinux_policy":
-                    role = "SELINUX_POLICY"
-
-            db_package = get_package_by_nevra(db,
-                                              name=package["name"],
-                                              epoch=package["epoch"],
-                                              version=package["version"],
-                                              release=package["release"],
-                                              arch=package["architecture"])
-            if db_package is None:
-                self.log_warn("Package {0}-{1}:{2}-{3}.{4} not found in "
-                              "storage".format(package["name"],
-                                               package["epoch"],
-                                               package["version"],
-                                               package["release"],
-                                               package["architecture"]))
-
-                db_unknown_pkg = get_unknown_package(db,
-                                                     db_report,
-                                                     role,
-                                                     package["name"],
-                                                     package["epoch"],
-                                                     package["version"],
-                                                     package["release"],
-                                                     package["architecture"])
-                if db_unknown_pkg is None:
-                    db_arch = get_arch_by_name(db, package["architecture"])
-                    if db_arch is None:
-                        continue
-
-                    db_unknown_pkg = ReportUnknownPackage()
-                    db_unknown_pkg.report = db_report
-                    db_unknown_pkg.name = package["name"]
-                    db_unknown_pkg.epoch = package["epoch"]
-                    db_unknown_pkg.version = package["version"]
-                    db_unknown_pkg.release = package["release"]
-                    db_unknown_pkg.arch = db_arch
-                    db_unknown_pkg.type = role
-                    db_unknown_pkg.count = 0
-                    db.session.add(db_unknown_pkg)
-
-                db_unknown_pkg.count += count
-                continue
-
-            db_reportpackage = get_reportpackage(db, db_report, db_package)
-            if db_reportpackage is None:
-                db_reportpackage = ReportPackage()
-                db_reportpackage.report = db_report
-                db_reportpackage.installed_package = db_package
-                db_reportpackage.count = 0
-                db_reportpackage.type = role
-                db.session.add(db_reportpackage)
-
-            db_reportpackage.count += count
-
     def validate_ureport(self, ureport):
         RHEL.ureport_checker.check(ureport)
         return True
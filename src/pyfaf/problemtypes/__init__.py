@@ -18,6 +18,10 @@
 
 import os
 from pyfaf.common import FafError, Plugin, import_dir, load_plugins
+from pyfaf.queries import (get_crash_threads_by_report_ids,
+                           get_report_crashthreads,
+                           lock_reports,
+                           upsert_report_crashthreads)
 from pyfaf.storage import SymbolSource, YieldQueryAdaptor
 
 __all__ = ["ProblemType", "problemtypes"]
@@ -87,6 +91,13 @@ class ProblemType(Plugin):
         raise NotImplementedError("save_ureport_post_flush is not implemented "
                                   "for {0}".format(self.__class__.__name__))
 
+    def log_cache_stats(self):
+        """
+        Log the statistics of caches kept across uReports, if any.
+        """
+
+        pass
+
     def get_component_name(self, ureport):
         """
         Get the component name against which the report should be filed.
@@ -150,6 +161,102 @@ class ProblemType(Plugin):
         raise NotImplementedError("compare is not implemented for {0}"
                                   .format(self.__class__.__name__))
 
+    def _db_report_to_crashthread(self, db_report):
+        """
+        Load the crash thread of a pyfaf.storage.Report object into
+        a JSON serializable object. Return None if the report has no usable
+        crash thread.
+        """
+
+        raise NotImplementedError("_db_report_to_crashthread is not "
+                                  "implemented for {0}"
+                                  .format(self.__class__.__name__))
+
+    def _thread_to_crashthread(self, db_report, db_thread):
+        """
+        Load the crash thread `db_thread` of `db_report` into a JSON
+        serializable object. `db_thread` is either
+        a pyfaf.storage.ReportBtThread or a pyfaf.storage.LoadedBtThread
+        object. Return None if the thread is not usable.
+        """
+
+        raise NotImplementedError("_thread_to_crashthread is not "
+                                  "implemented for {0}"
+                                  .format(self.__class__.__name__))
+
+    def _crashthread_to_satyr(self, crashthread):
+        """
+        Create a satyr object from a crash thread loaded by
+        _db_report_to_crashthread.
+        """
+
+        raise NotImplementedError("_crashthread_to_satyr is not implemented "
+                                  "for {0}".format(self.__class__.__name__))
+
+    def _db_report_to_satyr(self, db_report):
+        crashthread = self._db_report_to_crashthread(db_report)
+        if crashthread is None:
+            return None
+
+        return self._crashthread_to_satyr(crashthread)
+
+    def db_reports_to_satyr(self, db, db_reports):
+        """
+        Return a list of satyr objects of `db_reports` in the same order,
+        None for reports with no usable crash thread. Crash threads are
+        taken from the cache in pyfaf.storage.ReportCrashThread, the missing
+        ones are loaded by pyfaf.queries.get_crash_threads_by_report_ids
+        and cached.
+        """
+
+        crashthreads = get_report_crashthreads(db, [db_report.id
+                                                    for db_report
+                                                    in db_reports])
+        self.log_debug("{0} of {1} crash threads cached"
+                       .format(len(crashthreads), len(db_reports)))
+
+        missing = [db_report for db_report in db_reports
+                   if db_report.id not in crashthreads]
+        if missing:
+            db.session.begin(subtransactions=True)
+            try:
+                # Loading and caching the crash threads in one transaction
+                # with the reports locked keeps concurrent invalidation from
+                # being overwritten with crash threads of the old frames
+                lock_reports(db, [db_report.id for db_report in missing])
+                threads = get_crash_threads_by_report_ids(
+                    db, [db_report.id for db_report in missing])
+
+                for db_report in missing:
+                    if db_report.id in threads:
+                        crashthreads[db_report.id] = \
+                            self._thread_to_crashthread(
+                                db_report, threads[db_report.id][0])
+                    else:
+                        self.log_warn("Report #{0} has no crash thread"
+                                      .format(db_report.id))
+                        crashthreads[db_report.id] = None
+
+                self.log_debug("Caching {0} crash threads"
+                               .format(len(missing)))
+                upsert_report_crashthreads(
+                    db, [(db_report.id, crashthreads[db_report.id])
+                         for db_report in missing])
+                db.session.commit()
+            except:
+                db.session.rollback()
+                raise
+
+        result = []
+        for db_report in db_reports:
+            crashthread = crashthreads[db_report.id]
+            if crashthread is None:
+                result.append(None)
+            else:
+                result.append(self._crashthread_to_satyr(crashthread))
+
+        return result
+
     def compare_many(self, db_reports):
         """
         Some libraries (btparser, satyr) provide a way to compare
@@ -176,5 +283,15 @@ class ProblemType(Plugin):
         raise NotImplementedError("find_crash_function is not implemented for "
                                   "{0}".format(self.__class__.__name__))
 
+    def find_thread_crash_function(self, db_thread):
+        """
+        Find the crash function of a crash thread, either
+        a pyfaf.storage.ReportBtThread or a pyfaf.storage.LoadedBtThread.
+        """
+
+        raise NotImplementedError("find_thread_crash_function is not "
+                                  "implemented for {0}"
+                                  .format(self.__class__.__name__))
+
 import_dir(__name__, os.path.dirname(__file__))
 load_plugins(ProblemType, problemtypes)
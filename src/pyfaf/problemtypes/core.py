@@ -21,6 +21,9 @@ from __future__ import unicode_literals
 import os
 import satyr
 import shutil
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.util import identity_key
 from pyfaf.problemtypes import ProblemType
 from pyfaf.checker import (Checker,
                            DictChecker,
@@ -29,12 +32,16 @@ from pyfaf.checker import (Checker,
                            StringChecker)
 from pyfaf.common import FafError, get_libname
 from pyfaf.queries import (get_backtrace_by_hash,
+                           get_frame_symbolsources,
                            get_package_by_file,
                            get_package_by_file_build_arch,
+                           get_packed_threads_by_symbolsource,
                            get_reportexe,
                            get_src_package_by_build,
                            get_ssource_by_bpo,
-                           get_symbol_by_name_path)
+                           get_ssources_by_bpos,
+                           get_symbol_by_name_path,
+                           get_symbols_by_names_paths)
 from pyfaf.retrace import (addr2line,
                            demangle,
                            get_base_address,
@@ -49,7 +56,9 @@ from pyfaf.storage import (OpSysComponent,
                            ReportExecutable,
                            Symbol,
                            SymbolSource,
-                           column_len)
+                           column_len,
+                           getDatabase)
+from pyfaf.utils.lru import LRUCache
 from pyfaf.utils.parse import str2bool
 from pyfaf.utils.hash import hash_list
 
@@ -113,6 +122,20 @@ class CoredumpProblem(ProblemType):
         skipkeys = ["retrace.coreskipsource", "retrace.skipsource"]
         self.load_config_to_self("skipsrc", skipkeys, True, callback=str2bool)
 
+        cachekeys = ["processing.coresymbolcachesize",
+                     "processing.symbolcachesize"]
+        self.load_config_to_self("symbolcachesize", cachekeys, 100000,
+                                 callback=int)
+
+        # Ids of symbols and symbol sources seen by previous uReports.
+        # The ids of rows created by a transaction that is rolled back
+        # become invalid, so the caches are dropped on every rollback.
+        self._symbol_ids = LRUCache(self.symbolcachesize)
+        self._ssource_ids = LRUCache(self.symbolcachesize)
+        self._symbols_db = None
+        self._new_symbols = []
+        event.listen(Session, "after_soft_rollback", self._drop_symbol_cache)
+
     def _get_crash_thread(self, stacktrace):
         """
         Searches for a single crash thread and return it. Raises FafError if
@@ -164,27 +187,46 @@ class CoredumpProblem(ProblemType):
 
         return result
 
-    def _db_thread_to_satyr(self, db_thread):
-        thread = satyr.GdbThread()
-        thread.number = db_thread.number
-
-        for db_frame in db_thread.frames:
-            frame = satyr.GdbFrame()
-            frame.address = db_frame.symbolsource.offset
-            frame.library_name = \
-                db_frame.symbolsource.path.encode("ascii", "ignore")
-            frame.number = db_frame.order
+    def _db_thread_to_crashthread(self, db_thread):
+        frames = []
+        for db_frame in db_thread.get_frames():
+            frame = {
+                "address": db_frame.symbolsource.offset,
+                "library_name":
+                    db_frame.symbolsource.path.encode("ascii", "ignore"),
+                "number": db_frame.order,
+                "function_name": "??",
+            }
             if db_frame.symbolsource.symbol is not None:
-                frame.function_name = db_frame.symbolsource.symbol.name
-            else:
-                frame.function_name = "??"
+                frame["function_name"] = db_frame.symbolsource.symbol.name
 
             if db_frame.symbolsource.source_path is not None:
-                frame.source_file = \
+                frame["source_file"] = \
                     db_frame.symbolsource.source_path.encode("ascii", "ignore")
 
             if db_frame.symbolsource.line_number is not None:
-                frame.source_line = db_frame.symbolsource.line_number
+                frame["source_line"] = db_frame.symbolsource.line_number
+
+            frames.append(frame)
+
+        return {"number": db_thread.number, "frames": frames}
+
+    def _crashthread_to_satyr(self, crashthread):
+        thread = satyr.GdbThread()
+        thread.number = crashthread["number"]
+
+        for values in crashthread["frames"]:
+            frame = satyr.GdbFrame()
+            frame.address = values["address"]
+            frame.library_name = values["library_name"]
+            frame.number = values["number"]
+            frame.function_name = values["function_name"]
+
+            if "source_file" in values:
+                frame.source_file = values["source_file"]
+
+            if "source_line" in values:
+                frame.source_line = values["source_line"]
 
             thread.frames.append(frame)
 
@@ -195,9 +237,13 @@ class CoredumpProblem(ProblemType):
 
         return thread
 
+    def _db_thread_to_satyr(self, db_thread):
+        return self._crashthread_to_satyr(
+            self._db_thread_to_crashthread(db_thread))
+
     def _db_thread_validate(self, db_thread):
-        if len(db_thread.frames) == 1:
-            db_frame = db_thread.frames[0]
+        if len(db_thread.get_frames()) == 1:
+            db_frame = db_thread.get_frames()[0]
             if (db_frame.symbolsource.symbol is not None and
                     db_frame.symbolsource.symbol.name ==
                     "anonymous function" and
@@ -207,7 +253,15 @@ class CoredumpProblem(ProblemType):
                 return False
         return True
 
-    def _db_report_to_satyr(self, db_report):
+    def _thread_to_crashthread(self, db_report, db_thread):
+        if not self._db_thread_validate(db_thread):
+            self.log_warn("Report #{0} has only one bad frame"
+                          .format(db_report.id))
+            return None
+
+        return self._db_thread_to_crashthread(db_thread)
+
+    def _db_report_to_crashthread(self, db_report):
         if len(db_report.backtraces) < 1:
             self.log_warn("Report #{0} has no usable backtraces"
                           .format(db_report.id))
@@ -221,12 +275,8 @@ class CoredumpProblem(ProblemType):
         for db_thread in db_report.backtraces[0].threads:
             if not db_thread.crashthread:
                 continue
-            if self._db_thread_validate(db_thread):
-                return self._db_thread_to_satyr(db_thread)
-            else:
-                self.log_warn("Report #{0} has only one bad frame"
-                              .format(db_report.id))
-                return None
+
+            return self._thread_to_crashthread(db_report, db_thread)
 
         self.log_warn("Report #{0} has no crash thread".format(db_report.id))
         return None
@@ -306,6 +356,82 @@ class CoredumpProblem(ProblemType):
 
         return hash_list(hashbase)
 
+    def _drop_symbol_cache(self, session, previous_transaction):
+        self._symbol_ids.clear()
+        self._ssource_ids.clear()
+        self._new_symbols = []
+
+    def _get_cached(self, db, cls, cache, keys):
+        """
+        Return a dictionary key -> `cls` instance for the `keys` with an id
+        in `cache`. Instances not present in the session are loaded with
+        a single query.
+        """
+
+        if db is not self._symbols_db:
+            self._drop_symbol_cache(None, None)
+            self._symbols_db = db
+
+        result = {}
+        ids = {}
+        for key in keys:
+            obj_id = cache.get(key)
+            if obj_id is not None:
+                ids[obj_id] = key
+
+        missing = []
+        for obj_id, key in ids.items():
+            obj = db.session.identity_map.get(identity_key(cls, obj_id))
+            if obj is None or inspect(obj).expired:
+                missing.append(obj_id)
+            else:
+                result[key] = obj
+
+        if missing:
+            for obj in db.session.query(cls).filter(cls.id.in_(missing)):
+                result[ids[obj.id]] = obj
+
+        # rows deleted in the meantime
+        for obj_id, key in ids.items():
+            if key not in result:
+                cache.discard(key)
+
+        return result
+
+    def _get_symbols(self, db, keys):
+        """
+        Return a dictionary (name, normalized path) -> Symbol for the
+        existing ones of `keys`.
+        """
+
+        result = self._get_cached(db, Symbol, self._symbol_ids, keys)
+
+        missing = set(keys) - set(result)
+        if missing:
+            for db_symbol in get_symbols_by_names_paths(db, missing):
+                key = (db_symbol.name, db_symbol.normalized_path)
+                result[key] = db_symbol
+                self._symbol_ids.put(key, db_symbol.id)
+
+        return result
+
+    def _get_symbolsources(self, db, keys):
+        """
+        Return a dictionary (build id, path, offset) -> SymbolSource for
+        the existing ones of `keys`.
+        """
+
+        result = self._get_cached(db, SymbolSource, self._ssource_ids, keys)
+
+        missing = set(keys) - set(result)
+        if missing:
+            for db_ssource in get_ssources_by_bpos(db, missing):
+                key = (db_ssource.build_id, db_ssource.path, db_ssource.offset)
+                result[key] = db_ssource
+                self._ssource_ids.put(key, db_ssource.id)
+
+        return result
+
     def save_ureport(self, db, db_report, ureport, flush=False, count=1):
         db_report.errname = str(ureport["signal"])
 
@@ -324,8 +450,21 @@ class CoredumpProblem(ProblemType):
             raise FafError("Unable to get backtrace hash")
 
         if len(db_report.backtraces) < 1:
-            new_symbols = {}
-            new_symbolsources = {}
+            # Resolve all symbols and symbol sources of the stacktrace
+            # at once instead of two queries per frame
+            symbol_keys = set()
+            ssource_keys = set()
+            for thread in ureport["stacktrace"]:
+                for frame in thread["frames"]:
+                    path = os.path.abspath(frame["file_name"])
+                    ssource_keys.add((frame.get("build_id"), path,
+                                      frame["build_id_offset"]))
+                    if "function_name" in frame:
+                        symbol_keys.add((frame["function_name"],
+                                         get_libname(path)))
+
+            symbols = self._get_symbols(db, symbol_keys)
+            symbolsources = self._get_symbolsources(db, ssource_keys)
 
             db_backtrace = ReportBacktrace()
             db_backtrace.report = db_report
@@ -375,40 +514,30 @@ class CoredumpProblem(ProblemType):
 
                     db_symbol = None
                     if "function_name" in frame:
-                        norm_path = get_libname(path)
-
-                        db_symbol = \
-                            get_symbol_by_name_path(db,
-                                                    frame["function_name"],
-                                                    norm_path)
+                        key = (frame["function_name"], get_libname(path))
+                        db_symbol = symbols.get(key)
                         if db_symbol is None:
-                            key = (frame["function_name"], norm_path)
-                            if key in new_symbols:
-                                db_symbol = new_symbols[key]
-                            else:
-                                db_symbol = Symbol()
-                                db_symbol.name = frame["function_name"]
-                                db_symbol.normalized_path = norm_path
-                                db.session.add(db_symbol)
-                                new_symbols[key] = db_symbol
-
-                    db_symbolsource = get_ssource_by_bpo(db, build_id,
-                                                         path, offset)
-
+                            db_symbol = Symbol()
+                            db_symbol.name = frame["function_name"]
+                            db_symbol.normalized_path = key[1]
+                            db.session.add(db_symbol)
+                            symbols[key] = db_symbol
+                            self._new_symbols.append((self._symbol_ids, key,
+                                                      db_symbol))
+
+                    key = (build_id, path, offset)
+                    db_symbolsource = symbolsources.get(key)
                     if db_symbolsource is None:
-                        key = (build_id, path, offset)
-
-                        if key in new_symbolsources:
-                            db_symbolsource = new_symbolsources[key]
-                        else:
-                            db_symbolsource = SymbolSource()
-                            db_symbolsource.symbol = db_symbol
-                            db_symbolsource.build_id = build_id
-                            db_symbolsource.path = path
-                            db_symbolsource.offset = offset
-                            db_symbolsource.hash = fingerprint
-                            db.session.add(db_symbolsource)
-                            new_symbolsources[key] = db_symbolsource
+                        db_symbolsource = SymbolSource()
+                        db_symbolsource.symbol = db_symbol
+                        db_symbolsource.build_id = build_id
+                        db_symbolsource.path = path
+                        db_symbolsource.offset = offset
+                        db_symbolsource.hash = fingerprint
+                        db.session.add(db_symbolsource)
+                        symbolsources[key] = db_symbolsource
+                        self._new_symbols.append((self._ssource_ids, key,
+                                                  db_symbolsource))
 
                     db_frame = ReportBtFrame()
                     db_frame.thread = db_thread
@@ -421,7 +550,20 @@ class CoredumpProblem(ProblemType):
             db.session.flush()
 
     def save_ureport_post_flush(self):
-        self.log_debug("save_ureport_post_flush is not required for coredumps")
+        # the identity is available without reloading the expired objects
+        for cache, key, obj in self._new_symbols:
+            identity = inspect(obj).identity
+            if identity is not None:
+                cache.put(key, identity[0])
+
+        self._new_symbols = []
+
+    def log_cache_stats(self):
+        self.log_info("Symbol cache: {0} hits, {1} misses; symbol source "
+                      "cache: {2} hits, {3} misses"
+                      .format(self._symbol_ids.hits, self._symbol_ids.misses,
+                              self._ssource_ids.hits,
+                              self._ssource_ids.misses))
 
     def get_component_name(self, ureport):
         return ureport["component"]
@@ -436,14 +578,8 @@ class CoredumpProblem(ProblemType):
         reports = []
         ret_db_reports = []
 
-        i = 0
-        for db_report in db_reports:
-            i += 1
-
-            self.log_debug("[{0} / {1}] Loading report #{2}"
-                           .format(i, len(db_reports), db_report.id))
-
-            report = self._db_report_to_satyr(db_report)
+        satyr_reports = self.db_reports_to_satyr(getDatabase(), db_reports)
+        for db_report, report in zip(db_reports, satyr_reports):
             if report is None:
                 self.log_debug("Unable to build satyr.GdbStacktrace")
                 continue
@@ -470,9 +606,10 @@ class CoredumpProblem(ProblemType):
         return False
 
     def _get_ssources_for_retrace_query(self, db):
-        core_syms = (db.session.query(SymbolSource.id)
-                       .join(ReportBtFrame)
-                       .join(ReportBtThread)
+        frames = get_frame_symbolsources(db)
+        core_syms = (db.session.query(frames.c.symbolsource_id)
+                       .join(ReportBtThread,
+                             ReportBtThread.id == frames.c.thread_id)
                        .join(ReportBacktrace)
                        .join(Report)
                        .filter(Report.type == CoredumpProblem.name)
@@ -658,6 +795,14 @@ class CoredumpProblem(ProblemType):
                         db_newframe.order = db_frame.order - inl_id
                         db.session.add(db_newframe)
 
+                    if db_ssource_inl.id is None:
+                        db.session.flush()
+
+                    for db_thread in get_packed_threads_by_symbolsource(
+                            db, db_ssource.id):
+                        db_thread.add_inlined_frame(db_ssource.id,
+                                                    db_ssource_inl.id, inl_id)
+
                 funcname, srcfile, srcline = results.pop()
                 self.log_debug("Result: {0}".format(funcname))
                 db_symbol = get_symbol_by_name_path(db, funcname, norm_path)
@@ -700,12 +845,15 @@ class CoredumpProblem(ProblemType):
             if not db_thread.crashthread:
                 continue
 
-            satyr_thread = self._db_thread_to_satyr(db_thread)
-            satyr_stacktrace = satyr.GdbStacktrace()
-            satyr_stacktrace.threads.append(satyr_thread)
-
-            return satyr_stacktrace.find_crash_frame().function_name
+            return self.find_thread_crash_function(db_thread)
 
         self.log_warn("Backtrace #{0} has no crash thread"
                       .format(db_backtrace.id))
         return None
+
+    def find_thread_crash_function(self, db_thread):
+        satyr_thread = self._db_thread_to_satyr(db_thread)
+        satyr_stacktrace = satyr.GdbStacktrace()
+        satyr_stacktrace.threads.append(satyr_thread)
+
+        return satyr_stacktrace.find_crash_frame().function_name
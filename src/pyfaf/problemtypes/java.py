@@ -37,7 +37,8 @@ from pyfaf.storage import (ReportBacktrace,
                            OpSysComponent,
                            Symbol,
                            SymbolSource,
-                           column_len)
+                           column_len,
+                           getDatabase)
 from pyfaf.utils.parse import str2bool
 from pyfaf.utils.hash import hash_list
 
@@ -129,41 +130,27 @@ class JavaProblem(ProblemType):
 
         return db_threads[0]
 
-    def _db_frame_to_satyr(self, db_frame):
-        class_path = db_frame.symbolsource.path
-
-        result = satyr.JavaFrame()
-        result.name = db_frame.symbolsource.symbol.name
-        result.is_native = class_path == JavaProblem.native
-        result.is_exception = class_path == JavaProblem.exception
-        if class_path not in [JavaProblem.exception,
-                              JavaProblem.native,
-                              JavaProblem.unknown]:
-            result.class_path = class_path
-        if db_frame.symbolsource.source_path is not None:
-            result.file_name = db_frame.symbolsource.source_path
-        result.file_line = db_frame.symbolsource.line_number
+    def _db_frame_to_crashthread(self, db_frame):
+        return {
+            "name": db_frame.symbolsource.symbol.name,
+            "class_path": db_frame.symbolsource.path,
+            "file_name": db_frame.symbolsource.source_path,
+            "file_line": db_frame.symbolsource.line_number,
+        }
 
-        return result
-
-    def _db_thread_to_satyr(self, db_thread):
-        if len(db_thread.frames) < 1:
+    def _db_thread_to_crashthread(self, db_thread):
+        if len(db_thread.get_frames()) < 1:
             self.log_warn("Thread #{0} has no usable frames"
                           .format(db_thread.id))
             return None
 
-        result = satyr.JavaThread()
-        result.name = "Thread #{0}".format(db_thread.number)
-        for db_frame in db_thread.frames:
-            frame = self._db_frame_to_satyr(db_frame)
-            if frame is None:
-                continue
+        return {
+            "number": db_thread.number,
+            "frames": [self._db_frame_to_crashthread(db_frame)
+                       for db_frame in db_thread.get_frames()],
+        }
 
-            result.frames.append(frame)
-
-        return result
-
-    def _db_backtrace_to_satyr(self, db_backtrace):
+    def _db_backtrace_to_crashthread(self, db_backtrace):
         if len(db_backtrace.threads) < 1:
             self.log_warn("Backtrace #{0} has no usable threads"
                           .format(db_backtrace.id))
@@ -173,15 +160,40 @@ class JavaProblem(ProblemType):
             self.log_warn("Backtrace #{0} has several threads"
                           .format(db_backtrace.id))
 
-        return self._db_thread_to_satyr(db_backtrace.threads[0])
+        return self._db_thread_to_crashthread(db_backtrace.threads[0])
 
-    def _db_report_to_satyr(self, db_report):
+    def _db_report_to_crashthread(self, db_report):
         if len(db_report.backtraces) < 1:
             self.log_warn("Report #{0} has no usable backtraces"
                           .format(db_report.id))
             return None
 
-        return self._db_backtrace_to_satyr(db_report.backtraces[0])
+        return self._db_backtrace_to_crashthread(db_report.backtraces[0])
+
+    def _thread_to_crashthread(self, db_report, db_thread):
+        return self._db_thread_to_crashthread(db_thread)
+
+    def _crashthread_to_satyr(self, crashthread):
+        result = satyr.JavaThread()
+        result.name = "Thread #{0}".format(crashthread["number"])
+        for values in crashthread["frames"]:
+            class_path = values["class_path"]
+
+            frame = satyr.JavaFrame()
+            frame.name = values["name"]
+            frame.is_native = class_path == JavaProblem.native
+            frame.is_exception = class_path == JavaProblem.exception
+            if class_path not in [JavaProblem.exception,
+                                  JavaProblem.native,
+                                  JavaProblem.unknown]:
+                frame.class_path = class_path
+            if values["file_name"] is not None:
+                frame.file_name = values["file_name"]
+            frame.file_line = values["file_line"]
+
+            result.frames.append(frame)
+
+        return result
 
     def validate_ureport(self, ureport):
         JavaProblem.checker.check(ureport)
@@ -350,14 +362,8 @@ class JavaProblem(ProblemType):
         reports = []
         ret_db_reports = []
 
-        i = 0
-        for db_report in db_reports:
-            i += 1
-
-            self.log_debug("[{0} / {1}] Loading report #{2}"
-                           .format(i, len(db_reports), db_report.id))
-
-            report = self._db_report_to_satyr(db_report)
+        satyr_reports = self.db_reports_to_satyr(getDatabase(), db_reports)
+        for db_report, report in zip(db_reports, satyr_reports):
             if report is None:
                 self.log_debug("Unable to build satyr.JavaStacktrace")
                 continue
@@ -384,4 +390,7 @@ class JavaProblem(ProblemType):
 
     def find_crash_function(self, db_backtrace):
         crash_thread = self._db_backtrace_find_crash_thread(db_backtrace)
-        return crash_thread.frames[0].symbolsource.symbol.name
+        return self.find_thread_crash_function(crash_thread)
+
+    def find_thread_crash_function(self, db_thread):
+        return db_thread.get_frames()[0].symbolsource.symbol.name
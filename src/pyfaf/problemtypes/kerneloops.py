@@ -31,13 +31,16 @@ from pyfaf.checker import (Checker,
 from pyfaf.common import FafError, log
 from pyfaf.queries import (get_archs,
                            get_backtrace_by_hash,
+                           get_frame_symbolsources,
                            get_kernelmodule_by_name,
                            get_package_by_name_build_arch,
                            get_package_by_nevra,
+                           get_packed_threads_by_symbolsource,
                            get_src_package_by_build,
                            get_ssource_by_bpo,
                            get_symbol_by_name_path,
                            get_taint_flag_by_ureport_name)
+from pyfaf.refcache import refcache
 from pyfaf.retrace import addr2line, demangle, get_function_offset_map
 from pyfaf.storage import (KernelModule,
                            KernelTaintFlag,
@@ -52,7 +55,8 @@ from pyfaf.storage import (KernelModule,
                            OpSysComponent,
                            Symbol,
                            SymbolSource,
-                           column_len)
+                           column_len,
+                           getDatabase)
 from pyfaf.utils.parse import str2bool
 from pyfaf.utils.hash import hash_list
 
@@ -193,30 +197,44 @@ class KerneloopsProblem(ProblemType):
 
         return hash_list(hashbase)
 
-    def _db_backtrace_to_satyr(self, db_backtrace):
-        stacktrace = satyr.Kerneloops()
-
+    def _db_backtrace_to_crashthread(self, db_backtrace):
         if len(db_backtrace.threads) < 1:
             self.log_warn("Backtrace #{0} has no usable threads"
                           .format(db_backtrace.id))
             return None
 
-        db_thread = db_backtrace.threads[0]
+        return self._thread_to_crashthread(None, db_backtrace.threads[0])
 
-        if len(db_thread.frames) < 1:
+    def _thread_to_crashthread(self, db_report, db_thread):
+        if len(db_thread.get_frames()) < 1:
             self.log_warn("Thread #{0} has no usable frames"
                           .format(db_thread.id))
             return None
 
-        for db_frame in db_thread.frames:
-            frame = satyr.KerneloopsFrame()
+        frames = []
+        for db_frame in db_thread.get_frames():
+            frame = {
+                "function_name": "??",
+                "address": db_frame.symbolsource.offset,
+                "function_offset": db_frame.symbolsource.func_offset,
+                "reliable": db_frame.reliable,
+            }
             if db_frame.symbolsource.symbol is not None:
-                frame.function_name = db_frame.symbolsource.symbol.name
-            else:
-                frame.function_name = "??"
-            frame.address = db_frame.symbolsource.offset
-            frame.function_offset = db_frame.symbolsource.func_offset
-            frame.reliable = db_frame.reliable
+                frame["function_name"] = db_frame.symbolsource.symbol.name
+
+            frames.append(frame)
+
+        return {"frames": frames}
+
+    def _crashthread_to_satyr(self, crashthread):
+        stacktrace = satyr.Kerneloops()
+
+        for values in crashthread["frames"]:
+            frame = satyr.KerneloopsFrame()
+            frame.function_name = values["function_name"]
+            frame.address = values["address"]
+            frame.function_offset = values["function_offset"]
+            frame.reliable = values["reliable"]
             if frame.address < 0:
                 frame.address += (1 << 64)
 
@@ -227,13 +245,20 @@ class KerneloopsProblem(ProblemType):
 
         return stacktrace
 
-    def _db_report_to_satyr(self, db_report):
+    def _db_backtrace_to_satyr(self, db_backtrace):
+        crashthread = self._db_backtrace_to_crashthread(db_backtrace)
+        if crashthread is None:
+            return None
+
+        return self._crashthread_to_satyr(crashthread)
+
+    def _db_report_to_crashthread(self, db_report):
         if len(db_report.backtraces) < 1:
             self.log_warn("Report #{0} has no usable backtraces"
                           .format(db_report.id))
             return None
 
-        return self._db_backtrace_to_satyr(db_report.backtraces[0])
+        return self._db_backtrace_to_crashthread(db_report.backtraces[0])
 
     def _parse_kernel_build_id(self, build_id, archs):
         """
@@ -432,7 +457,7 @@ class KerneloopsProblem(ProblemType):
                 db.session.add(db_frame)
 
             for taintflag in ureport["taint_flags"]:
-                db_taintflag = get_taint_flag_by_ureport_name(db, taintflag)
+                db_taintflag = refcache.get_taint_flag(db, taintflag)
                 if db_taintflag is None:
                     self.log_warn("Skipping unsupported taint flag '{0}'"
                                   .format(taintflag))
@@ -440,7 +465,7 @@ class KerneloopsProblem(ProblemType):
 
                 db_bttaintflag = ReportBtTaintFlag()
                 db_bttaintflag.backtrace = db_backtrace
-                db_bttaintflag.taintflag = db_taintflag
+                db_bttaintflag.taintflag_id = db_taintflag.id
                 db.session.add(db_bttaintflag)
 
             if "modules" in ureport:
@@ -499,14 +524,8 @@ class KerneloopsProblem(ProblemType):
         reports = []
         ret_db_reports = []
 
-        i = 0
-        for db_report in db_reports:
-            i += 1
-
-            self.log_debug("[{0} / {1}] Loading report #{2}"
-                           .format(i, len(db_reports), db_report.id))
-            report = self._db_report_to_satyr(db_report)
-
+        satyr_reports = self.db_reports_to_satyr(getDatabase(), db_reports)
+        for db_report, report in zip(db_reports, satyr_reports):
             if report is None:
                 self.log_debug("Unable to build satyr.Kerneloops")
                 continue
@@ -520,9 +539,10 @@ class KerneloopsProblem(ProblemType):
         return ret_db_reports, distances
 
     def _get_ssources_for_retrace_query(self, db):
-        koops_syms = (db.session.query(SymbolSource.id)
-                       .join(ReportBtFrame)
-                       .join(ReportBtThread)
+        frames = get_frame_symbolsources(db)
+        koops_syms = (db.session.query(frames.c.symbolsource_id)
+                       .join(ReportBtThread,
+                             ReportBtThread.id == frames.c.thread_id)
                        .join(ReportBacktrace)
                        .join(Report)
                        .filter(Report.type == KerneloopsProblem.name)
@@ -708,6 +728,14 @@ class KerneloopsProblem(ProblemType):
                         db_newframe.order = db_frame.order - inl_id
                         db.session.add(db_newframe)
 
+                    if db_ssource_inl.id is None:
+                        db.session.flush()
+
+                    for db_thread in get_packed_threads_by_symbolsource(
+                            db, db_ssource.id):
+                        db_thread.add_inlined_frame(db_ssource.id,
+                                                    db_ssource_inl.id, inl_id)
+
                 funcname, srcfile, srcline = results.pop()
                 self.log_debug("Result: {0}".format(funcname))
                 db_symbol = get_symbol_by_name_path(db, funcname, module)
@@ -756,3 +784,8 @@ class KerneloopsProblem(ProblemType):
     def find_crash_function(self, db_backtrace):
         satyr_koops = self._db_backtrace_to_satyr(db_backtrace)
         return satyr_koops.frames[0].function_name
+
+    def find_thread_crash_function(self, db_thread):
+        satyr_koops = self._crashthread_to_satyr(
+            self._thread_to_crashthread(None, db_thread))
+        return satyr_koops.frames[0].function_name
@@ -38,7 +38,8 @@ from pyfaf.storage import (ReportBacktrace,
                            OpSysComponent,
                            Symbol,
                            SymbolSource,
-                           column_len)
+                           column_len,
+                           getDatabase)
 from pyfaf.utils.parse import str2bool
 from pyfaf.utils.hash import hash_list
 
@@ -105,7 +106,7 @@ class RubyProblem(ProblemType):
 
         return hash_list(hashbase)
 
-    def _db_report_to_satyr(self, db_report):
+    def _db_report_to_crashthread(self, db_report):
         if len(db_report.backtraces) < 1:
             self.log_warn("Report #{0} has no usable backtraces"
                           .format(db_report.id))
@@ -118,28 +119,44 @@ class RubyProblem(ProblemType):
                           .format(db_backtrace.id))
             return None
 
-        db_thread = db_backtrace.threads[0]
+        return self._thread_to_crashthread(db_report, db_backtrace.threads[0])
 
-        if len(db_thread.frames) < 1:
+    def _thread_to_crashthread(self, db_report, db_thread):
+        if len(db_thread.get_frames()) < 1:
             self.log_warn("Thread #{0} has no usable frames"
                           .format(db_thread.id))
             return None
 
+        frames = []
+        for db_frame in db_thread.get_frames():
+            frame = {
+                "function_name": db_frame.symbolsource.symbol.name,
+                "file_line": db_frame.symbolsource.offset,
+                "file_name": db_frame.symbolsource.path,
+            }
+            if db_frame.symbolsource.srcline is not None:
+                frame["line_contents"] = db_frame.symbolsource.srcline
+
+            frames.append(frame)
+
+        return {"exception_name": db_report.errname, "frames": frames}
+
+    def _crashthread_to_satyr(self, crashthread):
         stacktrace = satyr.RubyStacktrace()
-        if db_report.errname is not None:
-            stacktrace.exception_name = db_report.errname
+        if crashthread["exception_name"] is not None:
+            stacktrace.exception_name = crashthread["exception_name"]
 
-        for db_frame in db_thread.frames:
+        for values in crashthread["frames"]:
             frame = satyr.RubyFrame()
-            funcname = db_frame.symbolsource.symbol.name
+            funcname = values["function_name"]
             if funcname.startswith("<") and funcname.endswith(">"):
                 frame.special_function = funcname[1:-1]
             else:
                 frame.function_name = funcname
-            frame.file_line = db_frame.symbolsource.offset
-            frame.file_name = db_frame.symbolsource.path
-            if db_frame.symbolsource.srcline is not None:
-                frame.line_contents = db_frame.symbolsource.srcline.encode("utf-8")
+            frame.file_line = values["file_line"]
+            frame.file_name = values["file_name"]
+            if "line_contents" in values:
+                frame.line_contents = values["line_contents"].encode("utf-8")
 
             stacktrace.frames.append(frame)
 
@@ -300,14 +317,8 @@ class RubyProblem(ProblemType):
         reports = []
         ret_db_reports = []
 
-        i = 0
-        for db_report in db_reports:
-            i += 1
-
-            self.log_debug("[{0} / {1}] Loading report #{2}"
-                           .format(i, len(db_reports), db_report.id))
-
-            report = self._db_report_to_satyr(db_report)
+        satyr_reports = self.db_reports_to_satyr(getDatabase(), db_reports)
+        for db_report, report in zip(db_reports, satyr_reports):
             if report is None:
                 self.log_debug("Unable to build satyr.RubyStacktrace")
                 continue
@@ -344,6 +355,9 @@ class RubyProblem(ProblemType):
             self.log_debug("multiple crash threads found")
             return None
 
-        db_symbol = crashthreads[0].frames[0].symbolsource.symbol
+        return self.find_thread_crash_function(crashthreads[0])
+
+    def find_thread_crash_function(self, db_thread):
+        db_symbol = db_thread.get_frames()[0].symbolsource.symbol
 
         return db_symbol.nice_name or db_symbol.name
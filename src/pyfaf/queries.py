@@ -16,9 +16,11 @@
 # You should have received a copy of the GNU General Public License
 # along with faf.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import defaultdict
 from datetime import timedelta
 import datetime
 import functools
+import json
 
 from pyfaf.storage import (Arch,
                            AssociatePeople,
@@ -54,6 +56,7 @@ from pyfaf.storage import (Arch,
                            ReportBtThread,
                            ReportBz,
                            ReportContactEmail,
+                           ReportCrashThread,
                            ReportExecutable,
                            ReportHash,
                            ReportHistoryDaily,
@@ -73,7 +76,15 @@ from pyfaf.storage import (Arch,
                            UnknownOpSys)
 
 from pyfaf.opsys import systems
-from sqlalchemy import func, desc
+from pyfaf.storage.report import (LoadedBtFrame,
+                                  LoadedBtThread,
+                                  LoadedSymbol,
+                                  LoadedSymbolSource,
+                                  packed_frame_values,
+                                  unpack_frame)
+from sqlalchemy import (BigInteger, and_, cast, desc, func, or_, select,
+                        tuple_, union_all)
+from sqlalchemy.dialects.postgresql import ARRAY, array
 from sqlalchemy.orm import load_only
 
 __all__ = ["get_arch_by_name", "get_archs", "get_associate_by_name",
@@ -98,10 +109,12 @@ __all__ = ["get_arch_by_name", "get_archs", "get_associate_by_name",
            "get_package_by_file", "get_packages_by_file",
            "get_package_by_file_build_arch", "get_packages_by_file_builds_arch",
            "get_package_by_name_build_arch", "get_package_by_nevra",
+           "get_packages_by_nevras",
            "get_problems", "get_problem_component", "get_empty_problems",
            "get_problem_opsysrelease", "get_build_by_nevr",
            "get_release_ids", "get_releases", "get_report",
-           "get_report_count_by_component", "get_report_release_desktop",
+           "get_report_by_osrelease_arch", "get_report_count_by_component",
+           "get_report_release_desktop",
            "get_report_stats_by_component", "get_report_by_id",
            "get_reportarch", "get_reportexe", "get_reportosrelease",
            "get_reportpackage", "get_reportreason", "get_reports_by_type",
@@ -112,7 +125,22 @@ __all__ = ["get_arch_by_name", "get_archs", "get_associate_by_name",
            "get_symbolsource", "get_taint_flag_by_ureport_name",
            "get_unknown_opsys", "get_unknown_package", "update_frame_ssource",
            "query_hot_problems", "query_longterm_problems",
-           "user_is_maintainer", "get_packages_by_osrelease", "get_all_report_hashes"]
+           "user_is_maintainer", "get_packages_by_osrelease", "get_all_report_hashes",
+           "get_archs_by_names", "get_bz_bugs_by_ids",
+           "get_components_by_names", "get_mantis_bugs_by_external_ids",
+           "get_osreleases_by_names_versions",
+           "get_reportarchs_by_report_ids", "get_reportbzs_by_report_ids",
+           "get_reportmantises_by_report_ids",
+           "get_reportosreleases_by_report_ids",
+           "get_reportreasons_by_report_ids", "get_reports_by_hashes",
+           "get_ssources_by_bpos", "get_symbols_by_names_paths",
+           "upsert_report_history", "upsert_report_packages",
+           "upsert_report_unknown_packages", "get_frame_symbolsources",
+           "get_packed_threads_by_symbolsource",
+           "get_problem_representatives", "get_reports_by_problem_ids",
+           "get_unclustered_reports_by_type", "get_report_problem_ids",
+           "get_report_crashthreads", "upsert_report_crashthreads",
+           "get_crash_threads", "get_crash_threads_by_report_ids"]
 
 
 def get_arch_by_name(db, arch_name):
@@ -126,6 +154,17 @@ def get_arch_by_name(db, arch_name):
                       .first())
 
 
+def get_archs_by_names(db, arch_names):
+    """
+    Return a list of pyfaf.storage.Arch objects named
+    by any of `arch_names`.
+    """
+
+    return (db.session.query(Arch)
+                      .filter(Arch.name.in_(arch_names))
+                      .all())
+
+
 def get_archs(db):
     """
     Returns the list of all pyfaf.storage.Arch objects.
@@ -188,6 +227,20 @@ def get_component_by_name(db, component_name, opsys_name):
                       .first())
 
 
+def get_components_by_names(db, component_names, opsys_names):
+    """
+    Return a list of (opsys name, pyfaf.storage.OpSysComponent) tuples
+    for components named by any of `component_names` belonging to any
+    of `opsys_names` operating systems.
+    """
+
+    return (db.session.query(OpSys.name, OpSysComponent)
+                      .join(OpSysComponent.opsys)
+                      .filter(OpSysComponent.name.in_(component_names))
+                      .filter(OpSys.name.in_(opsys_names))
+                      .all())
+
+
 def get_component_by_name_release(db, opsysrelease, component_name):
     """
     Return OpSysReleaseComponent instance matching `component_name`
@@ -298,7 +351,8 @@ def get_history_day(db, db_report, db_osrelease, day):
 
     return (db.session.query(ReportHistoryDaily)
                       .filter(ReportHistoryDaily.report == db_report)
-                      .filter(ReportHistoryDaily.opsysrelease == db_osrelease)
+                      .filter(ReportHistoryDaily.opsysrelease_id ==
+                              db_osrelease.id)
                       .filter(ReportHistoryDaily.day == day)
                       .first())
 
@@ -311,7 +365,8 @@ def get_history_month(db, db_report, db_osrelease, month):
 
     return (db.session.query(ReportHistoryMonthly)
                       .filter(ReportHistoryMonthly.report == db_report)
-                      .filter(ReportHistoryMonthly.opsysrelease == db_osrelease)
+                      .filter(ReportHistoryMonthly.opsysrelease_id ==
+                              db_osrelease.id)
                       .filter(ReportHistoryMonthly.month == month)
                       .first())
 
@@ -358,7 +413,8 @@ def get_history_week(db, db_report, db_osrelease, week):
 
     return (db.session.query(ReportHistoryWeekly)
                       .filter(ReportHistoryWeekly.report == db_report)
-                      .filter(ReportHistoryWeekly.opsysrelease == db_osrelease)
+                      .filter(ReportHistoryWeekly.opsysrelease_id ==
+                              db_osrelease.id)
                       .filter(ReportHistoryWeekly.week == week)
                       .first())
 
@@ -509,6 +565,20 @@ def get_osrelease(db, name, version):
                       .first())
 
 
+def get_osreleases_by_names_versions(db, names, versions):
+    """
+    Return a list of (opsys name, pyfaf.storage.OpSysRelease) tuples for
+    releases of any of `names` operating systems with any of `versions`.
+    The result may contain combinations not asked for.
+    """
+
+    return (db.session.query(OpSys.name, OpSysRelease)
+                      .join(OpSysRelease.opsys)
+                      .filter(OpSys.name.in_(names))
+                      .filter(OpSysRelease.version.in_(versions))
+                      .all())
+
+
 def get_packages_by_osrelease(db, name, version, arch):
     """
     Return pyfaf.storage.Package objects assigned to specific osrelease
@@ -619,6 +689,32 @@ def get_package_by_nevra(db, name, epoch, version, release, arch):
                       .first())
 
 
+def get_packages_by_nevras(db, nevras, chunk_size=500):
+    """
+    Return a dictionary (name, epoch, version, release, arch name) ->
+    pyfaf.storage.Package for the existing ones of `nevras`, an iterable
+    of such tuples.
+    """
+
+    result = {}
+    nevras = list(nevras)
+    for start in xrange(0, len(nevras), chunk_size):
+        chunk = nevras[start:start + chunk_size]
+        query = (db.session.query(Package, Build.epoch, Build.version,
+                                  Build.release, Arch.name)
+                           .join(Build)
+                           .join(Arch)
+                           .filter(tuple_(Package.name, Build.epoch,
+                                          Build.version, Build.release,
+                                          Arch.name).in_(chunk)))
+
+        for db_package, epoch, version, release, arch in query:
+            result.setdefault((db_package.name, epoch, version, release, arch),
+                              db_package)
+
+    return result
+
+
 def get_build_by_nevr(db, name, epoch, version, release):
     """
     Return pyfaf.storage.Build object from NEVR or None if not found.
@@ -864,6 +960,36 @@ def get_report(db, report_hash, os_name=None, os_version=None, os_arch=None):
     return db_query.first()
 
 
+def get_report_by_osrelease_arch(db, report_hash, opsysrelease_id, arch_id):
+    """
+    Return pyfaf.storage.Report object with the given hash that has been
+    reported from the given operating system release and architecture
+    or None if not found.
+    """
+
+    return (db.session.query(Report)
+                      .join(ReportHash)
+                      .join(ReportOpSysRelease)
+                      .join(ReportArch)
+                      .filter(ReportHash.hash == report_hash)
+                      .filter(ReportOpSysRelease.opsysrelease_id ==
+                              opsysrelease_id)
+                      .filter(ReportArch.arch_id == arch_id)
+                      .first())
+
+
+def get_reports_by_hashes(db, report_hashes):
+    """
+    Return a list of (hash, pyfaf.storage.Report) tuples
+    for reports with any of `report_hashes`.
+    """
+
+    return (db.session.query(ReportHash.hash, Report)
+                      .join(Report)
+                      .filter(ReportHash.hash.in_(report_hashes))
+                      .all())
+
+
 def get_report_count_by_component(db, opsys_name=None, opsys_version=None,
                                   history='daily'):
     """
@@ -898,7 +1024,8 @@ def get_report_release_desktop(db, db_report, db_release, desktop):
 
     return (db.session.query(ReportReleaseDesktop)
                       .filter(ReportReleaseDesktop.report == db_report)
-                      .filter(ReportReleaseDesktop.release == db_release)
+                      .filter(ReportReleaseDesktop.release_id ==
+                              db_release.id)
                       .filter(ReportReleaseDesktop.desktop == desktop)
                       .first())
 
@@ -937,10 +1064,20 @@ def get_reportarch(db, report, arch):
 
     return (db.session.query(ReportArch)
                       .filter(ReportArch.report == report)
-                      .filter(ReportArch.arch == arch)
+                      .filter(ReportArch.arch_id == arch.id)
                       .first())
 
 
+def get_reportarchs_by_report_ids(db, report_ids):
+    """
+    Return a list of pyfaf.storage.ReportArch objects of any of `report_ids`.
+    """
+
+    return (db.session.query(ReportArch)
+                      .filter(ReportArch.report_id.in_(report_ids))
+                      .all())
+
+
 def get_reportexe(db, report, executable):
     """
     Return pyfaf.storage.ReportExecutable object from pyfaf.storage.Report
@@ -961,10 +1098,22 @@ def get_reportosrelease(db, report, osrelease):
 
     return (db.session.query(ReportOpSysRelease)
                       .filter(ReportOpSysRelease.report == report)
-                      .filter(ReportOpSysRelease.opsysrelease == osrelease)
+                      .filter(ReportOpSysRelease.opsysrelease_id ==
+                              osrelease.id)
                       .first())
 
 
+def get_reportosreleases_by_report_ids(db, report_ids):
+    """
+    Return a list of pyfaf.storage.ReportOpSysRelease objects
+    of any of `report_ids`.
+    """
+
+    return (db.session.query(ReportOpSysRelease)
+                      .filter(ReportOpSysRelease.report_id.in_(report_ids))
+                      .all())
+
+
 def get_reportpackage(db, report, package):
     """
     Return pyfaf.storage.ReportPackage object from pyfaf.storage.Report
@@ -989,6 +1138,16 @@ def get_reportreason(db, report, reason):
                       .first())
 
 
+def get_reportreasons_by_report_ids(db, report_ids):
+    """
+    Return a list of pyfaf.storage.ReportReason objects of any of `report_ids`.
+    """
+
+    return (db.session.query(ReportReason)
+                      .filter(ReportReason.report_id.in_(report_ids))
+                      .all())
+
+
 def get_reports_by_type(db, report_type, min_count=0):
     """
     Return pyfaf.storage.Report object list from
@@ -1001,6 +1160,76 @@ def get_reports_by_type(db, report_type, min_count=0):
     return q.all()
 
 
+def get_unclustered_reports_by_type(db, report_type, min_count=0):
+    """
+    Return a list of pyfaf.storage.Report objects of the textual type
+    that are not assigned to any problem.
+    """
+
+    q = (db.session.query(Report)
+                   .filter(Report.type == report_type)
+                   .filter(Report.problem_id == None))
+    if min_count > 0:
+        q = q.filter(Report.count >= min_count)
+    return q.all()
+
+
+def get_problem_representatives(db, report_type, limit=1, min_count=0):
+    """
+    Return a list of pyfaf.storage.Report objects of the textual type
+    representing the problems they are assigned to - at most `limit`
+    reports with the highest count of each problem.
+    """
+
+    ranked = (db.session.query(
+        Report.id.label("report_id"),
+        func.row_number().over(partition_by=Report.problem_id,
+                               order_by=(Report.count.desc(), Report.id))
+        .label("rank"))
+              .filter(Report.type == report_type)
+              .filter(Report.problem_id != None))
+    if min_count > 0:
+        ranked = ranked.filter(Report.count >= min_count)
+    ranked = ranked.subquery()
+
+    return (db.session.query(Report)
+            .join(ranked, Report.id == ranked.c.report_id)
+            .filter(ranked.c.rank <= limit)
+            .all())
+
+
+def get_reports_by_problem_ids(db, problem_ids, report_type=None,
+                               min_count=0):
+    """
+    Return a list of pyfaf.storage.Report objects assigned to the problems
+    with `problem_ids`, only of the textual type if given.
+    """
+
+    if not problem_ids:
+        return []
+
+    q = (db.session.query(Report)
+                   .filter(Report.problem_id.in_(problem_ids)))
+    if report_type is not None:
+        q = q.filter(Report.type == report_type)
+    if min_count > 0:
+        q = q.filter(Report.count >= min_count)
+    return q.all()
+
+
+def get_report_problem_ids(db, report_type=None):
+    """
+    Return a dictionary report id -> problem id of all reports assigned
+    to a problem, only of the textual type if given.
+    """
+
+    q = (db.session.query(Report.id, Report.problem_id)
+                   .filter(Report.problem_id != None))
+    if report_type is not None:
+        q = q.filter(Report.type == report_type)
+    return dict(q.all())
+
+
 def remove_problem_from_low_count_reports_by_type(db, report_type, min_count):
     """
     Set problem_id = NULL for reports of given `report_type` where count is
@@ -1044,6 +1273,16 @@ def get_reportbz_by_major_version(db, report_id, major_version):
     return query
 
 
+def get_reportbzs_by_report_ids(db, report_ids):
+    """
+    Return a list of pyfaf.storage.ReportBz objects of any of `report_ids`.
+    """
+
+    return (db.session.query(ReportBz)
+                      .filter(ReportBz.report_id.in_(report_ids))
+                      .all())
+
+
 def get_reportmantis(db, report_id, opsysrelease_id=None):
     """
     Return pyfaf.storage.ReportMantis objects of given `report_id`.
@@ -1058,6 +1297,17 @@ def get_reportmantis(db, report_id, opsysrelease_id=None):
     return query
 
 
+def get_reportmantises_by_report_ids(db, report_ids):
+    """
+    Return a list of pyfaf.storage.ReportMantis objects of any
+    of `report_ids`.
+    """
+
+    return (db.session.query(ReportMantis)
+                      .filter(ReportMantis.report_id.in_(report_ids))
+                      .all())
+
+
 def get_repos_for_opsys(db, opsys_id):
     """
     Return Repos assigned to given `opsys_id`.
@@ -1094,15 +1344,50 @@ def get_ssource_by_bpo(db, build_id, path, offset):
                       .first())
 
 
+def get_ssources_by_bpos(db, bpos, chunk_size=500):
+    """
+    Return a list of pyfaf.storage.SymbolSource objects matching any of
+    (build id, path, offset) tuples `bpos`. Build id may be None.
+    """
+
+    result = []
+    bpos = list(bpos)
+    for start in xrange(0, len(bpos), chunk_size):
+        chunk = bpos[start:start + chunk_size]
+        with_build_id = [bpo for bpo in chunk if bpo[0] is not None]
+        without_build_id = [(path, offset) for build_id, path, offset in chunk
+                            if build_id is None]
+
+        conditions = []
+        if with_build_id:
+            conditions.append(tuple_(SymbolSource.build_id,
+                                     SymbolSource.path,
+                                     SymbolSource.offset).in_(with_build_id))
+        if without_build_id:
+            conditions.append(and_(SymbolSource.build_id.is_(None),
+                                   tuple_(SymbolSource.path,
+                                          SymbolSource.offset)
+                                   .in_(without_build_id)))
+
+        result.extend(db.session.query(SymbolSource)
+                                .filter(or_(*conditions))
+                                .all())
+
+    return result
+
+
 def get_ssources_for_retrace(db, problemtype):
     """
     Return a list of pyfaf.storage.SymbolSource objects of given
     problem type that need retracing.
     """
 
+    frames = get_frame_symbolsources(db)
     return (db.session.query(SymbolSource)
-                      .join(ReportBtFrame)
-                      .join(ReportBtThread)
+                      .join(frames,
+                            frames.c.symbolsource_id == SymbolSource.id)
+                      .join(ReportBtThread,
+                            ReportBtThread.id == frames.c.thread_id)
                       .join(ReportBacktrace)
                       .join(Report)
                       .filter(Report.type == problemtype)
@@ -1112,6 +1397,149 @@ def get_ssources_for_retrace(db, problemtype):
                       .all())
 
 
+def get_frame_symbolsources(db):
+    """
+    Return a subquery of (thread_id, symbolsource_id) rows of all frames,
+    both pyfaf.storage.ReportBtFrame rows and frames of packed threads.
+    """
+
+    rows = select([ReportBtFrame.thread_id.label("thread_id"),
+                   ReportBtFrame.symbolsource_id.label("symbolsource_id")])
+    packed = (select([ReportBtThread.id,
+                      func.unnest(ReportBtThread.packed_frames).op(">>")(2)])
+              .where(ReportBtThread.packed_frames != None))
+
+    return union_all(rows, packed).alias()
+
+
+def get_packed_threads_by_symbolsource(db, symbolsource_id):
+    """
+    Return a list of packed pyfaf.storage.ReportBtThread objects
+    with a frame of `symbolsource_id`.
+    """
+
+    values = cast(array(packed_frame_values(symbolsource_id)),
+                  ARRAY(BigInteger))
+    return (db.session.query(ReportBtThread)
+                      .filter(ReportBtThread.packed_frames.op("&&")(values))
+                      .all())
+
+
+def _load_crash_threads(db, column, ids):
+    """
+    Return a list of pyfaf.storage.LoadedBtThread objects of the crash
+    threads of backtraces with `column` in `ids`, ordered by backtrace id
+    and thread number. Threads, frames and symbol sources are loaded by
+    three queries per chunk of ids regardless of the number of frames.
+    """
+
+    result = []
+    ids = list(ids)
+    chunk_size = 1000
+    for start in xrange(0, len(ids), chunk_size):
+        threads = (db.session.query(ReportBtThread.id,
+                                    ReportBtThread.backtrace_id,
+                                    ReportBacktrace.report_id,
+                                    ReportBtThread.number,
+                                    ReportBtThread.packed_frames)
+                   .join(ReportBacktrace)
+                   .filter(column.in_(ids[start:start + chunk_size]))
+                   .filter(ReportBtThread.crashthread == True)
+                   .order_by(ReportBtThread.backtrace_id,
+                             ReportBtThread.number,
+                             ReportBtThread.id)
+                   .all())
+
+        # thread id -> list of (symbol source id, inlined, reliable)
+        frames = defaultdict(list)
+        thread_ids = [thread.id for thread in threads
+                      if thread.packed_frames is None]
+        if thread_ids:
+            for thread_id, ssource_id, inlined, reliable in (
+                    db.session.query(ReportBtFrame.thread_id,
+                                     ReportBtFrame.symbolsource_id,
+                                     ReportBtFrame.inlined,
+                                     ReportBtFrame.reliable)
+                    .filter(ReportBtFrame.thread_id.in_(thread_ids))
+                    .order_by(ReportBtFrame.thread_id, ReportBtFrame.order)):
+                frames[thread_id].append((ssource_id, inlined, reliable))
+
+        for thread in threads:
+            if thread.packed_frames is not None:
+                frames[thread.id] = [unpack_frame(value)
+                                     for value in thread.packed_frames]
+
+        ssource_ids = set(frame[0] for thread_frames in frames.values()
+                          for frame in thread_frames)
+        ssources = {}
+        if ssource_ids:
+            for row in (db.session.query(SymbolSource.id,
+                                         SymbolSource.build_id,
+                                         SymbolSource.path,
+                                         SymbolSource.offset,
+                                         SymbolSource.func_offset,
+                                         SymbolSource.hash,
+                                         SymbolSource.source_path,
+                                         SymbolSource.line_number,
+                                         SymbolSource.srcline,
+                                         Symbol.id,
+                                         Symbol.name,
+                                         Symbol.nice_name,
+                                         Symbol.normalized_path)
+                        .outerjoin(Symbol,
+                                   SymbolSource.symbol_id == Symbol.id)
+                        .filter(SymbolSource.id.in_(ssource_ids))):
+                symbol = None
+                if row[9] is not None:
+                    symbol = LoadedSymbol(*row[9:])
+
+                ssources[row[0]] = LoadedSymbolSource(*(tuple(row[:9]) +
+                                                        (symbol,)))
+
+        for thread in threads:
+            result.append(LoadedBtThread(
+                thread.id, thread.backtrace_id, thread.report_id,
+                thread.number,
+                [LoadedBtFrame(order, ssources[ssource_id], inlined, reliable)
+                 for order, (ssource_id, inlined, reliable)
+                 in enumerate(frames[thread.id], 1)]))
+
+    return result
+
+
+def get_crash_threads(db, backtrace_ids):
+    """
+    Return a dictionary backtrace id -> list of crash threads of the
+    backtrace as pyfaf.storage.LoadedBtThread objects ordered by thread
+    number. Backtraces without a crash thread are missing.
+    """
+
+    result = defaultdict(list)
+    for thread in _load_crash_threads(db, ReportBtThread.backtrace_id,
+                                      backtrace_ids):
+        result[thread.backtrace_id].append(thread)
+
+    return dict(result)
+
+
+def get_crash_threads_by_report_ids(db, report_ids):
+    """
+    Return a dictionary report id -> list of crash threads of the first
+    backtrace of the report with a crash thread as
+    pyfaf.storage.LoadedBtThread objects ordered by thread number. Reports
+    without a crash thread are missing.
+    """
+
+    result = {}
+    for thread in _load_crash_threads(db, ReportBacktrace.report_id,
+                                      report_ids):
+        threads = result.setdefault(thread.report_id, [])
+        if not threads or threads[0].backtrace_id == thread.backtrace_id:
+            threads.append(thread)
+
+    return result
+
+
 def get_supported_components(db):
     """
     Return a list of pyfaf.storage.OpSysReleaseComponent that
@@ -1136,6 +1564,25 @@ def get_symbol_by_name_path(db, name, path):
                       .first())
 
 
+def get_symbols_by_names_paths(db, names_paths, chunk_size=500):
+    """
+    Return a list of pyfaf.storage.Symbol objects matching any of
+    (name, normalized path) tuples `names_paths`.
+    """
+
+    result = []
+    names_paths = list(names_paths)
+    for start in xrange(0, len(names_paths), chunk_size):
+        chunk = names_paths[start:start + chunk_size]
+        result.extend(db.session.query(Symbol)
+                                .filter(tuple_(Symbol.name,
+                                               Symbol.normalized_path)
+                                        .in_(chunk))
+                                .all())
+
+    return result
+
+
 def get_symbolsource(db, symbol, filename, offset):
     """
     Return pyfaf.storage.SymbolSource object from pyfaf.storage.Symbol,
@@ -1178,15 +1625,15 @@ def get_unknown_package(db, db_report, role, name,
     package role and NEVRA or None if not found.
     """
 
-    db_arch = get_arch_by_name(db, arch)
     return (db.session.query(ReportUnknownPackage)
+                      .join(ReportUnknownPackage.arch)
                       .filter(ReportUnknownPackage.report == db_report)
                       .filter(ReportUnknownPackage.type == role)
                       .filter(ReportUnknownPackage.name == name)
                       .filter(ReportUnknownPackage.epoch == epoch)
                       .filter(ReportUnknownPackage.version == version)
                       .filter(ReportUnknownPackage.release == release)
-                      .filter(ReportUnknownPackage.arch == db_arch)
+                      .filter(Arch.name == arch)
                       .first())
 
 
@@ -1218,9 +1665,208 @@ def update_frame_ssource(db, db_ssrc_from, db_ssrc_to):
     for db_frame in db_frames:
         db_frame.symbolsource = db_ssrc_to
 
+    for db_thread in get_packed_threads_by_symbolsource(db, db_ssrc_from.id):
+        db_thread.replace_symbolsource(db_ssrc_from.id, db_ssrc_to.id)
+
     db.session.flush()
 
 
+def upsert_report_history(db, target, rows):
+    """
+    Add counts to pyfaf.storage.ReportHistory(Daily|Weekly|Monthly) rows,
+    according to `target`, creating the missing ones. `rows` is a list of
+    (report_id, opsysrelease_id, date, count, unique) tuples with unique
+    (report_id, opsysrelease_id, date) keys. Uses one multi-row UPDATE and
+    one multi-row INSERT per chunk of `rows`.
+    """
+
+    hist_table, hist_field = get_history_target(target)
+    table = hist_table.__tablename__
+    field = hist_field.key
+
+    update = ("UPDATE {0} SET count = {0}.count + v.count, "
+              "\"unique\" = {0}.\"unique\" + v.\"unique\" "
+              "FROM (VALUES {{0}}) "
+              "AS v(report_id, opsysrelease_id, {1}, count, \"unique\") "
+              "WHERE {0}.report_id = v.report_id "
+              "AND {0}.opsysrelease_id = v.opsysrelease_id "
+              "AND {0}.{1} = v.{1}".format(table, field))
+
+    insert = ("INSERT INTO {0} "
+              "(report_id, opsysrelease_id, {1}, count, \"unique\") "
+              "SELECT v.report_id, v.opsysrelease_id, v.{1}, v.count, "
+              "v.\"unique\" "
+              "FROM (VALUES {{0}}) "
+              "AS v(report_id, opsysrelease_id, {1}, count, \"unique\") "
+              "WHERE NOT EXISTS (SELECT 1 FROM {0} h "
+              "WHERE h.report_id = v.report_id "
+              "AND h.opsysrelease_id = v.opsysrelease_id "
+              "AND h.{1} = v.{1})".format(table, field))
+
+    columns = [("r", "{0}"), ("o", "{0}"), ("d", "{0}"), ("c", "{0}"),
+               ("u", "{0}")]
+
+    _upsert_rows(db, update, insert, columns, rows)
+
+
+def _upsert_rows(db, update, insert, columns, rows, params=None):
+    """
+    Execute `update` and `insert` for each chunk of `rows`, replacing {0}
+    in them with a VALUES list of the chunk. `columns` is a list of
+    (parameter prefix, SQL expression of the parameter) tuples describing
+    the items of a row. `params` are added to the parameters of the rows.
+    """
+
+    chunk_size = 1000
+    for start in xrange(0, len(rows), chunk_size):
+        values = []
+        chunk_params = dict(params or {})
+        for i, row in enumerate(rows[start:start + chunk_size]):
+            names = ["{0}{1}".format(prefix, i) for prefix, expr in columns]
+            values.append("({0})".format(", ".join(
+                expr.format(":" + name)
+                for name, (prefix, expr) in zip(names, columns))))
+            chunk_params.update(zip(names, row))
+
+        values = ", ".join(values)
+        db.session.execute(update.format(values), chunk_params)
+        db.session.execute(insert.format(values), chunk_params)
+
+
+def get_report_crashthreads(db, report_ids):
+    """
+    Return a dictionary report id -> serialized crash thread of the reports
+    with `report_ids` that have their crash thread cached, see
+    pyfaf.storage.ReportCrashThread.
+    """
+
+    result = {}
+    report_ids = list(report_ids)
+    chunk_size = 10000
+    for start in xrange(0, len(report_ids), chunk_size):
+        result.update(db.session.query(ReportCrashThread.report_id,
+                                       ReportCrashThread.data)
+                      .filter(ReportCrashThread.report_id.in_(
+                          report_ids[start:start + chunk_size]))
+                      .all())
+
+    return result
+
+
+def lock_reports(db, report_ids):
+    """
+    Lock pyfaf.storage.Report rows with `report_ids` until the end of the
+    current transaction. The rows are locked in the order of their ids.
+    """
+
+    report_ids = sorted(set(report_ids))
+    chunk_size = 10000
+    for start in xrange(0, len(report_ids), chunk_size):
+        (db.session.query(Report.id)
+         .filter(Report.id.in_(report_ids[start:start + chunk_size]))
+         .order_by(Report.id)
+         .with_lockmode("update")
+         .all())
+
+
+def upsert_report_crashthreads(db, rows):
+    """
+    Cache serialized crash threads of reports. `rows` is a list of
+    (report id, crash thread) tuples with unique report ids, the crash
+    thread being a JSON serializable object or None. The reports must be
+    locked by `lock_reports` since their crash threads were loaded so that
+    the cache is not filled from frames invalidated in the meantime, see
+    pyfaf.storage.events.invalidate_crashthreads.
+    """
+
+    update = ("UPDATE reportcrashthreads SET data = v.data "
+              "FROM (VALUES {0}) AS v(report_id, data) "
+              "WHERE reportcrashthreads.report_id = v.report_id")
+
+    insert = ("INSERT INTO reportcrashthreads (report_id, data) "
+              "SELECT v.report_id, v.data "
+              "FROM (VALUES {0}) AS v(report_id, data) "
+              "WHERE NOT EXISTS (SELECT 1 FROM reportcrashthreads c "
+              "WHERE c.report_id = v.report_id)")
+
+    columns = [("r", "{0}"), ("d", "CAST({0} AS text)")]
+
+    rows = [(report_id, None if data is None else json.dumps(data))
+            for report_id, data in rows]
+    _upsert_rows(db, update, insert, columns, rows)
+
+
+def upsert_report_packages(db, report_id, rows):
+    """
+    Add counts to pyfaf.storage.ReportPackage rows of report `report_id`,
+    creating the missing ones. `rows` is a list of (installed package id,
+    type, count) tuples with unique installed package ids. An existing row
+    is updated regardless of its type.
+    """
+
+    update = ("UPDATE reportpackages "
+              "SET count = reportpackages.count + v.count "
+              "FROM (VALUES {0}) AS v(installed_package_id, type, count) "
+              "WHERE reportpackages.report_id = :report_id "
+              "AND reportpackages.installed_package_id = "
+              "v.installed_package_id")
+
+    insert = ("INSERT INTO reportpackages "
+              "(report_id, installed_package_id, type, count) "
+              "SELECT :report_id, v.installed_package_id, v.type, v.count "
+              "FROM (VALUES {0}) AS v(installed_package_id, type, count) "
+              "WHERE NOT EXISTS (SELECT 1 FROM reportpackages p "
+              "WHERE p.report_id = :report_id "
+              "AND p.installed_package_id = v.installed_package_id)")
+
+    columns = [("p", "{0}"), ("t", "CAST({0} AS reportpackage_type)"),
+               ("c", "{0}")]
+
+    _upsert_rows(db, update, insert, columns, rows,
+                 params={"report_id": report_id})
+
+
+def upsert_report_unknown_packages(db, report_id, rows):
+    """
+    Add counts to pyfaf.storage.ReportUnknownPackage rows of report
+    `report_id`, creating the missing ones. `rows` is a list of (type, name,
+    epoch, version, release, arch id, count) tuples with unique (type, name,
+    epoch, version, release, arch id) keys.
+    """
+
+    update = ("UPDATE reportunknownpackages "
+              "SET count = reportunknownpackages.count + v.count "
+              "FROM (VALUES {0}) "
+              "AS v(type, name, epoch, version, release, arch_id, count) "
+              "WHERE reportunknownpackages.report_id = :report_id "
+              "AND reportunknownpackages.type = v.type "
+              "AND reportunknownpackages.name = v.name "
+              "AND reportunknownpackages.epoch = v.epoch "
+              "AND reportunknownpackages.version = v.version "
+              "AND reportunknownpackages.release = v.release "
+              "AND reportunknownpackages.arch_id = v.arch_id")
+
+    insert = ("INSERT INTO reportunknownpackages "
+              "(report_id, type, name, epoch, version, release, arch_id, "
+              "count) "
+              "SELECT :report_id, v.type, v.name, v.epoch, v.version, "
+              "v.release, v.arch_id, v.count "
+              "FROM (VALUES {0}) "
+              "AS v(type, name, epoch, version, release, arch_id, count) "
+              "WHERE NOT EXISTS (SELECT 1 FROM reportunknownpackages u "
+              "WHERE u.report_id = :report_id AND u.type = v.type "
+              "AND u.name = v.name AND u.epoch = v.epoch "
+              "AND u.version = v.version AND u.release = v.release "
+              "AND u.arch_id = v.arch_id)")
+
+    columns = [("t", "CAST({0} AS reportpackage_type)"), ("n", "{0}"),
+               ("e", "{0}"), ("v", "{0}"), ("r", "{0}"), ("a", "{0}"),
+               ("c", "{0}")]
+
+    _upsert_rows(db, update, insert, columns, rows,
+                 params={"report_id": report_id})
+
+
 def get_bugtracker_by_name(db, name):
     return (db.session.query(Bugtracker)
             .filter(Bugtracker.name == name)
@@ -1321,6 +1967,16 @@ def user_is_maintainer(db, username, component_id):
                       .count()) > 0
 
 
+def get_bz_bugs_by_ids(db, bug_ids):
+    """
+    Return a list of BzBug instances with any of `bug_ids`.
+    """
+
+    return (db.session.query(BzBug)
+            .filter(BzBug.id.in_(bug_ids))
+            .all())
+
+
 def get_mantis_bug(db, external_id, tracker_id):
     """
     Return MantisBug instance if there is a bug in the database
@@ -1333,6 +1989,18 @@ def get_mantis_bug(db, external_id, tracker_id):
             .first())
 
 
+def get_mantis_bugs_by_external_ids(db, external_ids, tracker_id):
+    """
+    Return a list of MantisBug instances of the tracker with `tracker_id`
+    with any of `external_ids`.
+    """
+
+    return (db.session.query(MantisBug)
+            .filter(MantisBug.external_id.in_(external_ids))
+            .filter(MantisBug.tracker_id == tracker_id)
+            .all())
+
+
 def get_report_opsysrelease(db, report_id):
     return (db.session.query(OpSysRelease)
             .join(ReportOpSysRelease)
@@ -0,0 +1,234 @@
+# Copyright (C) 2016  ABRT Team
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This file is part of faf.
+#
+# faf is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# faf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with faf.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+from collections import namedtuple
+
+from pyfaf.common import log
+from pyfaf.config import paths
+from pyfaf.queries import (get_arch_by_name,
+                           get_archs_by_names,
+                           get_component_by_name,
+                           get_components_by_names,
+                           get_osrelease,
+                           get_osreleases_by_names_versions,
+                           get_taint_flag_by_ureport_name)
+
+__all__ = ["CachedArch", "CachedComponent", "CachedOpSysRelease",
+           "CachedTaintFlag", "ReferenceCache", "refcache"]
+
+# The cache holds plain records rather than storage objects so that they can
+# be shared between sessions. Use the ids to refer to the rows.
+CachedArch = namedtuple("CachedArch", ["id", "name"])
+CachedComponent = namedtuple("CachedComponent",
+                             ["id", "name", "opsys_id", "opsys_name"])
+CachedOpSysRelease = namedtuple("CachedOpSysRelease",
+                                ["id", "version", "status", "opsys_id",
+                                 "opsys_name"])
+CachedTaintFlag = namedtuple("CachedTaintFlag",
+                             ["id", "ureport_name", "nice_name", "character"])
+
+
+class ReferenceCache(object):
+    """
+    In-memory cache of the rarely changing reference data looked up for
+    every uReport - operating system releases, architectures, components
+    and kernel taint flags. Only existing rows are cached, a miss always
+    falls back to the storage.
+
+    The cache is dropped by `invalidate`, which also touches a stamp file
+    in the spool directory so that the caches of other processes are
+    dropped on their next lookup. It is dropped as well when used with
+    a different database.
+    """
+
+    def __init__(self, stamp_path=None):
+        if stamp_path is None:
+            stamp_path = paths["refcache_stamp"]
+
+        self.log = log.getChildLogger(self.__class__.__name__)
+        self.stamp_path = stamp_path
+
+        self._db = None
+        self._stamp = self._read_stamp()
+        self._clear()
+
+    def _clear(self):
+        self._osreleases = {}
+        self._archs = {}
+        self._components = {}
+        self._taintflags = {}
+
+    def _read_stamp(self):
+        try:
+            return os.stat(self.stamp_path).st_mtime
+        except OSError:
+            return None
+
+    def _check(self, db):
+        """
+        Drop the cached data if it has been invalidated by another process
+        or if it belongs to a different database.
+        """
+
+        stamp = self._read_stamp()
+        if stamp != self._stamp or db is not self._db:
+            self._clear()
+            self._stamp = stamp
+            self._db = db
+
+    def invalidate(self):
+        """
+        Drop the cached data in this and all other processes.
+        """
+
+        self._clear()
+
+        try:
+            with open(self.stamp_path, "a"):
+                os.utime(self.stamp_path, None)
+        except (IOError, OSError) as ex:
+            self.log.warn("Unable to touch '{0}': {1}"
+                          .format(self.stamp_path, str(ex)))
+
+        self._stamp = self._read_stamp()
+
+    def prefetch(self, db, osreleases=None, archs=None, components=None):
+        """
+        Load the missing ones of `osreleases`, an iterable of
+        (opsys name, version) tuples, `archs`, an iterable of names, and
+        `components`, an iterable of (component name, opsys name) tuples,
+        with set-based queries.
+        """
+
+        self._check(db)
+
+        missing = set(key for key in osreleases or []
+                      if key not in self._osreleases)
+        if missing:
+            for opsys_name, db_osrelease in get_osreleases_by_names_versions(
+                    db, set(key[0] for key in missing),
+                    set(key[1] for key in missing)):
+                self._add_osrelease(opsys_name, db_osrelease)
+
+        missing = set(name for name in archs or []
+                      if name not in self._archs)
+        if missing:
+            for db_arch in get_archs_by_names(db, missing):
+                self._add_arch(db_arch)
+
+        missing = set(key for key in components or []
+                      if key not in self._components)
+        if missing:
+            for opsys_name, db_component in get_components_by_names(
+                    db, set(key[0] for key in missing),
+                    set(key[1] for key in missing)):
+                self._add_component(opsys_name, db_component)
+
+    def _add_osrelease(self, opsys_name, db_osrelease):
+        result = CachedOpSysRelease(id=db_osrelease.id,
+                                    version=db_osrelease.version,
+                                    status=db_osrelease.status,
+                                    opsys_id=db_osrelease.opsys_id,
+                                    opsys_name=opsys_name)
+        self._osreleases[(opsys_name, db_osrelease.version)] = result
+        return result
+
+    def _add_arch(self, db_arch):
+        result = CachedArch(id=db_arch.id, name=db_arch.name)
+        self._archs[db_arch.name] = result
+        return result
+
+    def _add_component(self, opsys_name, db_component):
+        result = CachedComponent(id=db_component.id,
+                                 name=db_component.name,
+                                 opsys_id=db_component.opsys_id,
+                                 opsys_name=opsys_name)
+        self._components[(db_component.name, opsys_name)] = result
+        return result
+
+    def get_osrelease(self, db, opsys_name, version):
+        """
+        Return CachedOpSysRelease or None if not found.
+        """
+
+        self._check(db)
+
+        result = self._osreleases.get((opsys_name, version))
+        if result is None:
+            db_osrelease = get_osrelease(db, opsys_name, version)
+            if db_osrelease is not None:
+                result = self._add_osrelease(opsys_name, db_osrelease)
+
+        return result
+
+    def get_arch(self, db, arch_name):
+        """
+        Return CachedArch or None if not found.
+        """
+
+        self._check(db)
+
+        result = self._archs.get(arch_name)
+        if result is None:
+            db_arch = get_arch_by_name(db, arch_name)
+            if db_arch is not None:
+                result = self._add_arch(db_arch)
+
+        return result
+
+    def get_component(self, db, component_name, opsys_name):
+        """
+        Return CachedComponent or None if not found.
+        """
+
+        self._check(db)
+
+        result = self._components.get((component_name, opsys_name))
+        if result is None:
+            db_component = get_component_by_name(db, component_name,
+                                                 opsys_name)
+            if db_component is not None:
+                result = self._add_component(opsys_name, db_component)
+
+        return result
+
+    def get_taint_flag(self, db, ureport_name):
+        """
+        Return CachedTaintFlag or None if not found.
+        """
+
+        self._check(db)
+
+        result = self._taintflags.get(ureport_name)
+        if result is None:
+            db_taintflag = get_taint_flag_by_ureport_name(db, ureport_name)
+            if db_taintflag is not None:
+                result = CachedTaintFlag(id=db_taintflag.id,
+                                         ureport_name=db_taintflag.ureport_name,
+                                         nice_name=db_taintflag.nice_name,
+                                         character=db_taintflag.character)
+                self._taintflags[ureport_name] = result
+
+        return result
+
+
+# Invalid name "refcache" for type constant
+# pylint: disable-msg=C0103
+refcache = ReferenceCache()
+# pylint: enable-msg=C0103
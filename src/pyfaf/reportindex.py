@@ -0,0 +1,358 @@
+# Copyright (C) 2016  ABRT Team
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This file is part of faf.
+#
+# faf is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# faf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with faf.  If not, see <http://www.gnu.org/licenses/>.
+
+import fcntl
+import os
+from collections import namedtuple
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+
+from pyfaf.common import log
+from pyfaf.config import config, paths
+from pyfaf.storage import (BzBug,
+                           OpSysRelease,
+                           ReportArch,
+                           ReportBz,
+                           ReportHash,
+                           ReportOpSysRelease)
+from pyfaf.utils.lru import LRUCache
+
+__all__ = ["IndexedReport", "ReportIndex", "reportindex"]
+
+
+class IndexedReport(namedtuple("IndexedReport",
+                               ["id", "osrelease_ids", "arch_ids", "bugs"])):
+    """
+    What is needed to tell whether a report is known - ids of the operating
+    system releases and architectures it has been reported from and
+    (operating system release id, version) tuples of its bugzilla bugs.
+    """
+
+    def has_bug(self, opsysrelease_id=None):
+        """
+        Return True if the report has a bug, for the given operating
+        system release if `opsysrelease_id` is given.
+        """
+
+        if not opsysrelease_id:
+            return bool(self.bugs)
+
+        return any(osr_id == opsysrelease_id for osr_id, version in self.bugs)
+
+    def has_bug_by_major_version(self, major_version):
+        """
+        Return True if the report has a bug for any operating system release
+        of `major_version`.
+        """
+
+        prefix = "{0}.".format(major_version)
+        return any(version.startswith(prefix) for osr_id, version in self.bugs)
+
+
+class ReportIndex(object):
+    """
+    In-memory index of report hashes to IndexedReports answering whether
+    an incoming uReport is known. Entries are loaded from the storage on
+    the first lookup of a hash and kept in a bounded LRU cache.
+
+    Committed changes of report hashes, operating system releases,
+    architectures and bugs of reports are appended to a change log in the
+    spool directory. Every process reads the log before a lookup and drops
+    the entries that have changed. The cache is dropped as well when used
+    with a different database.
+    """
+
+    # the log is started from scratch once it grows over this size,
+    # dropping the caches of all processes
+    MAX_LOG_SIZE = 1024 * 1024
+
+    def __init__(self, log_path=None, maxsize=None):
+        if log_path is None:
+            log_path = paths["reportindex_log"]
+
+        if maxsize is None:
+            maxsize = int(config.get("ureport.reportindexsize", 100000))
+
+        self.log = log.getChildLogger(self.__class__.__name__)
+        self.log_path = log_path
+
+        self._db = None
+        self._entries = LRUCache(maxsize)
+        # report id -> report hash of the cached entries
+        self._hashes = {}
+        self._log_ino = None
+        self._log_offset = 0
+        self._sync(drop=False)
+
+        # session -> [report hashes, report ids, everything] changed by
+        # the transaction
+        self._pending = WeakKeyDictionary()
+        event.listen(Session, "after_flush", self._after_flush)
+        event.listen(Session, "after_bulk_delete", self._after_bulk_delete)
+        event.listen(Session, "after_bulk_update", self._after_bulk_update)
+        event.listen(Session, "after_commit", self._after_commit)
+        event.listen(Session, "after_rollback", self._after_rollback)
+
+    def _clear(self):
+        self._entries.clear()
+        self._hashes = {}
+
+    def _discard(self, report_hash):
+        entry = self._entries.get(report_hash)
+        if entry is None:
+            return
+
+        self._entries.discard(report_hash)
+        for report in entry:
+            self._hashes.pop(report.id, None)
+
+    def _sync(self, drop=True):
+        """
+        Drop the entries changed by other processes since the last call.
+        """
+
+        try:
+            stat = os.stat(self.log_path)
+            ino, size = stat.st_ino, stat.st_size
+        except OSError:
+            ino, size = None, 0
+
+        if ino != self._log_ino or size < self._log_offset:
+            # the log has been started from scratch
+            if drop:
+                self._clear()
+
+            self._log_ino = ino
+            self._log_offset = size
+            return
+
+        if size == self._log_offset:
+            return
+
+        try:
+            with open(self.log_path, "r") as logfile:
+                logfile.seek(self._log_offset)
+                data = logfile.read(size - self._log_offset)
+        except IOError as ex:
+            self.log.warn("Unable to read '{0}': {1}"
+                          .format(self.log_path, str(ex)))
+            self._clear()
+            return
+
+        # skip a line being written right now
+        data = data[:data.rfind("\n") + 1]
+        self._log_offset += len(data)
+
+        for line in data.splitlines():
+            kind, value = line.split(" ", 1)
+            if kind == "C":
+                self._clear()
+            elif kind == "H":
+                self._discard(value)
+            elif kind == "R":
+                report_hash = self._hashes.get(int(value))
+                if report_hash is not None:
+                    self._discard(report_hash)
+
+    def get(self, db, report_hash):
+        """
+        Return a tuple of IndexedReports of the reports with `report_hash`
+        ordered by id. The tuple is empty if there is no such report.
+        """
+
+        if db is not self._db:
+            self._clear()
+            self._db = db
+
+        self._sync()
+
+        result = self._entries.get(report_hash)
+        if result is None:
+            result = self._load(db, report_hash)
+            self._entries.put(report_hash, result)
+            for report in result:
+                self._hashes[report.id] = report_hash
+
+            # forget ids of the entries pushed out of the cache
+            if len(self._hashes) > 2 * self._entries.maxsize:
+                self._hashes = dict((report_id, rhash)
+                                    for report_id, rhash
+                                    in self._hashes.items()
+                                    if rhash in self._entries)
+
+        return result
+
+    def _load(self, db, report_hash):
+        report_ids = sorted(report_id for (report_id,) in
+                            (db.session.query(ReportHash.report_id)
+                             .filter(ReportHash.hash == report_hash)))
+        if not report_ids:
+            return ()
+
+        osrelease_ids = dict((report_id, set()) for report_id in report_ids)
+        for report_id, osrelease_id in (
+                db.session.query(ReportOpSysRelease.report_id,
+                                 ReportOpSysRelease.opsysrelease_id)
+                .filter(ReportOpSysRelease.report_id.in_(report_ids))):
+            osrelease_ids[report_id].add(osrelease_id)
+
+        arch_ids = dict((report_id, set()) for report_id in report_ids)
+        for report_id, arch_id in (db.session.query(ReportArch.report_id,
+                                                    ReportArch.arch_id)
+                                   .filter(ReportArch.report_id
+                                           .in_(report_ids))):
+            arch_ids[report_id].add(arch_id)
+
+        bugs = dict((report_id, []) for report_id in report_ids)
+        for report_id, osrelease_id, version in (
+                db.session.query(ReportBz.report_id, BzBug.opsysrelease_id,
+                                 OpSysRelease.version)
+                .join(BzBug, ReportBz.bzbug_id == BzBug.id)
+                .join(OpSysRelease, BzBug.opsysrelease_id == OpSysRelease.id)
+                .filter(ReportBz.report_id.in_(report_ids))):
+            bugs[report_id].append((osrelease_id, version))
+
+        return tuple(IndexedReport(id=report_id,
+                                   osrelease_ids=frozenset(
+                                       osrelease_ids[report_id]),
+                                   arch_ids=frozenset(arch_ids[report_id]),
+                                   bugs=tuple(bugs[report_id]))
+                     for report_id in report_ids)
+
+    # attributes of modified rows the entries are built from
+    TRACKED_ATTRS = {
+        ReportHash: ["hash", "report_id"],
+        ReportOpSysRelease: ["report_id", "opsysrelease_id"],
+        ReportArch: ["report_id", "arch_id"],
+        ReportBz: ["report_id", "bzbug_id", "bzbug"],
+        BzBug: ["opsysrelease_id", "opsysrelease"],
+        OpSysRelease: ["version"],
+    }
+
+    def _modified(self, obj):
+        """
+        Return True if any attribute of the modified `obj` the entries
+        are built from has changed.
+        """
+
+        return any(get_history(obj, attr).has_changes()
+                   for attr in ReportIndex.TRACKED_ATTRS[type(obj)])
+
+    def _after_flush(self, session, flush_context):
+        report_hashes = set()
+        report_ids = set()
+        bug_ids = set()
+        everything = False
+
+        dirty = [obj for obj in session.dirty
+                 if type(obj) in ReportIndex.TRACKED_ATTRS and
+                 self._modified(obj)]
+
+        for obj in list(session.new) + list(session.deleted) + dirty:
+            if isinstance(obj, ReportHash):
+                report_hashes.add(obj.hash)
+                # a modified row is also dropped under its former hash
+                report_hashes.update(get_history(obj, "hash").deleted)
+            elif isinstance(obj, (ReportOpSysRelease, ReportArch, ReportBz)):
+                report_ids.add(obj.report_id)
+                report_ids.update(get_history(obj, "report_id").deleted)
+
+        for obj in dirty:
+            if isinstance(obj, BzBug):
+                bug_ids.add(obj.id)
+            elif isinstance(obj, OpSysRelease):
+                # versions of bugs are cached by all entries
+                everything = True
+
+        if bug_ids:
+            # bugs moved to another operating system release
+            report_ids.update(
+                report_id for (report_id,) in
+                session.query(ReportBz.report_id)
+                .filter(ReportBz.bzbug_id.in_(bug_ids)))
+
+        if report_hashes or report_ids or everything:
+            pending = self._pending.setdefault(session, [set(), set(), False])
+            pending[0].update(report_hashes)
+            pending[1].update(report_ids)
+            pending[2] = pending[2] or everything
+
+    def _after_bulk_delete(self, session, query, query_context, result):
+        # the deleted rows are not known, drop everything
+        self._pending.setdefault(session, [set(), set(), False])[2] = True
+
+    def _after_bulk_update(self, session, query, query_context, result):
+        self._pending.setdefault(session, [set(), set(), False])[2] = True
+
+    def _after_commit(self, session):
+        pending = self._pending.pop(session, None)
+        if pending is not None:
+            self.changed(*pending)
+
+    def _after_rollback(self, session):
+        self._pending.pop(session, None)
+
+    def changed(self, report_hashes=None, report_ids=None, everything=False):
+        """
+        Drop the entries of `report_hashes` and `report_ids` or all entries
+        if `everything` is True in all processes. Changes done through
+        the ORM are recorded automatically once committed.
+        """
+
+        if everything:
+            lines = ["C -\n"]
+        else:
+            lines = (["H {0}\n".format(rhash)
+                      for rhash in report_hashes or []] +
+                     ["R {0}\n".format(report_id)
+                      for report_id in report_ids or []])
+        if not lines:
+            return
+
+        try:
+            with open(self.log_path + ".lock", "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    try:
+                        size = os.path.getsize(self.log_path)
+                    except OSError:
+                        size = 0
+
+                    if size > ReportIndex.MAX_LOG_SIZE:
+                        tmp_path = self.log_path + ".new"
+                        open(tmp_path, "w").close()
+                        os.rename(tmp_path, self.log_path)
+
+                    with open(self.log_path, "a") as logfile:
+                        logfile.write("".join(lines))
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        except (IOError, OSError) as ex:
+            self.log.warn("Unable to write '{0}': {1}"
+                          .format(self.log_path, str(ex)))
+            # at least this process must not use the stale entries
+            self._clear()
+
+
+# Invalid name "reportindex" for type constant
+# pylint: disable-msg=C0103
+reportindex = ReportIndex()
+# pylint: enable-msg=C0103
@@ -97,12 +97,11 @@ class PrefilterSolutionFinder(SolutionFinder):
             ureport = ureport1to2(ureport)
 
         db_opsys = None
-        if osr is not None:
-            db_opsys = osr.opsys
-
         osname = ureport["os"]["name"]
         if osname not in systems:
             log.warn("Operating system '{0}' is not supported".format(osname))
+            if osr is not None:
+                db_opsys = osr.opsys
         else:
             osplugin = systems[osname]
             db_opsys = get_opsys_by_name(db, osplugin.nice_name)
@@ -151,7 +150,7 @@ class PrefilterSolutionFinder(SolutionFinder):
                     if not db_thread.crashthread:
                         continue
 
-                    for db_frame in db_thread.frames:
+                    for db_frame in db_thread.get_frames():
                         if parser.match(db_frame.symbolsource.path):
                             return self._sfps_to_solution(solution)
 
@@ -0,0 +1,742 @@
+# Copyright (C) 2016  ABRT Team
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This file is part of faf.
+#
+# faf is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# faf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with faf.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import fcntl
+import json
+import os
+import re
+import struct
+import time
+from collections import namedtuple
+
+from pyfaf.common import FafError, log
+from pyfaf.config import config, paths
+
+__all__ = ["CoalescedReports", "SpoolCounter", "SpoolRecord",
+           "SegmentSpool", "iter_record", "make_record", "parse_record",
+           "record_body", "record_count", "segment_spool_enabled",
+           "set_record_count", "spool_depth"]
+
+# A JSON document can't start with '#', so a uReport submitted by a client
+# is never mistaken for a record
+RECORD_MAGIC = "#faf-spool-record 1\n"
+
+SpoolRecord = namedtuple("SpoolRecord",
+                         ["segment", "number", "timestamp", "data"])
+
+
+def segment_spool_enabled():
+    """
+    Return True if incoming uReports are spooled into segment files
+    instead of one file per uReport.
+    """
+
+    return config.get("ureport.spoolformat", "files").lower() == "segments"
+
+
+def spool_depth():
+    """
+    Return the SpoolCounter of uReports waiting in the configured spool.
+    """
+
+    if segment_spool_enabled():
+        return SegmentSpool().depth
+
+    return SpoolCounter(paths["reports_depth"])
+
+
+def iter_record(ureport, report_hash, ureport_version, received):
+    """
+    Generate the spool record of a uReport that has been validated in
+    chunks, see `make_record`. The uReport is encoded while the chunks are
+    being consumed, so the whole record is never held in memory.
+    """
+
+    header = {"hash": report_hash,
+              "ureport_version": ureport_version,
+              "received": received}
+
+    yield RECORD_MAGIC
+    yield json.dumps(header)
+    yield "\n"
+
+    encoder = json.JSONEncoder(separators=(",", ":"))
+    for chunk in encoder.iterencode(ureport):
+        yield chunk
+
+
+def make_record(ureport, report_hash, ureport_version, received):
+    """
+    Return a spool record of a uReport that has been validated. The record
+    holds the uReport converted to version 2 together with its report hash,
+    the original uReport version and the `received` timestamp, so that
+    save-reports does not need to validate and hash it again.
+    """
+
+    return "".join(iter_record(ureport, report_hash, ureport_version,
+                               received))
+
+
+def parse_record(data):
+    """
+    Return a (header, ureport) tuple of the spool record `data` or None if
+    `data` is a plain uReport. Raise ValueError if the record is malformed.
+    """
+
+    if not data.startswith(RECORD_MAGIC):
+        return None
+
+    try:
+        header, body = data[len(RECORD_MAGIC):].split("\n", 1)
+    except ValueError:
+        raise ValueError("Truncated spool record")
+
+    return json.loads(header), json.loads(body)
+
+
+def record_body(data):
+    """
+    Return the uReport part of the spool record `data` or `data` itself
+    if it is a plain uReport.
+    """
+
+    if not data.startswith(RECORD_MAGIC):
+        return data
+
+    return data[len(RECORD_MAGIC):].split("\n", 1)[-1]
+
+
+def record_count(data):
+    """
+    Return the number of uReports the spool record `data` stands for,
+    see `set_record_count`. A plain uReport is a single one. Raise
+    ValueError if the record is malformed.
+    """
+
+    if not data.startswith(RECORD_MAGIC):
+        return 1
+
+    header = data[len(RECORD_MAGIC):].split("\n", 1)[0]
+    return json.loads(header).get("count", 1)
+
+
+def set_record_count(data, count):
+    """
+    Return the spool record `data` standing for `count` received uReports,
+    so that coalesced uReports keep their count when the record is moved
+    back to incoming. Raise ValueError if `data` is not a record.
+    """
+
+    record = parse_record(data)
+    if record is None:
+        raise ValueError("Not a spool record")
+
+    header = record[0]
+    header["count"] = count
+
+    return "".join([RECORD_MAGIC, json.dumps(header), "\n",
+                    record_body(data)])
+
+
+class SpoolCounter(object):
+    """
+    Number of uReports waiting in a spool kept in a small file, so that
+    the depth of the spool is known without listing it. Writers of the
+    spool add to it, save-reports subtracts from it and sets it to the
+    real number from time to time in case an update has been lost.
+    """
+
+    VALUE = struct.Struct("!q")
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self):
+        """
+        Return the current value, 0 if the counter does not exist yet.
+        """
+
+        try:
+            with open(self.path, "rb") as counterfile:
+                data = counterfile.read(SpoolCounter.VALUE.size)
+        except IOError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            return 0
+
+        if len(data) < SpoolCounter.VALUE.size:
+            return 0
+
+        return SpoolCounter.VALUE.unpack(data)[0]
+
+    def _update(self, func):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = os.read(fd, SpoolCounter.VALUE.size)
+            if len(data) < SpoolCounter.VALUE.size:
+                value = 0
+            else:
+                value = SpoolCounter.VALUE.unpack(data)[0]
+
+            value = max(func(value), 0)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, SpoolCounter.VALUE.pack(value))
+            return value
+        finally:
+            # closing the file releases the lock
+            os.close(fd)
+
+    def add(self, delta):
+        """
+        Add `delta` to the counter and return the new value.
+        """
+
+        if not delta:
+            return self.get()
+
+        return self._update(lambda value: value + delta)
+
+    def set(self, value):
+        """
+        Set the counter to `value`.
+        """
+
+        return self._update(lambda old: value)
+
+
+class CoalescedReports(object):
+    """
+    uReports merged by the web tier while the spool is over its high-water
+    mark. Only the first uReport of each key is kept, the others just
+    increment its count. save-reports takes the uReports together with
+    their counts and removes them once they are saved. The number of
+    stored records, taken or not, is kept in the `depth` SpoolCounter.
+    """
+
+    TAKEN_PARSER = re.compile(r"^([0-9a-f]+)-([0-9]+)\.taken$")
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = paths["reports_coalesced"]
+
+        self.directory = directory
+        self.depth = SpoolCounter(self._path("depth"))
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _lock(self):
+        lock = open(self._path("lock"), "a")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def add(self, key, data, limit=0):
+        """
+        Store the record `data`, a string or an iterable of strings, under
+        `key`, a hexadecimal digest, or increment the count of the record
+        already stored under `key`. Return True if it has been merged,
+        False if it has been stored and None if it has not been stored
+        because there are `limit` records already. 0 means no limit.
+        """
+
+        if isinstance(data, basestring):
+            data = [data]
+
+        lock = self._lock()
+        try:
+            datpath = self._path("{0}.dat".format(key))
+            countpath = self._path("{0}.count".format(key))
+
+            if os.path.isfile(datpath):
+                try:
+                    with open(countpath, "r") as countfile:
+                        count = int(countfile.read() or 1)
+                except IOError as ex:
+                    if ex.errno != errno.ENOENT:
+                        raise
+                    count = 1
+
+                with open(countpath, "w") as countfile:
+                    countfile.write(str(count + 1))
+
+                return True
+
+            if limit > 0 and self.depth.get() >= limit:
+                return None
+
+            with open(datpath, "wb") as datfile:
+                for chunk in data:
+                    datfile.write(chunk)
+
+            self.depth.add(1)
+            return False
+        finally:
+            lock.close()
+
+    def take(self):
+        """
+        Return a list of (name, data, count) tuples of the stored records.
+        Records are not merged into anymore once taken, call `done`
+        with the names after they have been saved. Records taken before
+        and not done are returned again.
+        """
+
+        # nothing has been coalesced yet
+        if not os.path.isdir(self.directory):
+            return []
+
+        result = []
+        lock = self._lock()
+        try:
+            for fname in sorted(os.listdir(self.directory)):
+                if not fname.endswith(".dat"):
+                    continue
+
+                key = fname[:-len(".dat")]
+                countpath = self._path("{0}.count".format(key))
+                try:
+                    with open(countpath, "r") as countfile:
+                        count = int(countfile.read() or 1)
+                    os.unlink(countpath)
+                except IOError as ex:
+                    if ex.errno != errno.ENOENT:
+                        raise
+                    count = 1
+
+                os.rename(self._path(fname),
+                          self._path("{0}-{1}.taken".format(key, count)))
+
+            # correct updates lost by crashed processes
+            self.depth.set(sum(1 for fname in os.listdir(self.directory)
+                               if CoalescedReports.TAKEN_PARSER.match(fname)))
+        finally:
+            lock.close()
+
+        for fname in sorted(os.listdir(self.directory)):
+            match = CoalescedReports.TAKEN_PARSER.match(fname)
+            if match is None:
+                continue
+
+            with open(self._path(fname), "rb") as datfile:
+                result.append((fname, datfile.read(), int(match.group(2))))
+
+        return result
+
+    def done(self, names):
+        """
+        Remove the taken records `names`.
+        """
+
+        removed = 0
+        for name in names:
+            try:
+                os.unlink(self._path(name))
+                removed += 1
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+
+        self.depth.add(-removed)
+
+
+class SegmentSpool(object):
+    """
+    Append-only spool of uReports. Records are appended to numbered segment
+    files, a new segment is started once the current one grows over
+    `segment_size` bytes. Each segment has an index file of fixed-size
+    (offset, length, receive timestamp) entries, the record number is the
+    position of its entry. The index entry is written after the data, so
+    a reader never sees an incomplete record. The saved or deferred state
+    of records is appended to a state file next to the segment. The number
+    of records without a state is kept in the `depth` SpoolCounter.
+    Segments all records of which have a state are removed by `retire`,
+    segment numbers are never reused.
+
+    Any number of processes may append, writers are serialized by a lock.
+    There must be only one reader, see `lock_reader`.
+    """
+
+    INDEX_ENTRY = struct.Struct("!QId")
+
+    SAVED = "S"
+    DEFERRED = "D"
+    REQUEUED = "R"
+
+    SEGMENT_PARSER = re.compile(r"^([0-9]{8})\.dat$")
+
+    def __init__(self, directory=None, segment_size=None):
+        if directory is None:
+            directory = paths["reports_segments"]
+
+        if segment_size is None:
+            segment_size = int(config.get("ureport.spoolsegmentsize",
+                                          64 * 1024 * 1024))
+
+        self.log = log.getChildLogger(self.__class__.__name__)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.depth = SpoolCounter(os.path.join(directory, "depth"))
+
+        self._segment = None
+        self._reader_lock = None
+        # segment -> number of index entries already returned
+        self._read = {}
+
+    def _path(self, segment, ext):
+        return os.path.join(self.directory, "{0:08d}.{1}".format(segment, ext))
+
+    def segments(self):
+        """
+        Return the sorted list of segment numbers.
+        """
+
+        result = []
+        for fname in os.listdir(self.directory):
+            match = SegmentSpool.SEGMENT_PARSER.match(fname)
+            if match is not None:
+                result.append(int(match.group(1)))
+
+        return sorted(result)
+
+    def _writable_segment(self):
+        """
+        Return the number of the segment to append to. Must be called with
+        the writer lock held.
+        """
+
+        if self._segment is None:
+            segments = self.segments()
+            if segments:
+                self._segment = segments[-1]
+            else:
+                self._segment = 1
+
+        # another writer may have started newer segments already
+        while True:
+            try:
+                size = os.path.getsize(self._path(self._segment, "dat"))
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+
+                # the segment has been retired, the last one never is
+                segments = self.segments()
+                if segments and segments[-1] > self._segment:
+                    self._segment = segments[-1]
+                    continue
+
+                return self._segment
+
+            if size < self.segment_size:
+                return self._segment
+
+            self._segment += 1
+
+    def append(self, data, timestamp=None):
+        """
+        Append the record `data` and return its (segment, number) tuple.
+        `data` is a string or an iterable of strings written one by one.
+        `timestamp` defaults to the current time.
+        """
+
+        if isinstance(data, basestring):
+            data = [data]
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        with open(os.path.join(self.directory, "write.lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                segment = self._writable_segment()
+
+                with open(self._path(segment, "dat"), "ab") as datfile:
+                    datfile.seek(0, os.SEEK_END)
+                    offset = datfile.tell()
+                    length = 0
+                    for chunk in data:
+                        datfile.write(chunk)
+                        length += len(chunk)
+
+                with open(self._path(segment, "idx"), "ab") as idxfile:
+                    # drop an entry partially written by a crashed writer
+                    idxfile.seek(0, os.SEEK_END)
+                    size = idxfile.tell()
+                    if size % SegmentSpool.INDEX_ENTRY.size:
+                        size -= size % SegmentSpool.INDEX_ENTRY.size
+                        idxfile.truncate(size)
+
+                    idxfile.write(SegmentSpool.INDEX_ENTRY.pack(
+                        offset, length, timestamp))
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        self.depth.add(1)
+        return segment, size // SegmentSpool.INDEX_ENTRY.size
+
+    def lock_reader(self):
+        """
+        Make this process the only reader of the spool. Raise FafError if
+        another process is reading it.
+        """
+
+        lock = open(os.path.join(self.directory, "read.lock"), "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as ex:
+            lock.close()
+            if ex.errno in [errno.EAGAIN, errno.EACCES]:
+                raise FafError("The spool '{0}' is locked by another reader"
+                               .format(self.directory))
+            raise
+
+        self._reader_lock = lock
+
+    def unlock_reader(self):
+        if self._reader_lock is not None:
+            self._reader_lock.close()
+            self._reader_lock = None
+
+    def _read_states(self, segment):
+        """
+        Return a dictionary record number -> state of `segment`.
+        """
+
+        states = {}
+        try:
+            with open(self._path(segment, "state"), "r") as statefile:
+                for line in statefile:
+                    # skip a line partially written by a crashed reader
+                    if not line.endswith("\n"):
+                        break
+
+                    number, state = line.split()
+                    states[int(number)] = state
+        except IOError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+
+        return states
+
+    def _read_index(self, segment, start=0):
+        """
+        Return a list of (offset, length, timestamp) tuples of complete
+        index entries of `segment`, starting with entry number `start`.
+        """
+
+        with open(self._path(segment, "idx"), "rb") as idxfile:
+            idxfile.seek(start * SegmentSpool.INDEX_ENTRY.size)
+            data = idxfile.read()
+
+        size = SegmentSpool.INDEX_ENTRY.size
+        return [SegmentSpool.INDEX_ENTRY.unpack_from(data, pos)
+                for pos in xrange(0, len(data) - len(data) % size, size)]
+
+    def pending(self, limit=None):
+        """
+        Return a list of at most `limit` SpoolRecords with no state, oldest
+        first. Records returned once are not returned again by the same
+        SegmentSpool, unless `rewind` is called.
+        """
+
+        result = []
+        for segment in self.segments():
+            if limit is not None and len(result) >= limit:
+                break
+
+            start = self._read.get(segment, 0)
+            try:
+                entries = self._read_index(segment, start)
+            except IOError as ex:
+                # the segment has just been started
+                if ex.errno != errno.ENOENT:
+                    raise
+                continue
+
+            if not entries:
+                continue
+
+            states = self._read_states(segment)
+            with open(self._path(segment, "dat"), "rb") as datfile:
+                for i, (offset, length, timestamp) in enumerate(entries):
+                    if limit is not None and len(result) >= limit:
+                        break
+
+                    number = start + i
+                    self._read[segment] = number + 1
+                    if number in states:
+                        continue
+
+                    datfile.seek(offset)
+                    result.append(SpoolRecord(segment=segment, number=number,
+                                              timestamp=timestamp,
+                                              data=datfile.read(length)))
+
+        return result
+
+    def rewind(self):
+        """
+        Forget the records returned by `pending`.
+        """
+
+        self._read = {}
+
+    def _write_states(self, records, state):
+        """
+        Append the `state` of `records`, an iterable of (segment, number)
+        tuples, to the state files. Return the number of records.
+        """
+
+        by_segment = {}
+        for segment, number in records:
+            by_segment.setdefault(segment, []).append(number)
+
+        for segment, numbers in sorted(by_segment.items()):
+            with open(self._path(segment, "state"), "a") as statefile:
+                statefile.write("".join("{0} {1}\n".format(number, state)
+                                        for number in sorted(numbers)))
+
+        return sum(len(numbers) for numbers in by_segment.values())
+
+    def mark(self, records, state):
+        """
+        Set the `state` of `records`, an iterable of (segment, number)
+        tuples, to SAVED or DEFERRED.
+        """
+
+        self.depth.add(-self._write_states(records, state))
+
+    def deferred(self):
+        """
+        Return the list of SpoolRecords marked as deferred and not requeued
+        yet, oldest first. Deferred records of retired segments are not in
+        the spool anymore, see `retire`.
+        """
+
+        result = []
+        for segment in self.segments():
+            states = self._read_states(segment)
+            numbers = sorted(number for number, state in states.items()
+                             if state == SegmentSpool.DEFERRED)
+            if not numbers:
+                continue
+
+            entries = self._read_index(segment)
+            with open(self._path(segment, "dat"), "rb") as datfile:
+                for number in numbers:
+                    offset, length, timestamp = entries[number]
+                    datfile.seek(offset)
+                    result.append(SpoolRecord(segment=segment, number=number,
+                                              timestamp=timestamp,
+                                              data=datfile.read(length)))
+
+        return result
+
+    def requeue(self, records):
+        """
+        Append the data of deferred `records`, SpoolRecords returned by
+        `deferred`, as new records with their original receive time and
+        mark the deferred ones as REQUEUED. Must be called by the reader.
+        """
+
+        for record in records:
+            self.append(record.data, timestamp=record.timestamp)
+
+        self._write_states([(record.segment, record.number)
+                            for record in records], SegmentSpool.REQUEUED)
+
+    def retire(self, deferred_dir=None):
+        """
+        Remove the segments all records of which have a state, except the
+        last one that writers append to. Deferred records are written to
+        `deferred_dir`, reports/deferred by default, as files named
+        <segment>-<number> with their receive time as the modification
+        time, the same way the file spool keeps deferred uReports. Return
+        the list of removed segments. Must be called by the reader.
+        """
+
+        if deferred_dir is None:
+            deferred_dir = paths["reports_deferred"]
+
+        retired = []
+        for segment in self.segments()[:-1]:
+            try:
+                entries = self._read_index(segment)
+            except IOError as ex:
+                # a writer crashed before writing the first index entry
+                if ex.errno != errno.ENOENT:
+                    raise
+                entries = []
+
+            states = self._read_states(segment)
+            if any(number not in states for number in xrange(len(entries))):
+                continue
+
+            deferred = sorted(number for number, state in states.items()
+                              if state == SegmentSpool.DEFERRED and
+                              number < len(entries))
+
+            with open(self._path(segment, "dat"), "rb") as datfile:
+                for number in deferred:
+                    offset, length, timestamp = entries[number]
+                    datfile.seek(offset)
+
+                    path = os.path.join(deferred_dir, "{0:08d}-{1}"
+                                        .format(segment, number))
+                    with open(path, "wb") as deferredfile:
+                        deferredfile.write(datfile.read(length))
+                    os.utime(path, (timestamp, timestamp))
+
+            # without the data file the segment is gone even if removing
+            # the rest fails
+            for ext in ["dat", "idx", "state"]:
+                try:
+                    os.unlink(self._path(segment, ext))
+                except OSError as ex:
+                    if ex.errno != errno.ENOENT:
+                        raise
+
+            self._read.pop(segment, None)
+            retired.append(segment)
+
+            self.log.debug("Retired segment {0} with {1} deferred records"
+                           .format(segment, len(deferred)))
+
+        return retired
+
+    def count_pending(self):
+        """
+        Return the number of records with no state. Reads the index and
+        the state files of all segments, use `depth` for a cheap estimate.
+        """
+
+        total = 0
+        for segment in self.segments():
+            try:
+                size = os.path.getsize(self._path(segment, "idx"))
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+                continue
+
+            total += size // SegmentSpool.INDEX_ENTRY.size
+            total -= len(self._read_states(segment))
+
+        return total
@@ -231,6 +231,15 @@ class Database(object):
     def close(self):
         self.session.close()
 
+    def dispose(self):
+        """
+        Close the session and all pooled connections. Call before forking
+        so that child processes open their own connections.
+        """
+
+        self.session.close()
+        self._db.dispose()
+
 
 class TemporaryDatabase(object):
     def __init__(self, session):
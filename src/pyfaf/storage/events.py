@@ -1,10 +1,28 @@
-from sqlalchemy import event
-from sqlalchemy.orm import mapper
+from collections import defaultdict
+
+from sqlalchemy import cast, event, func, select
+from sqlalchemy.dialects.postgresql import ARRAY, array
+from sqlalchemy.orm import attributes, mapper
 from sqlalchemy.orm.session import Session
+from sqlalchemy.orm.util import identity_key
 
+from . import BigInteger
 from . import Build
+from . import Report
 from . import ReportBacktrace
 from . import ReportBtFrame
+from . import ReportBtTaintFlag
+from . import ReportBtThread
+from . import ReportCrashThread
+from . import Symbol
+from . import SymbolSource
+
+from .report import packed_frame_values, unpack_frame
+from pyfaf.utils.storage import frame_quality
+
+# key of the statements to execute after the flush in the attributes of
+# the flush context
+AFTER_FLUSH_STATEMENTS = "pyfaf.after_flush_statements"
 
 
 @event.listens_for(ReportBtFrame, "init")
@@ -16,16 +34,326 @@ def init_btframe(target, args, kwargs):
     target.reliable = True
 
 
+def _history(obj, key):
+    """
+    Return the history of attribute `key` of `obj` without loading it.
+    """
+
+    return attributes.get_history(obj, key,
+                                  passive=attributes.PASSIVE_NO_INITIALIZE)
+
+
+def _changed(obj, *keys):
+    """
+    Return True if any of attributes `keys` of `obj` has been changed.
+    """
+
+    for key in keys:
+        hist = _history(obj, key)
+        if hist.added or hist.deleted:
+            return True
+
+    return False
+
+
+def _execute_after_flush(flush_context, statement):
+    """
+    Execute `statement` once the flush of `flush_context` has written its
+    changes, in the transaction of the flush. Statements executed directly
+    by before_flush hooks run in a transaction of their own on autocommit
+    sessions and are kept even if the flush fails.
+    """
+
+    flush_context.attributes.setdefault(AFTER_FLUSH_STATEMENTS,
+                                        []).append(statement)
+
+
+@event.listens_for(Session, "after_flush")
+def execute_after_flush(session, flush_context):
+    """
+    Execute the statements queued by `_execute_after_flush`.
+    """
+
+    for statement in flush_context.attributes.pop(AFTER_FLUSH_STATEMENTS, []):
+        session.execute(statement)
+
+
+def _thread_backtrace(session, db_thread):
+    if db_thread is None:
+        return None
+
+    if db_thread.backtrace is None and db_thread.backtrace_id is not None:
+        return session.query(ReportBacktrace).get(db_thread.backtrace_id)
+
+    return db_thread.backtrace
+
+
+def _frame_backtrace(session, db_frame):
+    db_thread = db_frame.thread
+    if db_thread is None and db_frame.thread_id is not None:
+        db_thread = session.query(ReportBtThread).get(db_frame.thread_id)
+
+    return _thread_backtrace(session, db_thread)
+
+
+def _symbol_name(session, symbol=None, symbol_id=None):
+    if symbol is not None:
+        return symbol.name
+
+    if symbol_id is None:
+        return None
+
+    return (session.query(Symbol.name)
+            .filter(Symbol.id == symbol_id)
+            .scalar())
+
+
+def _symbolsource_quality_change(session, db_ssource):
+    """
+    Return the change of quality of frames with `db_ssource` caused by
+    its pending modifications.
+    """
+
+    if not _changed(db_ssource, "symbol", "symbol_id", "source_path",
+                    "line_number"):
+        return 0
+
+    old = {}
+    for key in ["source_path", "line_number"]:
+        hist = _history(db_ssource, key)
+        if hist.deleted:
+            old[key] = hist.deleted[0]
+        elif hist.unchanged:
+            old[key] = hist.unchanged[0]
+        else:
+            old[key] = None
+
+    symbol_hist = _history(db_ssource, "symbol")
+    symbol_id_hist = _history(db_ssource, "symbol_id")
+
+    # the foreign key is only synchronized with the relationship by flush
+    old_symbol_id = None
+    if symbol_id_hist.deleted:
+        old_symbol_id = symbol_id_hist.deleted[0]
+    elif symbol_id_hist.unchanged:
+        old_symbol_id = symbol_id_hist.unchanged[0]
+
+    if symbol_hist.deleted and symbol_hist.deleted[0] is not None:
+        old_symbol_name = symbol_hist.deleted[0].name
+    else:
+        old_symbol_name = _symbol_name(session, symbol_id=old_symbol_id)
+
+    if symbol_hist.added:
+        new_symbol_name = _symbol_name(session, symbol=symbol_hist.added[0])
+    elif symbol_id_hist.added:
+        new_symbol_name = _symbol_name(session,
+                                       symbol_id=symbol_id_hist.added[0])
+    else:
+        new_symbol_name = old_symbol_name
+
+    return (frame_quality(new_symbol_name, db_ssource.source_path,
+                          db_ssource.line_number) -
+            frame_quality(old_symbol_name, old["source_path"],
+                          old["line_number"]))
+
+
 @event.listens_for(Session, "before_flush")
 def update_backtrace_quality(session, flush_context, instances):
     """
-    Compute and store backtrace quality information
+    Keep backtrace quality information up to date.
+
+    Quality is computed for new backtraces and backtraces whose frames,
+    threads or taint flags have changed. Changes of symbol sources adjust
+    the quality of backtraces with the symbol source in their crash thread
+    without loading the backtraces. The recompute-quality action computes
+    quality of all backtraces from scratch.
     """
 
-    objects = session.new.union(session.dirty)
-    for obj in [c for c in objects if isinstance(c, ReportBacktrace)]:
+    backtraces = set()
+    for obj in session.new:
         if isinstance(obj, ReportBacktrace):
-            obj.quality = obj.compute_quality()
+            backtraces.add(obj)
+        elif isinstance(obj, ReportBtThread):
+            backtraces.add(_thread_backtrace(session, obj))
+        elif isinstance(obj, ReportBtFrame):
+            backtraces.add(_frame_backtrace(session, obj))
+        elif isinstance(obj, ReportBtTaintFlag):
+            backtraces.add(obj.backtrace)
+
+    quality_changes = {}
+    for obj in session.dirty:
+        if isinstance(obj, ReportBtThread):
+            if _changed(obj, "crashthread", "frames", "packed_frames"):
+                backtraces.add(_thread_backtrace(session, obj))
+        elif isinstance(obj, ReportBtFrame):
+            if _changed(obj, "reliable", "symbolsource", "symbolsource_id"):
+                backtraces.add(_frame_backtrace(session, obj))
+        elif isinstance(obj, ReportBacktrace):
+            if _changed(obj, "threads", "taint_flags"):
+                backtraces.add(obj)
+        elif isinstance(obj, SymbolSource) and obj.id is not None:
+            change = _symbolsource_quality_change(session, obj)
+            if change:
+                quality_changes[obj.id] = change
+
+    for obj in session.deleted:
+        if isinstance(obj, ReportBtThread):
+            backtraces.add(_thread_backtrace(session, obj))
+        elif isinstance(obj, ReportBtFrame):
+            backtraces.add(_frame_backtrace(session, obj))
+        elif isinstance(obj, ReportBtTaintFlag):
+            backtraces.add(obj.backtrace)
+
+    backtraces.discard(None)
+    for db_backtrace in backtraces:
+        if db_backtrace not in session.deleted:
+            db_backtrace.quality = db_backtrace.compute_quality()
+
+    if not quality_changes:
+        return
+
+    # backtrace id -> quality change
+    changes = defaultdict(int)
+    for backtrace_id, ssource_id, frames in (
+            session.query(ReportBtThread.backtrace_id,
+                          ReportBtFrame.symbolsource_id,
+                          func.count(ReportBtFrame.order))
+            .join(ReportBtFrame)
+            .filter(ReportBtThread.crashthread == True)
+            .filter(ReportBtFrame.symbolsource_id.in_(quality_changes.keys()))
+            .group_by(ReportBtThread.backtrace_id,
+                      ReportBtFrame.symbolsource_id)):
+        changes[backtrace_id] += quality_changes[ssource_id] * frames
+
+    packed_values = []
+    for ssource_id in quality_changes:
+        packed_values.extend(packed_frame_values(ssource_id))
+
+    for backtrace_id, packed_frames in (
+            session.query(ReportBtThread.backtrace_id,
+                          ReportBtThread.packed_frames)
+            .filter(ReportBtThread.crashthread == True)
+            .filter(ReportBtThread.packed_frames.op("&&")(
+                cast(array(packed_values), ARRAY(BigInteger))))):
+        for value in packed_frames:
+            ssource_id = unpack_frame(value)[0]
+            changes[backtrace_id] += quality_changes.get(ssource_id, 0)
+
+    recomputed = set(db_backtrace.id for db_backtrace in backtraces)
+
+    # quality change -> ids of backtraces not loaded in the session
+    updates = defaultdict(list)
+    for backtrace_id, change in changes.items():
+        if not change or backtrace_id in recomputed:
+            continue
+
+        db_backtrace = session.identity_map.get(
+            identity_key(ReportBacktrace, backtrace_id))
+        if db_backtrace is not None:
+            db_backtrace.quality += change
+        else:
+            updates[change].append(backtrace_id)
+
+    table = ReportBacktrace.__table__
+    for change, backtrace_ids in updates.items():
+        _execute_after_flush(flush_context,
+                             table.update()
+                             .where(table.c.id.in_(backtrace_ids))
+                             .values(quality=table.c.quality + change))
+
+
+@event.listens_for(Session, "before_flush")
+def invalidate_crashthreads(session, flush_context, instances):
+    """
+    Remove cached crash threads of reports whose backtraces change,
+    see pyfaf.storage.ReportCrashThread. Changes of symbol sources
+    invalidate all reports with a frame of the symbol source.
+    """
+
+    backtraces = set()
+    report_ids = set()
+    ssource_ids = set()
+    for obj in session.new:
+        if isinstance(obj, ReportBacktrace):
+            backtraces.add(obj)
+        elif isinstance(obj, ReportBtThread):
+            backtraces.add(_thread_backtrace(session, obj))
+        elif isinstance(obj, ReportBtFrame):
+            backtraces.add(_frame_backtrace(session, obj))
+
+    for obj in session.dirty:
+        if isinstance(obj, ReportBtThread):
+            if _changed(obj, "number", "crashthread", "frames",
+                        "packed_frames"):
+                backtraces.add(_thread_backtrace(session, obj))
+        elif isinstance(obj, ReportBtFrame):
+            if _changed(obj, "order", "reliable", "symbolsource",
+                        "symbolsource_id"):
+                backtraces.add(_frame_backtrace(session, obj))
+        elif isinstance(obj, ReportBacktrace):
+            if _changed(obj, "threads"):
+                backtraces.add(obj)
+        elif isinstance(obj, Report) and obj.id is not None:
+            if _changed(obj, "errname", "backtraces"):
+                report_ids.add(obj.id)
+        elif isinstance(obj, SymbolSource) and obj.id is not None:
+            if _changed(obj, "symbol", "symbol_id", "path", "offset",
+                        "func_offset", "source_path", "line_number",
+                        "srcline"):
+                ssource_ids.add(obj.id)
+
+    for obj in session.deleted:
+        if isinstance(obj, ReportBacktrace):
+            backtraces.add(obj)
+        elif isinstance(obj, ReportBtThread):
+            backtraces.add(_thread_backtrace(session, obj))
+        elif isinstance(obj, ReportBtFrame):
+            backtraces.add(_frame_backtrace(session, obj))
+
+    backtraces.discard(None)
+    for db_backtrace in backtraces:
+        if db_backtrace.report_id is not None:
+            report_ids.add(db_backtrace.report_id)
+        elif (db_backtrace.report is not None and
+              db_backtrace.report.id is not None):
+            report_ids.add(db_backtrace.report.id)
+
+    if ssource_ids:
+        report_ids.update(
+            report_id for (report_id,) in
+            session.query(ReportBacktrace.report_id)
+            .join(ReportBtThread)
+            .join(ReportBtFrame)
+            .filter(ReportBtFrame.symbolsource_id.in_(ssource_ids))
+            .distinct())
+
+        packed_values = []
+        for ssource_id in ssource_ids:
+            packed_values.extend(packed_frame_values(ssource_id))
+
+        report_ids.update(
+            report_id for (report_id,) in
+            session.query(ReportBacktrace.report_id)
+            .join(ReportBtThread)
+            .filter(ReportBtThread.packed_frames.op("&&")(
+                cast(array(packed_values), ARRAY(BigInteger))))
+            .distinct())
+
+    if not report_ids:
+        return
+
+    # Lock the reports like pyfaf.queries.lock_reports so that crash
+    # threads being cached from the old frames are removed as well
+    report_ids = sorted(report_ids)
+    table = Report.__table__
+    _execute_after_flush(flush_context,
+                         select([table.c.id], table.c.id.in_(report_ids),
+                                order_by=table.c.id, for_update=True))
+
+    table = ReportCrashThread.__table__
+    _execute_after_flush(flush_context,
+                         table.delete()
+                         .where(table.c.report_id.in_(report_ids)))
 
 
 @event.listens_for(mapper, 'before_delete')
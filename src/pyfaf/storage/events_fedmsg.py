@@ -24,77 +24,266 @@ fedmsg_environment = config.get("fedmsg.environment", "dev")
 notify_reports = str2bool(config.get("fedmsg.realtime_reports", "false"))
 notify_problems = str2bool(config.get("fedmsg.realtime_problems", "false"))
 
+batch_size = int(config.get("fedmsg.batch_size", 100))
+queue_size = int(config.get("fedmsg.queue_size", 10000))
+
 if notify_reports or notify_problems:
-    from sqlalchemy import event
-    from . import Report
+    import atexit
+    import os
+    import threading
+    import Queue
+    from weakref import WeakKeyDictionary
+    from sqlalchemy import event, func
+    from sqlalchemy.orm import Session
+    from . import (OpSysComponent, Problem, ProblemComponent, Report,
+                   ReportBacktrace, ReportHash)
     import fedmsg
     from pyfaf.utils import web
     from pyfaf.common import log
     logger = log.getChildLogger(__name__)
 
     levels = tuple(10**n for n in range(7))
-    fedmsg.init(name=fedmsg_name, environment=fedmsg_environment)
+
+    # session -> [(topic, msg)] waiting for the transaction to be committed
+    pending = WeakKeyDictionary()
+
+    class FedmsgSender(object):
+        """
+        Publishes the queued messages from a background thread in batches
+        of `batch_size`, so that a slow message bus does not block saving
+        of reports. Messages are dropped if more than `queue_size` of them
+        are waiting.
+        """
+
+        def __init__(self):
+            self._queue = Queue.Queue(queue_size)
+            self._thread = None
+            self._pid = None
+            self._lock = threading.Lock()
+
+        def _start(self):
+            with self._lock:
+                # the thread does not survive fork
+                if self._thread is not None and self._pid == os.getpid():
+                    return
+
+                self._queue = Queue.Queue(queue_size)
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run,
+                                                args=(self._queue,),
+                                                name="fedmsg-sender")
+                self._thread.daemon = True
+                self._thread.start()
+
+        def send(self, messages):
+            """
+            Queue (topic, msg) tuples to be published.
+            """
+
+            self._start()
+            for topic, msg in messages:
+                try:
+                    self._queue.put_nowait((topic, msg))
+                except Queue.Full:
+                    logger.warning("fedmsg queue is full, dropping '{0}'"
+                                   .format(topic))
+
+        def stop(self, timeout=None):
+            """
+            Publish the queued messages and stop the background thread.
+            """
+
+            if self._thread is None or self._pid != os.getpid():
+                return
+
+            try:
+                self._queue.put(None, timeout=timeout)
+            except Queue.Full:
+                logger.warning("fedmsg queue is full, not waiting for the "
+                               "queued messages")
+                return
+
+            self._thread.join(timeout)
+            self._thread = None
+
+        def _run(self, queue):
+            # fedmsg keeps its context in thread local storage
+            fedmsg.init(name=fedmsg_name, environment=fedmsg_environment)
+
+            stop = False
+            while not stop:
+                batch = [queue.get()]
+                while len(batch) < batch_size:
+                    try:
+                        batch.append(queue.get_nowait())
+                    except Queue.Empty:
+                        break
+
+                for item in batch:
+                    if item is None:
+                        stop = True
+                        continue
+
+                    topic, msg = item
+                    try:
+                        fedmsg.publish(topic=topic, modname='faf', msg=msg)
+                    # Catch any exception. This is non-critical and
+                    # mustn't stop the sender.
+                    except Exception as e:
+                        logger.exception(e, exc_info=True)
+
+    sender = FedmsgSender()
+    atexit.register(sender.stop, 30)
+
+    def _crash_function(query):
+        """
+        Return the most common crash function of backtraces matched by `query`
+        the same way as pyfaf.utils.storage.most_common_crash_function does,
+        without loading the backtraces.
+        """
+
+        crash_functions = {"??": 0}
+        for crashfn, count in (query.with_entities(ReportBacktrace.crashfn,
+                                                   func.count(ReportBacktrace.id))
+                               .group_by(ReportBacktrace.crashfn)):
+            crashfn = crashfn or "unknown function"
+            crash_functions[crashfn] = crash_functions.get(crashfn, 0) + count
+
+        return max(crash_functions.iteritems(), key=lambda x: x[1])[0]
+
+    def _report_messages(session, db_report, oldcount, newcount):
+        result = []
+        for level in levels:
+            if oldcount < level and newcount >= level:
+                logger.info("Notifying about report #{0} level {1}"
+                            .format(db_report.id, level))
+                # new reports may only have the component id set
+                component_name = (session.query(OpSysComponent.name)
+                                  .filter(OpSysComponent.id ==
+                                          db_report.component_id)
+                                  .scalar())
+                msg = {
+                    "report_id": db_report.id,
+                    "function": _crash_function(
+                        session.query(ReportBacktrace)
+                        .filter(ReportBacktrace.report_id == db_report.id)),
+                    "components": [component_name],
+                    "first_occurrence": db_report.first_occurrence
+                                        .strftime("%Y-%m-%d"),
+                    "count": newcount,
+                    "type": db_report.type,
+                    "level": level,
+                }
+                report_hash = (session.query(ReportHash.hash)
+                               .filter(ReportHash.report_id == db_report.id)
+                               .first())
+                if web.webfaf_installed() and report_hash is not None:
+                    msg["url"] = web.reverse("reports.bthash_forward",
+                                             bthash=report_hash[0])
+                if db_report.problem_id:
+                    msg["problem_id"] = db_report.problem_id
+
+                result.append(("report.threshold{0}".format(level), msg))
+
+        return result
+
+    def _problem_messages(session, problem_id, report_type, delta):
+        newcount = (session.query(func.sum(Report.count))
+                    .filter(Report.problem_id == problem_id)
+                    .scalar()) or 0
+        oldcount = newcount - delta
+
+        result = []
+        for level in levels:
+            if oldcount < level and newcount >= level:
+                logger.info("Notifying about problem #{0} level {1}"
+                            .format(problem_id, level))
+                first_occurrence = (session.query(Problem.first_occurrence)
+                                    .filter(Problem.id == problem_id)
+                                    .scalar())
+                components = set(name for (name,) in
+                                 session.query(OpSysComponent.name)
+                                 .join(ProblemComponent)
+                                 .filter(ProblemComponent.problem_id ==
+                                         problem_id))
+                msg = {
+                    "problem_id": problem_id,
+                    "function": _crash_function(
+                        session.query(ReportBacktrace)
+                        .join(Report)
+                        .filter(Report.problem_id == problem_id)),
+                    "components": components,
+                    "first_occurrence": first_occurrence.strftime("%Y-%m-%d"),
+                    "count": newcount,
+                    "type": report_type,
+                    "level": level,
+                }
+                if web.webfaf_installed():
+                    msg["url"] = web.reverse("problems.item",
+                                             problem_id=problem_id)
+
+                result.append(("problem.threshold{0}".format(level), msg))
+
+        return result
 
     @event.listens_for(Report.count, "set")
     def fedmsg_report(target, value, oldvalue, initiator):
         """
-        Send fedmsg notifications when Report.count reaches specified threshold.
+        Remember the count of the report before the first change since
+        the last flush. Threshold crossings are found once flushed.
+        """
+
+        if "_fedmsg_oldcount" not in target.__dict__:
+            if not isinstance(oldvalue, (int, long)):
+                oldvalue = 0
+
+            target.__dict__["_fedmsg_oldcount"] = oldvalue
+
+    @event.listens_for(Session, "after_flush")
+    def fedmsg_after_flush(session, flush_context):
+        """
+        Collect notifications about reports and problems whose count
+        reached specified threshold.
         """
+
         try:
-            db_report = target
-            if notify_reports:
-                oldcount = oldvalue
-                newcount = value
-                for level in levels:
-                    if oldcount < level and newcount >= level:
-                        logger.info("Notifying about report #{0} level {1}"
-                                    .format(db_report.id, level))
-                        msg = {
-                            "report_id": db_report.id,
-                            "function": db_report.crash_function,
-                            "components": [db_report.component.name],
-                            "first_occurrence": db_report.first_occurrence
-                                                .strftime("%Y-%m-%d"),
-                            "count": newcount,
-                            "type": db_report.type,
-                            "level": level,
-                        }
-                        if web.webfaf_installed() and db_report.hashes:
-                            msg["url"] = web.reverse("reports.bthash_forward",
-                                                     bthash=db_report.hashes[0].hash)
-                        if db_report.problem_id:
-                            msg["problem_id"] = db_report.problem_id
-
-                        fedmsg.publish(
-                            topic="report.threshold{0}".format(level),
-                            modname='faf',
-                            msg=msg)
-
-            if notify_problems and db_report.problem is not None:
-                oldcount = db_report.problem.reports_count
-                newcount = oldcount + value - oldvalue
-                for level in levels:
-                    if oldcount < level and newcount >= level:
-                        logger.info("Notifying about problem #{0} level {1}"
-                                    .format(db_report.problem.id, level))
-                        msg = {
-                            "problem_id": db_report.problem.id,
-                            "function": db_report.problem.crash_function,
-                            "components": db_report.problem.unique_component_names,
-                            "first_occurrence": db_report.problem.first_occurrence
-                                                .strftime("%Y-%m-%d"),
-                            "count": newcount,
-                            "type": db_report.type,
-                            "level": level,
-                        }
-                        if web.webfaf_installed():
-                            msg["url"] = web.reverse("problems.item",
-                                                     problem_id=db_report.problem.id)
-                        fedmsg.publish(
-                            topic="problem.threshold{0}".format(level),
-                            modname='faf',
-                            msg=msg)
+            messages = []
+            # problem id -> [report type, count increase]
+            problems = {}
+            for obj in list(session.new) + list(session.dirty):
+                if not isinstance(obj, Report):
+                    continue
+
+                oldcount = obj.__dict__.pop("_fedmsg_oldcount", None)
+                if oldcount is None or obj.count == oldcount:
+                    continue
+
+                if notify_reports:
+                    messages.extend(_report_messages(session, obj, oldcount,
+                                                     obj.count))
+
+                if notify_problems and obj.problem_id is not None:
+                    problem = problems.setdefault(obj.problem_id,
+                                                  [obj.type, 0])
+                    problem[1] += obj.count - oldcount
+
+            for problem_id, (report_type, delta) in problems.items():
+                messages.extend(_problem_messages(session, problem_id,
+                                                  report_type, delta))
+
+            if messages:
+                pending.setdefault(session, []).extend(messages)
         # Catch any exception. This is non-critical and mustn't break stuff
         # elsewhere.
         except Exception as e:
             logger.exception(e, exc_info=True)
+
+    @event.listens_for(Session, "after_commit")
+    def fedmsg_after_commit(session):
+        messages = pending.pop(session, None)
+        if messages:
+            sender.send(messages)
+
+    @event.listens_for(Session, "after_rollback")
+    def fedmsg_after_rollback(session):
+        pending.pop(session, None)
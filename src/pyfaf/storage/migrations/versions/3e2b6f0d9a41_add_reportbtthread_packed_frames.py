@@ -0,0 +1,48 @@
+# Copyright (C) 2016  ABRT Team
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This file is part of faf.
+#
+# faf is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# faf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with faf.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Add ReportBtThread packed_frames
+
+Revision ID: 3e2b6f0d9a41
+Revises: 168c63b81f85
+Create Date: 2016-12-20 11:02:41.518303
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3e2b6f0d9a41'
+down_revision = '168c63b81f85'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    op.add_column('reportbtthreads',
+                  sa.Column('packed_frames',
+                            postgresql.ARRAY(sa.BigInteger()),
+                            nullable=True))
+    op.create_index('ix_reportbtthreads_packed_frames', 'reportbtthreads',
+                    ['packed_frames'], postgresql_using='gin')
+
+
+def downgrade():
+    op.drop_index('ix_reportbtthreads_packed_frames',
+                  table_name='reportbtthreads')
+    op.drop_column('reportbtthreads', 'packed_frames')
@@ -0,0 +1,45 @@
+# Copyright (C) 2016  ABRT Team
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This file is part of faf.
+#
+# faf is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# faf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with faf.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Add reportcrashthreads table
+
+Revision ID: 5a3c81e4b7d2
+Revises: 3e2b6f0d9a41
+Create Date: 2016-12-22 14:37:19.204611
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5a3c81e4b7d2'
+down_revision = '3e2b6f0d9a41'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('reportcrashthreads',
+                    sa.Column('report_id', sa.Integer(), nullable=False),
+                    sa.Column('data', sa.UnicodeText(), nullable=True),
+                    sa.ForeignKeyConstraint(['report_id'], ['reports.id'], ),
+                    sa.PrimaryKeyConstraint('report_id'),
+                   )
+
+
+def downgrade():
+    op.drop_table('reportcrashthreads')
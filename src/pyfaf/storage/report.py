@@ -19,7 +19,12 @@
 from collections import namedtuple
 from string import ascii_uppercase
 
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.orm import joinedload, object_session
+
 from . import Arch
+from . import BigInteger
 from . import Boolean
 from . import Column
 from . import Date
@@ -35,13 +40,17 @@ from . import Package
 from . import Problem
 from . import BzBug
 from . import MantisBug
+from . import Index
 from . import String
 from . import SymbolSource
 from . import UniqueConstraint
 from . import backref
 from . import relationship
 
-from pyfaf.utils.storage import format_reason, most_common_crash_function
+from pyfaf.storage.jsontype import JSONType
+from pyfaf.utils.storage import (format_reason,
+                                 frame_quality,
+                                 most_common_crash_function)
 from pyfaf.utils.parse import signal2name
 
 
@@ -54,7 +63,7 @@ class Report(GenericTable):
     first_occurrence = Column(DateTime)
     last_occurrence = Column(DateTime)
     # Watch out, there's a "set" event handler on count that can send out fedmsg
-    # notifications.
+    # notifications once the report is flushed and committed.
     count = Column(Integer, nullable=False)
     errname = Column(String(256), nullable=True)
     component_id = Column(Integer, ForeignKey("{0}.id".format(OpSysComponent.__tablename__)), nullable=False, index=True)
@@ -168,7 +177,7 @@ class ReportBacktrace(GenericTable):
         if len(crashthreads) < 1:
             return []
 
-        return crashthreads[0].frames
+        return crashthreads[0].get_frames()
 
     def normalized(self):
         result = self.btp_thread()
@@ -224,19 +233,13 @@ class ReportBacktrace(GenericTable):
             quality -= 100
 
         for frame in self.frames:
-            if not frame.symbolsource.symbol:
-                quality -= 1
-            elif frame.symbolsource.symbol.name == '??':
-                    quality -= 1
-
-            if not frame.symbolsource.source_path:
-                quality -= 1
-
-            if not frame.symbolsource.line_number:
-                quality -= 1
+            symbolsource = frame.symbolsource
+            symbol_name = None
+            if symbolsource.symbol:
+                symbol_name = symbolsource.symbol.name
 
-            if not frame.reliable:
-                quality -= 1
+            quality += frame_quality(symbol_name, symbolsource.source_path,
+                                     symbolsource.line_number, frame.reliable)
 
         return quality
 
@@ -246,16 +249,260 @@ class ReportBacktrace(GenericTable):
                    for flag in self.taint_flags)
 
 
+def pack_frame(symbolsource_id, inlined=False, reliable=True):
+    """
+    Return the value representing a frame in ReportBtThread.packed_frames.
+    """
+
+    return (symbolsource_id << 2) | (bool(inlined) << 1) | bool(reliable)
+
+
+def unpack_frame(value):
+    """
+    Return (symbolsource_id, inlined, reliable) tuple of a frame
+    packed by `pack_frame`.
+    """
+
+    return value >> 2, bool(value & 2), bool(value & 1)
+
+
+def packed_frame_values(symbolsource_id):
+    """
+    Return all values a frame with `symbolsource_id` may be packed to.
+    """
+
+    return [pack_frame(symbolsource_id, inlined, reliable)
+            for inlined in [False, True] for reliable in [False, True]]
+
+
+class PackedBtFrame(object):
+    """
+    A frame of a thread stored in the packed layout. Provides the attributes
+    of ReportBtFrame, `order` is the position of the frame in the thread.
+    """
+
+    def __init__(self, thread, order, symbolsource, inlined, reliable):
+        self.thread = thread
+        self.thread_id = thread.id
+        self.order = order
+        self.symbolsource = symbolsource
+        self.symbolsource_id = symbolsource.id
+        self.inlined = inlined
+        self.reliable = reliable
+
+
+# Symbols and symbol sources of frames loaded by
+# pyfaf.queries.get_crash_threads
+LoadedSymbol = namedtuple("LoadedSymbol",
+                          ["id", "name", "nice_name", "normalized_path"])
+LoadedSymbolSource = namedtuple("LoadedSymbolSource",
+                                ["id", "build_id", "path", "offset",
+                                 "func_offset", "hash", "source_path",
+                                 "line_number", "srcline", "symbol"])
+
+
+class LoadedBtFrame(object):
+    """
+    A frame loaded by pyfaf.queries.get_crash_threads. Provides the
+    attributes of ReportBtFrame read from frames, `order` is the position
+    of the frame in the thread and `symbolsource` a LoadedSymbolSource.
+    """
+
+    __slots__ = ["order", "symbolsource", "inlined", "reliable"]
+
+    def __init__(self, order, symbolsource, inlined, reliable):
+        self.order = order
+        self.symbolsource = symbolsource
+        self.inlined = inlined
+        self.reliable = reliable
+
+
+class LoadedBtThread(object):
+    """
+    A crash thread loaded by pyfaf.queries.get_crash_threads. Provides
+    the attributes of ReportBtThread read from threads.
+    """
+
+    __slots__ = ["id", "backtrace_id", "report_id", "number", "frames"]
+
+    crashthread = True
+
+    def __init__(self, id, backtrace_id, report_id, number, frames):
+        self.id = id
+        self.backtrace_id = backtrace_id
+        self.report_id = report_id
+        self.number = number
+        self.frames = frames
+
+    def get_frames(self):
+        return self.frames
+
+
 class ReportBtThread(GenericTable):
     __tablename__ = "reportbtthreads"
+    __table_args__ = (Index("ix_reportbtthreads_packed_frames",
+                            "packed_frames", postgresql_using="gin"),)
 
     id = Column(Integer, primary_key=True)
     backtrace_id = Column(Integer, ForeignKey("{0}.id".format(ReportBacktrace.__tablename__)), nullable=False, index=True)
     number = Column(Integer, nullable=True)
     crashthread = Column(Boolean, nullable=False)
+    # Frames packed by pack_frame in the order of the thread. The thread
+    # has no ReportBtFrame rows if set, use get_frames to read frames
+    # of either layout.
+    packed_frames = Column(ARRAY(BigInteger), nullable=True)
 
     backtrace = relationship(ReportBacktrace, backref=backref("threads", order_by="ReportBtThread.number"))
 
+    def get_frames(self):
+        """
+        Return the list of frames of the thread in their order. The frames
+        are ReportBtFrame objects or PackedBtFrame objects if the thread
+        is packed, symbol sources of packed frames are loaded by a single
+        query.
+        """
+
+        if self.packed_frames is None:
+            return self.frames
+
+        packed_frames = tuple(self.packed_frames)
+        cached = self.__dict__.get("_unpacked_frames")
+        if cached is not None and cached[0] == packed_frames:
+            return cached[1]
+
+        unpacked = [unpack_frame(value) for value in packed_frames]
+        ssource_ids = set(ssource_id for ssource_id, inlined, reliable
+                          in unpacked)
+
+        ssources = {}
+        if ssource_ids:
+            ssources = dict(
+                (db_ssource.id, db_ssource) for db_ssource in
+                (object_session(self).query(SymbolSource)
+                 .options(joinedload(SymbolSource.symbol))
+                 .filter(SymbolSource.id.in_(ssource_ids))))
+
+        result = [PackedBtFrame(self, order, ssources[ssource_id],
+                                inlined, reliable)
+                  for order, (ssource_id, inlined, reliable)
+                  in enumerate(unpacked, 1)]
+
+        self.__dict__["_unpacked_frames"] = (packed_frames, result)
+        return result
+
+    def pack_frames(self):
+        """
+        Move the frames of the thread to the packed layout, their
+        ReportBtFrame rows are deleted.
+        """
+
+        if self.packed_frames is not None:
+            return
+
+        self.packed_frames = [pack_frame(db_frame.symbolsource_id,
+                                         db_frame.inlined, db_frame.reliable)
+                              for db_frame in self.frames]
+
+        db = object_session(self)
+        for db_frame in self.frames:
+            db.delete(db_frame)
+
+    def unpack_frames(self, step=10):
+        """
+        Move the frames of the thread back to ReportBtFrame rows, ordered
+        by multiples of `step` to leave room for inlined frames. The rows
+        are ordered after any rows the thread has already.
+        """
+
+        if self.packed_frames is None:
+            return
+
+        start = max([db_frame.order for db_frame in self.frames] or [0])
+
+        db = object_session(self)
+        for packed_frame in self.get_frames():
+            db_frame = ReportBtFrame()
+            db_frame.thread = self
+            db_frame.order = start + packed_frame.order * step
+            db_frame.symbolsource = packed_frame.symbolsource
+            db_frame.inlined = packed_frame.inlined
+            db_frame.reliable = packed_frame.reliable
+            db.add(db_frame)
+
+        self.packed_frames = None
+
+    def append_frame(self, symbolsource, inlined=False, reliable=True):
+        """
+        Add a frame of `symbolsource` to the end of the thread in the layout
+        of the thread. Frame rows of the thread are not loaded.
+        """
+
+        db = object_session(self)
+        if self.packed_frames is not None:
+            if symbolsource.id is None:
+                db.flush()
+
+            self.packed_frames = (list(self.packed_frames) +
+                                  [pack_frame(symbolsource.id, inlined,
+                                              reliable)])
+            return
+
+        max_order = (db.query(func.max(ReportBtFrame.order))
+                     .filter(ReportBtFrame.thread == self)
+                     .scalar() or 0)
+
+        db_frame = ReportBtFrame()
+        db_frame.thread = self
+        db_frame.symbolsource = symbolsource
+        db_frame.order = max_order + 1
+        db_frame.inlined = inlined
+        db_frame.reliable = reliable
+        db.add(db_frame)
+
+    def add_inlined_frame(self, symbolsource_id, inlined_symbolsource_id,
+                          depth):
+        """
+        Insert an inlined frame of `inlined_symbolsource_id` in front of
+        every frame of `symbolsource_id` of a packed thread unless it is
+        there already. `depth` is 1 for the function inlined directly into
+        the frame, 2 for the function inlined into that one etc.
+        """
+
+        frames = []
+        for value in self.packed_frames:
+            ssource_id, inlined, reliable = unpack_frame(value)
+            if ssource_id == symbolsource_id:
+                # the inlined frames right in front of the frame
+                start = len(frames)
+                while start > 0 and frames[start - 1][1]:
+                    start -= 1
+
+                if not any(frame[0] == inlined_symbolsource_id
+                           for frame in frames[start:]):
+                    position = max(start, len(frames) - depth + 1)
+                    frames.insert(position,
+                                  (inlined_symbolsource_id, True, True))
+
+            frames.append((ssource_id, inlined, reliable))
+
+        self.packed_frames = [pack_frame(*frame) for frame in frames]
+
+    def replace_symbolsource(self, symbolsource_id, new_symbolsource_id):
+        """
+        Replace `symbolsource_id` by `new_symbolsource_id` in all frames
+        of a packed thread.
+        """
+
+        frames = []
+        for value in self.packed_frames:
+            ssource_id, inlined, reliable = unpack_frame(value)
+            if ssource_id == symbolsource_id:
+                ssource_id = new_symbolsource_id
+
+            frames.append(pack_frame(ssource_id, inlined, reliable))
+
+        self.packed_frames = frames
+
 
 class ReportBtFrame(GenericTable):
     __tablename__ = "reportbtframes"
@@ -282,6 +529,22 @@ class ReportBtHash(GenericTable):
         return self.hash
 
 
+class ReportCrashThread(GenericTable):
+    """
+    Serialized crash thread of a report as loaded by its problem type
+    plugin. NULL data means the report has no usable crash thread. Rows
+    are removed when the backtrace of the report or its symbol sources
+    change, see pyfaf.storage.events.
+    """
+
+    __tablename__ = "reportcrashthreads"
+
+    report_id = Column(Integer, ForeignKey("{0}.id".format(Report.__tablename__)), primary_key=True)
+    data = Column(JSONType, nullable=True)
+
+    report = relationship(Report, backref=backref("crashthread", uselist=False))
+
+
 class ReportOpSysRelease(GenericTable):
     __tablename__ = "reportopsysreleases"
 
@@ -17,6 +17,10 @@
 # along with faf.  If not, see <http://www.gnu.org/licenses/>.
 
 import datetime
+import json
+import Queue
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from pyfaf.bugtrackers import bugtrackers
 from pyfaf.checker import (Checker,
@@ -28,22 +32,24 @@ from pyfaf.common import FafError, log
 from pyfaf.config import config
 from pyfaf.opsys import systems
 from pyfaf.problemtypes import problemtypes
-from pyfaf.queries import (get_arch_by_name,
-                           get_bz_bug,
-                           get_reportbz_by_major_version,
-                           get_component_by_name,
+from pyfaf.queries import (get_bugtracker_by_name,
+                           get_bz_bugs_by_ids,
                            get_contact_email,
-                           get_history_day,
-                           get_history_month,
-                           get_history_week,
-                           get_osrelease,
-                           get_mantis_bug,
+                           get_mantis_bugs_by_external_ids,
                            get_report,
                            get_report_contact_email,
                            get_reportarch,
+                           get_reportarchs_by_report_ids,
+                           get_reportbzs_by_report_ids,
+                           get_reportmantises_by_report_ids,
                            get_reportreason,
+                           get_reportreasons_by_report_ids,
                            get_reportosrelease,
-                           get_reportbz)
+                           get_reportosreleases_by_report_ids,
+                           get_reports_by_hashes,
+                           upsert_report_history)
+from pyfaf.refcache import refcache
+from pyfaf.reportindex import reportindex
 from pyfaf.storage import (Arch,
                            ContactEmail,
                            OpSysComponent,
@@ -54,9 +60,6 @@ from pyfaf.storage import (Arch,
                            ReportComment,
                            ReportContactEmail,
                            ReportHash,
-                           ReportHistoryDaily,
-                           ReportHistoryMonthly,
-                           ReportHistoryWeekly,
                            ReportOpSysRelease,
                            ReportMantis,
                            ReportReason,
@@ -67,8 +70,13 @@ from sqlalchemy.exc import IntegrityError
 
 log = log.getChildLogger(__name__)
 
-__all__ = ["get_version", "save", "ureport2",
-           "validate", "validate_attachment"]
+__all__ = ["get_dedupe_key", "get_report_hash", "get_version", "save",
+           "save_attachments", "save_batch", "ureport2", "validate",
+           "validate_attachment", "ReportHistoryCounter", "UReportLookups"]
+
+# attachment types linking a report to a bug, see save_attachments
+BZ_ATTACHMENT_TYPES = ["rhbz", "fedora-bugzilla", "rhel-bugzilla"]
+MANTIS_ATTACHMENT_TYPES = ["centos-mantisbt"]
 
 
 UREPORT_CHECKER = DictChecker({
@@ -166,7 +174,8 @@ def validate(ureport):
     raise FafError("uReport version {0} is not supported".format(ver))
 
 
-def save_ureport1(db, ureport, create_component=False, timestamp=None, count=1):
+def save_ureport1(db, ureport, create_component=False, timestamp=None, count=1,
+                  history=None, report_hash=None):
     """
     Saves uReport1
     """
@@ -174,30 +183,258 @@ def save_ureport1(db, ureport, create_component=False, timestamp=None, count=1):
     ureport2 = ureport1to2(ureport)
     validate(ureport2)
     save_ureport2(db, ureport2, create_component=create_component,
-                  timestamp=timestamp, count=count)
+                  timestamp=timestamp, count=count, history=history,
+                  report_hash=report_hash)
+
+
+class ReportHistoryCounter(object):
+    """
+    Report history increments collected in memory, keyed by
+    (report, opsysrelease id, date) for each of the daily, weekly and
+    monthly history. `flush` adds them to the storage with multi-row
+    upserts.
+    """
+
+    def __init__(self):
+        self._counts = {"daily": {}, "weekly": {}, "monthly": {}}
+
+    def __len__(self):
+        return sum(len(counts) for counts in self._counts.values())
+
+    def add(self, db_report, opsysrelease_id, day, count, unique):
+        """
+        Count `count` occurrences, `unique` of them unique, of `db_report`
+        in the operating system release `opsysrelease_id` on `day`.
+        """
+
+        week = day - datetime.timedelta(days=day.weekday())
+        month = day.replace(day=1)
+
+        for target, date in [("daily", day), ("weekly", week),
+                             ("monthly", month)]:
+            counts = self._counts[target]
+            key = (db_report, opsysrelease_id, date)
+            if key in counts:
+                counts[key][0] += count
+                counts[key][1] += unique
+            else:
+                counts[key] = [count, unique]
+
+    def flush(self, db):
+        """
+        Write the collected increments to the storage and reset the counter.
+        Reports created since they were added are flushed first.
+        """
+
+        if not len(self):
+            return
+
+        db.session.flush()
+
+        db.session.begin(subtransactions=True)
+        try:
+            for target, counts in self._counts.items():
+                upsert_report_history(db, target,
+                                      [(db_report.id, opsysrelease_id, date,
+                                        count, unique)
+                                       for (db_report, opsysrelease_id, date),
+                                           (count, unique) in counts.items()])
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+
+        self._counts = {"daily": {}, "weekly": {}, "monthly": {}}
+
+
+def _reason_key(reason):
+    """
+    Return the key of a report reason in UReportLookups. Reasons are
+    read from the database as unicode and saved from uReports encoded
+    in UTF-8.
+    """
+
+    if isinstance(reason, str):
+        return reason.decode("utf-8")
+
+    return reason
+
+
+class UReportLookups(object):
+    """
+    Rows looked up or created while saving uReports. Each lookup falls back
+    to a point query unless `prefetch` already resolved it with set-based
+    queries. Rows of reports created or prefetched by this object are all
+    known, so a miss there means the row does not exist yet. Operating
+    system releases, architectures and components are records of
+    the reference cache, see pyfaf.refcache.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.prefetched = False
+
+        self._osreleases = {}
+        self._archs = {}
+        self._components = {}
+        self._reports = {}
+        self._children = {}
+        # reports whose child rows are all present in self._children
+        self._complete = set()
+
+    def prefetch(self, ureports):
+        """
+        Resolve the lookups of all `ureports`, a list of
+        (uReport2, report hash) tuples, with set-based queries.
+        """
+
+        osreleases = set()
+        arch_names = set()
+        components = set()
+        report_hashes = set()
+        for ureport, report_hash in ureports:
+            osplugin = systems[ureport["os"]["name"]]
+            problemplugin = problemtypes[ureport["problem"]["type"]]
+
+            osreleases.add((osplugin.nice_name, ureport["os"]["version"]))
+            arch_names.add(ureport["os"]["architecture"])
+            components.add((problemplugin.get_component_name(
+                ureport["problem"]), osplugin.nice_name))
+            report_hashes.add(report_hash)
+
+        if not report_hashes:
+            return
+
+        refcache.prefetch(self.db, osreleases=osreleases, archs=arch_names,
+                          components=components)
+
+        reports_by_id = {}
+        for report_hash, db_report in get_reports_by_hashes(self.db,
+                                                            report_hashes):
+            self._reports[report_hash] = db_report
+            reports_by_id[db_report.id] = db_report
+
+        self.prefetched = True
+
+        if not reports_by_id:
+            return
+
+        report_ids = reports_by_id.keys()
+        for db_reportosrelease in get_reportosreleases_by_report_ids(
+                self.db, report_ids):
+            self._children[(ReportOpSysRelease,
+                            reports_by_id[db_reportosrelease.report_id],
+                            db_reportosrelease.opsysrelease_id)] = \
+                db_reportosrelease
+
+        for db_reportarch in get_reportarchs_by_report_ids(self.db,
+                                                           report_ids):
+            self._children[(ReportArch,
+                            reports_by_id[db_reportarch.report_id],
+                            db_reportarch.arch_id)] = db_reportarch
+
+        for db_reportreason in get_reportreasons_by_report_ids(self.db,
+                                                               report_ids):
+            self._children[(ReportReason,
+                            reports_by_id[db_reportreason.report_id],
+                            _reason_key(db_reportreason.reason))] = \
+                db_reportreason
+
+        self._complete.update(reports_by_id.values())
+
+    def get_osrelease(self, opsys_name, version):
+        key = (opsys_name, version)
+        if key not in self._osreleases:
+            self._osreleases[key] = refcache.get_osrelease(self.db,
+                                                           opsys_name,
+                                                           version)
 
+        return self._osreleases[key]
 
-def save_ureport2(db, ureport, create_component=False, timestamp=None, count=1):
+    def get_arch(self, arch_name):
+        if arch_name not in self._archs:
+            self._archs[arch_name] = refcache.get_arch(self.db, arch_name)
+
+        return self._archs[arch_name]
+
+    def get_component(self, component_name, opsys_name):
+        key = (component_name, opsys_name)
+        if key not in self._components:
+            self._components[key] = refcache.get_component(self.db,
+                                                           component_name,
+                                                           opsys_name)
+
+        return self._components[key]
+
+    def add_component(self, component_name, opsys_name, db_component):
+        self._components[(component_name, opsys_name)] = db_component
+
+    def get_report(self, report_hash):
+        if report_hash not in self._reports and not self.prefetched:
+            self._reports[report_hash] = get_report(self.db, report_hash)
+
+        return self._reports.get(report_hash)
+
+    def add_report(self, report_hash, db_report):
+        self._reports[report_hash] = db_report
+        self._complete.add(db_report)
+
+    def get_child(self, table, db_report, key, query, *args):
+        """
+        Return the `table` row of `db_report` identified by `key`. If it is
+        not known, call `query(db, *args)` to look it up.
+        """
+
+        result = self._children.get((table, db_report, key))
+        if result is None and db_report not in self._complete:
+            result = query(self.db, *args)
+            if result is not None:
+                self._children[(table, db_report, key)] = result
+
+        return result
+
+    def add_child(self, table, db_report, key, row):
+        self._children[(table, db_report, key)] = row
+
+
+def save_ureport2(db, ureport, create_component=False, timestamp=None, count=1,
+                  lookups=None, history=None, report_hash=None):
     """
-    Save uReport2
+    Save uReport2. History counts are added to `history`,
+    a ReportHistoryCounter, if given, and written right away otherwise.
+    `report_hash` is computed if not given.
     """
     if timestamp is None:
         timestamp = datetime.datetime.utcnow()
 
+    if lookups is None:
+        lookups = UReportLookups(db)
+
+    flush_history = history is None
+    if flush_history:
+        history = ReportHistoryCounter()
+
     osplugin = systems[ureport["os"]["name"]]
     problemplugin = problemtypes[ureport["problem"]["type"]]
 
-    db_osrelease = get_osrelease(db, osplugin.nice_name,
-                                 ureport["os"]["version"])
+    db_osrelease = lookups.get_osrelease(osplugin.nice_name,
+                                         ureport["os"]["version"])
     if db_osrelease is None:
         raise FafError("Operating system '{0} {1}' not found in storage"
                        .format(osplugin.nice_name, ureport["os"]["version"]))
 
-    report_hash = problemplugin.hash_ureport(ureport["problem"])
-    db_report = get_report(db, report_hash)
+    db_arch = lookups.get_arch(ureport["os"]["architecture"])
+    if db_arch is None:
+        raise FafError("Architecture '{0}' is not supported"
+                       .format(ureport["os"]["architecture"]))
+
+    if report_hash is None:
+        report_hash = problemplugin.hash_ureport(ureport["problem"])
+
+    db_report = lookups.get_report(report_hash)
     if db_report is None:
         component_name = problemplugin.get_component_name(ureport["problem"])
-        db_component = get_component_by_name(db, component_name,
+        db_component = lookups.get_component(component_name,
                                              osplugin.nice_name)
         if db_component is None:
             if create_component:
@@ -206,8 +443,10 @@ def save_ureport2(db, ureport, create_component=False, timestamp=None, count=1):
                                                          osplugin.nice_name))
                 db_component = OpSysComponent()
                 db_component.name = component_name
-                db_component.opsys = db_osrelease.opsys
+                db_component.opsys_id = db_osrelease.opsys_id
                 db.session.add(db_component)
+                lookups.add_component(component_name, osplugin.nice_name,
+                                      db_component)
             else:
                 raise FafError("Unknown component '{0}' in operating system "
                                "{1}".format(component_name, osplugin.nice_name))
@@ -217,7 +456,10 @@ def save_ureport2(db, ureport, create_component=False, timestamp=None, count=1):
         db_report.first_occurrence = timestamp
         db_report.last_occurrence = timestamp
         db_report.count = 0
-        db_report.component = db_component
+        if isinstance(db_component, OpSysComponent):
+            db_report.component = db_component
+        else:
+            db_report.component_id = db_component.id
         db.session.add(db_report)
 
         db_report_hash = ReportHash()
@@ -225,92 +467,62 @@ def save_ureport2(db, ureport, create_component=False, timestamp=None, count=1):
         db_report_hash.hash = report_hash
         db.session.add(db_report_hash)
 
+        lookups.add_report(report_hash, db_report)
+
     if db_report.first_occurrence > timestamp:
         db_report.first_occurrence = timestamp
 
     if db_report.last_occurrence < timestamp:
         db_report.last_occurrence = timestamp
 
-    db_reportosrelease = get_reportosrelease(db, db_report, db_osrelease)
+    db_reportosrelease = lookups.get_child(ReportOpSysRelease, db_report,
+                                           db_osrelease.id,
+                                           get_reportosrelease,
+                                           db_report, db_osrelease)
     if db_reportosrelease is None:
         db_reportosrelease = ReportOpSysRelease()
         db_reportosrelease.report = db_report
-        db_reportosrelease.opsysrelease = db_osrelease
+        db_reportosrelease.opsysrelease_id = db_osrelease.id
         db_reportosrelease.count = 0
         db.session.add(db_reportosrelease)
+        lookups.add_child(ReportOpSysRelease, db_report, db_osrelease.id,
+                          db_reportosrelease)
 
     db_reportosrelease.count += count
 
-    db_arch = get_arch_by_name(db, ureport["os"]["architecture"])
-    if db_arch is None:
-        raise FafError("Architecture '{0}' is not supported"
-                       .format(ureport["os"]["architecture"]))
-
-    db_reportarch = get_reportarch(db, db_report, db_arch)
+    db_reportarch = lookups.get_child(ReportArch, db_report, db_arch.id,
+                                      get_reportarch, db_report, db_arch)
     if db_reportarch is None:
         db_reportarch = ReportArch()
         db_reportarch.report = db_report
-        db_reportarch.arch = db_arch
+        db_reportarch.arch_id = db_arch.id
         db_reportarch.count = 0
         db.session.add(db_reportarch)
+        lookups.add_child(ReportArch, db_report, db_arch.id, db_reportarch)
 
     db_reportarch.count += count
 
     reason = ureport["reason"].encode("utf-8")
-    db_reportreason = get_reportreason(db, db_report, reason)
+    db_reportreason = lookups.get_child(ReportReason, db_report,
+                                        _reason_key(reason),
+                                        get_reportreason, db_report, reason)
     if db_reportreason is None:
         db_reportreason = ReportReason()
         db_reportreason.report = db_report
         db_reportreason.reason = reason
         db_reportreason.count = 0
         db.session.add(db_reportreason)
+        lookups.add_child(ReportReason, db_report, _reason_key(reason),
+                          db_reportreason)
 
     db_reportreason.count += count
 
-    day = timestamp.date()
-    db_daily = get_history_day(db, db_report, db_osrelease, day)
-    if db_daily is None:
-        db_daily = ReportHistoryDaily()
-        db_daily.report = db_report
-        db_daily.opsysrelease = db_osrelease
-        db_daily.day = day
-        db_daily.count = 0
-        db_daily.unique = 0
-        db.session.add(db_daily)
-
+    # all `count` occurrences of a deduplicated first occurrence are unique
+    unique = 0
     if "serial" in ureport["problem"] and ureport["problem"]["serial"] == 1:
-        db_daily.unique += 1
-    db_daily.count += count
-
-    week = day - datetime.timedelta(days=day.weekday())
-    db_weekly = get_history_week(db, db_report, db_osrelease, week)
-    if db_weekly is None:
-        db_weekly = ReportHistoryWeekly()
-        db_weekly.report = db_report
-        db_weekly.opsysrelease = db_osrelease
-        db_weekly.week = week
-        db_weekly.count = 0
-        db_weekly.unique = 0
-        db.session.add(db_weekly)
+        unique = count
 
-    if "serial" in ureport["problem"] and ureport["problem"]["serial"] == 1:
-        db_weekly.unique += 1
-    db_weekly.count += count
-
-    month = day.replace(day=1)
-    db_monthly = get_history_month(db, db_report, db_osrelease, month)
-    if db_monthly is None:
-        db_monthly = ReportHistoryMonthly()
-        db_monthly.report = db_report
-        db_monthly.opsysrelease = db_osrelease
-        db_monthly.month = month
-        db_monthly.count = 0
-        db_monthly.unique = 0
-        db.session.add(db_monthly)
-
-    if "serial" in ureport["problem"] and ureport["problem"]["serial"] == 1:
-        db_monthly.unique += 1
-    db_monthly.count += count
+    history.add(db_report, db_osrelease.id, timestamp.date(), count, unique)
 
     osplugin.save_ureport(db, db_report, ureport["os"], ureport["packages"],
                           count=count)
@@ -322,13 +534,18 @@ def save_ureport2(db, ureport, create_component=False, timestamp=None, count=1):
 
     db.session.flush()
 
+    if flush_history:
+        history.flush(db)
+
     problemplugin.save_ureport_post_flush()
 
 
-def save(db, ureport, create_component=False, timestamp=None, count=1):
+def save(db, ureport, create_component=False, timestamp=None, count=1,
+         report_hash=None):
     """
     Save uReport based on ureport_version element assuming the given uReport "
-    is valid. Flush the database at the end.
+    is valid. Flush the database at the end. `report_hash` is computed
+    if not given.
     """
 
     if timestamp is None:
@@ -337,15 +554,87 @@ def save(db, ureport, create_component=False, timestamp=None, count=1):
     ver = get_version(ureport)
 
     if ver == 1:
-        save_ureport1(db, ureport, create_component=create_component,
-                      timestamp=timestamp, count=count)
+        save_func = save_ureport1
     elif ver == 2:
-        save_ureport2(db, ureport, create_component=create_component,
-                      timestamp=timestamp, count=count)
+        save_func = save_ureport2
     else:
         raise FafError("uReport version {0} is not supported".format(ver))
 
-    db.session.flush()
+    history = ReportHistoryCounter()
+
+    db.session.begin(subtransactions=True)
+    try:
+        save_func(db, ureport, create_component=create_component,
+                  timestamp=timestamp, count=count, history=history,
+                  report_hash=report_hash)
+
+        db.session.flush()
+        history.flush(db)
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
+
+
+def save_batch(db, ureports, create_component=False):
+    """
+    Save a batch of valid uReports in a single transaction. `ureports` is
+    a list of (ureport, timestamp, count, report hash) tuples, the report
+    hash is computed if it is None. The lookups of the whole batch are
+    resolved up front with set-based queries and uReports sharing a report
+    hash are saved one right after another.
+
+    uReports rejected before anything was written for them (unknown
+    operating system release, architecture or component) are skipped and
+    returned as a list of (index, FafError) tuples. Any other failure rolls
+    back the whole batch and is raised.
+    """
+
+    groups = OrderedDict()
+    for i, (ureport, timestamp, count, report_hash) in enumerate(ureports):
+        if timestamp is None:
+            timestamp = datetime.datetime.utcnow()
+
+        ureport = ureport2(ureport)
+        if report_hash is None:
+            report_hash = get_report_hash(ureport)
+
+        groups.setdefault(report_hash, []).append((i, ureport, timestamp,
+                                                   count))
+
+    lookups = UReportLookups(db)
+    history = ReportHistoryCounter()
+    failed = []
+
+    db.session.begin(subtransactions=True)
+    try:
+        lookups.prefetch([(ureport, report_hash)
+                          for report_hash, group in groups.items()
+                          for i, ureport, timestamp, count in group])
+
+        for report_hash, group in groups.items():
+            for i, ureport, timestamp, count in group:
+                try:
+                    save_ureport2(db, ureport,
+                                  create_component=create_component,
+                                  timestamp=timestamp, count=count,
+                                  lookups=lookups, history=history,
+                                  report_hash=report_hash)
+                except FafError as ex:
+                    # the session is flushed after every uReport, anything
+                    # pending now belongs to the failed one
+                    if db.session.new or db.session.dirty:
+                        raise
+
+                    failed.append((i, ex))
+
+        history.flush(db)
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
+
+    return failed
 
 
 def ureport2(ureport):
@@ -363,6 +652,41 @@ def ureport2(ureport):
     raise FafError("uReport version {0} is not supported".format(ver))
 
 
+def get_report_hash(ureport):
+    """
+    Return the hash identifying the report `ureport` belongs to.
+    Assumes the given uReport is valid.
+    """
+
+    ureport = ureport2(ureport)
+    problemplugin = problemtypes[ureport["problem"]["type"]]
+    return problemplugin.hash_ureport(ureport["problem"])
+
+
+def get_dedupe_key(ureport, timestamp, report_hash=None):
+    """
+    Return the key grouping uReports that are saved as one with
+    save-reports --dedupe - uReports of the same report received from
+    the same operating system release and architecture with the same
+    packages and reason on the same day, either all first occurrences
+    (problem serial 1) counted as unique or none of them. Assumes the given
+    uReport is valid.
+    """
+
+    ureport = ureport2(ureport)
+    if report_hash is None:
+        report_hash = get_report_hash(ureport)
+
+    packages = sorted(json.dumps(package, sort_keys=True)
+                      for package in ureport["packages"])
+    unique = ureport["problem"].get("serial") == 1
+
+    return (ureport["problem"]["type"], report_hash,
+            ureport["os"]["name"], ureport["os"]["version"],
+            ureport["os"]["architecture"], timestamp.date(), tuple(packages),
+            ureport["reason"], unique)
+
+
 def validate_attachment(attachment):
     """
     Validate uReport attachment.
@@ -385,6 +709,21 @@ def attachment_type_allowed(atype):
 
 
 def save_attachment(db, attachment):
+    """
+    Save a valid `attachment`, see save_attachments. Raise FafError if
+    the attachment fails to save.
+    """
+
+    failed = save_attachments(db, [attachment], download_threads=1)
+    if failed:
+        raise failed[0][1]
+
+
+def _save_other_attachment(db, attachment):
+    """
+    Save a valid `attachment` that does not link a report to a bug.
+    """
+
     atype = attachment["type"].lower()
 
     if not attachment_type_allowed(atype):
@@ -395,94 +734,7 @@ def save_attachment(db, attachment):
     if not report:
         raise FafError("Report for given bthash not found")
 
-    if atype in ["rhbz", "fedora-bugzilla", "rhel-bugzilla"]:
-        bug_id = int(attachment["data"])
-
-        reportbug = (db.session.query(ReportBz)
-                     .filter(
-                         (ReportBz.report_id == report.id) &
-                         (ReportBz.bzbug_id == bug_id)
-                     )
-                     .first())
-
-        if reportbug:
-            log.debug("Skipping existing attachment")
-            return
-
-        bug = get_bz_bug(db, bug_id)
-        if not bug:
-            if atype in bugtrackers:
-                # download from bugtracker identified by atype
-                tracker = bugtrackers[atype]
-
-                if not tracker.installed(db):
-                    raise FafError("Bugtracker used in this attachment"
-                                   " is not installed")
-
-                bug = tracker.download_bug_to_storage(db, bug_id)
-            elif atype == "rhbz":
-                # legacy value
-                # - we need to guess the bugtracker:
-                # either fedora-bugzilla or rhel-bugzilla,
-                # former is more probable
-                for possible_tracker in ["fedora-bugzilla", "rhel-bugzilla"]:
-                    if possible_tracker not in bugtrackers:
-                        continue
-
-                    tracker = bugtrackers[possible_tracker]
-                    if not tracker.installed(db):
-                        continue
-
-                    bug = tracker.download_bug_to_storage(db, bug_id)
-                    if bug:
-                        break
-
-        if bug:
-            new = ReportBz()
-            new.report = report
-            new.bzbug = bug
-            db.session.add(new)
-            db.session.flush()
-        else:
-            log.error("Failed to fetch bug #{0} from '{1}'"
-                      .format(bug_id, atype))
-
-    elif atype == "centos-mantisbt":
-        bug_id = int(attachment["data"])
-
-        reportbug = (db.session.query(ReportMantis)
-                     .filter(
-                         (ReportMantis.report_id == report.id) &
-                         (ReportMantis.mantisbug_id == bug_id))
-                     .first())
-
-        if reportbug:
-            log.debug("Skipping existing attachment")
-            return
-
-        bug = get_mantis_bug(db, bug_id)
-        if not bug:
-            if atype in bugtrackers:
-                # download from bugtracker identified by atype
-                tracker = bugtrackers[atype]
-
-                if not tracker.installed(db):
-                    raise FafError("Bugtracker used in this attachment"
-                                   " is not installed")
-
-                bug = tracker.download_bug_to_storage(db, bug_id)
-
-        if bug:
-            new = ReportMantis()
-            new.report = report
-            new.mantisbug = bug
-            db.session.add(new)
-            db.session.flush()
-        else:
-            log.error("Failed to fetch bug #{0} from '{1}'"
-                      .format(bug_id, atype))
-
-    elif atype == "comment":
+    if atype == "comment":
         comment = ReportComment()
         comment.report = report
         comment.text = attachment["data"]
@@ -543,6 +795,251 @@ def save_attachment(db, attachment):
         log.warning("Unknown attachment type")
 
 
+def _attachment_bugtrackers(db, atype):
+    """
+    Return the list of bug trackers to download the bugs of attachments
+    of `atype` type from, in the order in which they are tried.
+    """
+
+    if atype in bugtrackers:
+        tracker = bugtrackers[atype]
+        if not tracker.installed(db):
+            raise FafError("Bugtracker used in this attachment"
+                           " is not installed")
+
+        return [tracker]
+
+    result = []
+    if atype == "rhbz":
+        # legacy value
+        # - we need to guess the bugtracker:
+        # either fedora-bugzilla or rhel-bugzilla,
+        # former is more probable
+        for possible_tracker in ["fedora-bugzilla", "rhel-bugzilla"]:
+            if possible_tracker not in bugtrackers:
+                continue
+
+            tracker = bugtrackers[possible_tracker]
+            if tracker.installed(db):
+                result.append(tracker)
+
+    return result
+
+
+def _download_bug(tracker, bug_id):
+    """
+    Download the bug in a thread of the pool. Return a (status, value)
+    tuple, where status is "ok" and value the downloaded bug, "error" and
+    value the exception raised or "fallback" if the tracker does not
+    support downloading without saving.
+    """
+
+    # Catching too general exception Exception
+    # pylint: disable-msg=W0703
+    try:
+        return "ok", tracker.download_bug(bug_id)
+    except NotImplementedError:
+        return "fallback", None
+    except Exception as ex:
+        log.error("Failed to download bug #{0} from '{1}': {2}"
+                  .format(bug_id, tracker.name, str(ex)))
+        return "error", ex
+    # pylint: enable-msg=W0703
+
+
+def save_attachments(db, attachments, download_threads=4, batch_size=100):
+    """
+    Save a list of valid `attachments`. Bugs of bug tracker attachments
+    that are not in storage yet are downloaded concurrently by at most
+    `download_threads` threads while the other attachments are saved.
+    The links between reports and bugs are written in batches of
+    `batch_size`. Return a list of (index, exception) tuples of attachments
+    that failed to save.
+    """
+
+    failed = []
+    others = []
+    bug_attachments = []
+    for i, attachment in enumerate(attachments):
+        atype = attachment["type"].lower()
+        if atype not in BZ_ATTACHMENT_TYPES + MANTIS_ATTACHMENT_TYPES:
+            others.append(i)
+            continue
+
+        if not attachment_type_allowed(atype):
+            failed.append((i, FafError("Attachment type '{}' not allowed on "
+                                       "this server".format(atype))))
+            continue
+
+        bug_attachments.append((i, atype, int(attachment["data"]),
+                                attachment["bthash"]))
+
+    reports = {}
+    if bug_attachments:
+        reports = dict(get_reports_by_hashes(
+            db, set(bthash for i, atype, bug_id, bthash in bug_attachments)))
+
+    report_ids = set(report.id for report in reports.values())
+    links = set()
+    bz_bug_ids = set()
+    mantis_bug_ids = {}
+    if report_ids:
+        links.update(("bz", rbz.report_id, rbz.bzbug_id)
+                     for rbz in get_reportbzs_by_report_ids(db, report_ids))
+        links.update(("mantis", rm.report_id, rm.mantisbug_id)
+                     for rm in get_reportmantises_by_report_ids(db,
+                                                                report_ids))
+
+    # bug id or (attachment type, external id) -> bug in storage
+    stored = {}
+    # attachment type -> bug trackers or FafError
+    trackers = {}
+    # (attachment type, bug id) -> [(attachment index, report)]
+    waiting = OrderedDict()
+    for i, atype, bug_id, bthash in bug_attachments:
+        report = reports.get(bthash)
+        if report is None:
+            failed.append((i, FafError("Report for given bthash not found")))
+            continue
+
+        if atype not in trackers:
+            try:
+                trackers[atype] = _attachment_bugtrackers(db, atype)
+            except FafError as ex:
+                trackers[atype] = ex
+
+        if atype in BZ_ATTACHMENT_TYPES:
+            bz_bug_ids.add(bug_id)
+        elif not isinstance(trackers[atype], FafError):
+            mantis_bug_ids.setdefault(atype, set()).add(bug_id)
+
+        waiting.setdefault((atype, bug_id), []).append((i, report))
+
+    if bz_bug_ids:
+        stored.update((bug.id, bug)
+                      for bug in get_bz_bugs_by_ids(db, bz_bug_ids))
+
+    for atype, bug_ids in mantis_bug_ids.items():
+        if not trackers[atype]:
+            continue
+
+        db_tracker = get_bugtracker_by_name(db, trackers[atype][0].name)
+        stored.update(((atype, bug.external_id), bug)
+                      for bug in get_mantis_bugs_by_external_ids(
+                          db, bug_ids, db_tracker.id))
+
+    new_links = []
+
+    def link(key, bug):
+        atype, bug_id = key
+        for i, report in waiting.pop(key):
+            if bug is None:
+                log.error("Failed to fetch bug #{0} from '{1}'"
+                          .format(bug_id, atype))
+                continue
+
+            if atype in BZ_ATTACHMENT_TYPES:
+                link_key = ("bz", report.id, bug.id)
+                new = ReportBz()
+                new.bzbug = bug
+            else:
+                link_key = ("mantis", report.id, bug.id)
+                new = ReportMantis()
+                new.mantisbug = bug
+
+            if link_key in links:
+                log.debug("Skipping existing attachment")
+                continue
+
+            links.add(link_key)
+            new.report = report
+            new_links.append(new)
+
+        if len(new_links) >= batch_size:
+            db.session.add_all(new_links)
+            db.session.flush()
+            del new_links[:]
+
+    def fail(key, ex):
+        failed.extend((i, ex) for i, report in waiting.pop(key))
+
+    # (attachment type, bug id) of the bugs to download
+    downloads = []
+    for key in list(waiting.keys()):
+        atype, bug_id = key
+        if isinstance(trackers[atype], FafError):
+            fail(key, trackers[atype])
+        elif atype in BZ_ATTACHMENT_TYPES and bug_id in stored:
+            link(key, stored[bug_id])
+        elif atype in MANTIS_ATTACHMENT_TYPES and key in stored:
+            link(key, stored[key])
+        elif not trackers[atype]:
+            link(key, None)
+        else:
+            downloads.append(key)
+
+    pool = None
+    results = Queue.Queue()
+
+    def download(key, position):
+        tracker = trackers[key[0]][position]
+        pool.apply_async(_download_bug, (tracker, key[1]),
+                         callback=lambda result: results.put((key, position,
+                                                              result)))
+
+    if downloads:
+        pool = ThreadPool(min(download_threads, len(downloads)))
+        for key in downloads:
+            download(key, 0)
+
+    for i in others:
+        try:
+            _save_other_attachment(db, attachments[i])
+        except FafError as ex:
+            failed.append((i, ex))
+
+    pending = len(downloads)
+    while pending > 0:
+        key, position, (status, value) = results.get()
+        pending -= 1
+
+        tracker = trackers[key[0]][position]
+        try:
+            if status == "error":
+                raise value
+
+            if status == "fallback":
+                bug = tracker.download_bug_to_storage(db, key[1])
+            else:
+                bug = tracker.save_bug(db, value)
+        except FafError as ex:
+            fail(key, ex)
+            continue
+        # Catching too general exception Exception
+        # pylint: disable-msg=W0703
+        except Exception as ex:
+            fail(key, FafError(str(ex)))
+            continue
+        # pylint: enable-msg=W0703
+
+        if not bug and position + 1 < len(trackers[key[0]]):
+            download(key, position + 1)
+            pending += 1
+            continue
+
+        link(key, bug)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if new_links:
+        db.session.add_all(new_links)
+        db.session.flush()
+
+    return sorted(failed)
+
+
 def valid_known_type(known_type):
     """
     Check if all "known" values from configuration file are correct
@@ -575,18 +1072,24 @@ def is_known(ureport, db, return_report=False, opsysrelease_id=None):
     if len(known_type) > 0 and not valid_known_type(known_type):
         return None
 
-    report_os = {'name':None,
-                 'version':None,
-                 'architecture':None}
+    reports = reportindex.get(db, report_hash)
 
     if 'EQUAL_UREPORT_EXISTS' in known_type:
-        report_os = ureport["os"]
-
-    report = get_report(db, report_hash, os_name=report_os['name'], os_version=report_os['version'], os_arch=report_os['architecture'])
-
-    if report is None:
+        osplugin = systems[ureport["os"]["name"]]
+        db_osrelease = refcache.get_osrelease(db, osplugin.nice_name,
+                                              ureport["os"]["version"])
+        db_arch = refcache.get_arch(db, ureport["os"]["architecture"])
+        if db_osrelease is None or db_arch is None:
+            return None
+
+        reports = [report for report in reports
+                   if db_osrelease.id in report.osrelease_ids and
+                   db_arch.id in report.arch_ids]
+
+    if not reports:
         return None
 
+    report = reports[0]
     found = False
 
     if 'EQUAL_UREPORT_EXISTS' in known_type:
@@ -594,26 +1097,23 @@ def is_known(ureport, db, return_report=False, opsysrelease_id=None):
         found = True
 
     elif ('BUG_OS_MINOR_VERSION' in known_type and
-        get_reportbz(db, report.id, opsysrelease_id).first() is not None):
+          report.has_bug(opsysrelease_id)):
 
         found = True
 
     elif ('BUG_OS_MAJOR_VERSION' in known_type and
-          get_reportbz_by_major_version(db, report.id,
-                                        major_version=ureport["os"]["version"]
-                                        .split(".")[0])
-          .first() is not None):
+          report.has_bug_by_major_version(
+              ureport["os"]["version"].split(".")[0])):
 
         found = True
 
-    elif (not known_type and
-          get_reportbz(db, report.id, opsysrelease_id).first() is not None):
+    elif not known_type and report.has_bug(opsysrelease_id):
 
         found = True
 
     if found:
         if return_report:
-            return report
+            return db.session.query(Report).get(report.id)
         return True
     else:
         return None
@@ -0,0 +1,86 @@
+# Copyright (C) 2016  ABRT Team
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This file is part of faf.
+#
+# faf is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# faf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with faf.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+
+__all__ = ["LRUCache"]
+
+
+class LRUCache(object):
+    """
+    Mapping holding at most `maxsize` items. When full, adding an item
+    discards the least recently used one. Lookups done by `get` are counted
+    in `hits` and `misses`.
+    """
+
+    def __init__(self, maxsize):
+        if maxsize < 1:
+            raise ValueError("maxsize must be a positive number")
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """
+        Return the value of `key` and mark it as the most recently used
+        one or `default` if `key` is not cached.
+        """
+
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._items[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Add or replace `key`, discarding the least recently used item if
+        the cache is full.
+        """
+
+        self._items.pop(key, None)
+        if len(self._items) >= self.maxsize:
+            self._items.popitem(last=False)
+
+        self._items[key] = value
+
+    def discard(self, key):
+        """
+        Remove `key` if it is cached.
+        """
+
+        self._items.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all items. The counters are kept.
+        """
+
+        self._items.clear()
@@ -22,7 +22,7 @@
 import re
 from collections import defaultdict
 
-__all__ = ["format_reason", "most_common_crash_function"]
+__all__ = ["format_reason", "frame_quality", "most_common_crash_function"]
 
 RE_SIGNAL = re.compile("SIG[^)]+")
 
@@ -68,3 +68,25 @@ def most_common_crash_function(backtraces):
             crash_functions[bt.crash_function] += 1
     result = max(crash_functions.iteritems(), key=lambda x: x[1])
     return result[0]
+
+
+def frame_quality(symbol_name, source_path, line_number, reliable=True):
+    """
+    Return how much a backtrace frame lowers the backtrace quality.
+    `symbol_name` is None if the frame has no symbol.
+    """
+
+    quality = 0
+    if symbol_name is None or symbol_name == '??':
+        quality -= 1
+
+    if not source_path:
+        quality -= 1
+
+    if not line_number:
+        quality -= 1
+
+    if not reliable:
+        quality -= 1
+
+    return quality
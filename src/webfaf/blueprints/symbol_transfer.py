@@ -1,14 +1,12 @@
 from hashlib import sha1
 import datetime
 import json
-from sqlalchemy import func
 
 from flask import Blueprint, request, jsonify, abort, Response
 from pyfaf.storage import (OpSysComponent,
                            Report,
                            ReportBacktrace,
                            ReportBtThread,
-                           ReportBtFrame,
                            ReportHash,
                            SymbolSource)
 from pyfaf.config import config
@@ -90,14 +88,8 @@ def process_symbol(build_id, path, offset, problem_type, create_symbol_auth_key)
             db_ssource.offset = offset
             db.session.add(db_ssource)
 
-            max_order = (db.session.query(func.max(ReportBtFrame.order))
-                                   .filter(ReportBtFrame.thread == db_thread)
-                                   .scalar() or 0)
-            db_frame = ReportBtFrame()
-            db_frame.thread = db_thread
-            db_frame.symbolsource = db_ssource
-            db_frame.order = max_order + 1
-            db.session.add(db_frame)
+            # the dummy thread may be packed by pack-frames
+            db_thread.append_frame(db_ssource)
 
             db.session.commit()
 
@@ -17,7 +17,6 @@ from pyfaf.storage import (Arch,
                            Report,
                            ReportArch,
                            ReportBacktrace,
-                           ReportBtFrame,
                            ReportBtTaintFlag,
                            ReportBtThread,
                            ReportBz,
@@ -30,7 +29,9 @@ from pyfaf.storage import (Arch,
                            Symbol,
                            SymbolSource)
 from pyfaf.queries import (get_history_target, get_report,
+                           get_crash_threads_by_report_ids,
                            get_external_faf_instances,
+                           get_frame_symbolsources,
                            get_report_opsysrelease)
 from pyfaf.solutionfinders import find_solution
 
@@ -144,12 +145,13 @@ def query_problems(db, hist_table, hist_column,
         final_query = final_query.filter(Problem.id == type_query.c.problem_id)
 
     if function_names or binary_names or source_file_names:
+        frames = get_frame_symbolsources(db)
         names_query = (
             db.session.query(Report.problem_id.label("problem_id"))
             .join(ReportBacktrace)
             .join(ReportBtThread)
-            .join(ReportBtFrame)
-            .join(SymbolSource)
+            .join(frames, frames.c.thread_id == ReportBtThread.id)
+            .join(SymbolSource, SymbolSource.id == frames.c.symbolsource_id)
             .filter(ReportBtThread.crashthread == True))
 
         if function_names:
@@ -517,13 +519,6 @@ def item(problem_id):
             pkg["count"],
             sorted(pkg["versions"].items(), key=itemgetter(1), reverse=True)))
 
-    for report in problem.reports:
-        for backtrace in report.backtraces:
-            fid = 0
-            for frame in backtrace.frames:
-                fid += 1
-                frame.nice_order = fid
-
     bt_hashes = (db.session.query(ReportHash.hash)
                            .join(Report)
                            .join(Problem)
@@ -557,6 +552,11 @@ def item(problem_id):
     is_maintainer = is_problem_maintainer(db, g.user, problem)
     forward["is_maintainer"] = is_maintainer
 
+    # report id -> frames of the crash thread
+    forward["backtraces"] = dict(
+        (report_id, threads[0].frames) for report_id, threads
+        in get_crash_threads_by_report_ids(db, report_ids).items())
+
     forward["extfafs"] = get_external_faf_instances(db)
 
     if report_ids:
@@ -1,7 +1,9 @@
 import datetime
+import hashlib
 import logging
 import json
 import os
+import time
 import uuid
 import urllib
 from datetime import timedelta
@@ -39,6 +41,7 @@ from pyfaf.storage import (AssociatePeople,
                            Problem,
                            )
 from pyfaf.queries import (get_report,
+                           get_crash_threads_by_report_ids,
                            get_unknown_opsys,
                            user_is_maintainer,
                            get_bz_bug,
@@ -48,11 +51,13 @@ from pyfaf.queries import (get_report,
 from pyfaf import ureport
 from pyfaf.opsys import systems
 from pyfaf.bugtrackers import bugtrackers
-from pyfaf.config import paths
+from pyfaf.config import config, paths
+from pyfaf.refcache import refcache
+from pyfaf.spool import (CoalescedReports, SegmentSpool, iter_record,
+                         segment_spool_enabled, spool_depth)
 from pyfaf.ureport import ureport2
 from pyfaf.solutionfinders import find_solution
-from pyfaf.common import FafError
-from pyfaf.problemtypes import problemtypes
+from pyfaf.utils.parse import str2bool
 from pyfaf import queries
 from flask import (Blueprint, render_template, request, abort, redirect,
                    url_for, flash, jsonify, g)
@@ -70,6 +75,20 @@ from utils import (Pagination,
 
 reports = Blueprint("reports", __name__)
 
+# uploaded files are read by chunks of this size
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# allowance for the multipart envelope around an uploaded file
+UPLOAD_ENVELOPE_SIZE = 64 * 1024
+
+# number of waiting uReports over which new ones are refused, 0 for no limit
+SPOOL_HIGH_WATER_MARK = int(config.get("ureport.spoolhighwatermark", 0))
+SPOOL_RETRY_AFTER = int(config.get("ureport.spoolretryafter", 60))
+SPOOL_COALESCE = str2bool(config.get("ureport.spoolcoalesce", "false"))
+# number of distinct coalesced uReports over which new ones are refused,
+# 0 for the high-water mark
+SPOOL_COALESCE_LIMIT = (int(config.get("ureport.spoolcoalescelimit", 0)) or
+                        SPOOL_HIGH_WATER_MARK)
+
 from webfaf_main import db, flask_cache, app
 from forms import (ReportFilterForm, NewReportForm, NewAttachmentForm,
                    component_names_to_ids, AssociateBzForm)
@@ -520,16 +539,12 @@ def item(report_id, want_object=False):
             pkg["count"],
             sorted(pkg["versions"].items(), key=itemgetter(1), reverse=True)))
 
-    try:
-        backtrace = report.backtraces[0].frames
-    except:
+    crash_threads = get_crash_threads_by_report_ids(db, [report.id])
+    if report.id in crash_threads:
+        backtrace = crash_threads[report.id][0].frames
+    else:
         backtrace = []
 
-    fid = 0
-    for frame in backtrace:
-        fid += 1
-        frame.nice_order = fid
-
     is_maintainer = is_component_maintainer(db, g.user, component)
 
     contact_emails = []
@@ -787,14 +802,72 @@ def _save_unknown_opsys(db, opsys):
         logging.error(str(ex))
 
 
+def _spool_full():
+    """
+    Return True if the spool is over its high-water mark.
+    """
+
+    if SPOOL_HIGH_WATER_MARK < 1:
+        return False
+
+    return spool_depth().get() >= SPOOL_HIGH_WATER_MARK
+
+
+def _spool_busy():
+    return InvalidUsage("The server is busy, please retry later.", 503,
+                        headers={"Retry-After": str(SPOOL_RETRY_AFTER)})
+
+
+def _read_upload(fileobj, max_length):
+    """
+    Read the uploaded `fileobj` by chunks. Raise InvalidUsage as soon as
+    it grows over `max_length` bytes.
+    """
+
+    chunks = []
+    length = 0
+    while True:
+        chunk = fileobj.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+
+        length += len(chunk)
+        if length > max_length:
+            raise InvalidUsage("uReport may only be {0} bytes long"
+                               .format(max_length), 413)
+
+        chunks.append(chunk)
+
+    return "".join(chunks)
+
+
 @reports.route("/new/", methods=('GET', 'POST'))
 def new():
-    form = NewReportForm()
+    # the form is created only once the request has passed the checks
+    # that do not need its body
+    form = None
     if request.method == "POST":
         try:
+            max_ureport_length = InvalidUReport.__lobs__["ureport"]
+
+            # reject an oversized request before its body is read
+            if (request.content_length is not None and
+                    request.content_length > (max_ureport_length +
+                                              UPLOAD_ENVELOPE_SIZE)):
+                raise InvalidUsage("uReport may only be {0} bytes long"
+                                   .format(max_ureport_length), 413)
+
+            # past the high-water mark the uReport is either merged into
+            # the same one received before or refused
+            coalesce = _spool_full()
+            if coalesce and not SPOOL_COALESCE:
+                raise _spool_busy()
+
+            form = NewReportForm()
             if not form.validate() or form.file.name not in request.files:
                 raise InvalidUsage("Invalid form data.", 400)
-            raw_data = request.files[form.file.name].read()
+            raw_data = _read_upload(request.files[form.file.name],
+                                    max_ureport_length)
             try:
                 data = json.loads(raw_data)
             except Exception as ex:
@@ -824,22 +897,12 @@ def new():
 
             report = data
 
-            max_ureport_length = InvalidUReport.__lobs__["ureport"]
-
-            if len(str(report)) > max_ureport_length:
-                raise InvalidUsage("uReport may only be {0} bytes long"
-                                   .format(max_ureport_length), 413)
-
             osr_id = None
             osr = None
             if report["os"]["name"] in systems:
-                osr = (db.session.query(OpSysRelease)
-                       .join(OpSys)
-                       .filter(OpSys.name ==
-                               systems[report["os"]["name"]].nice_name)
-                       .filter(OpSysRelease.version ==
-                               report["os"]["version"])
-                       .first())
+                osr = refcache.get_osrelease(
+                    db, systems[report["os"]["name"]].nice_name,
+                    report["os"]["version"])
 
                 if osr:
                     osr_id = osr.id
@@ -851,47 +914,66 @@ def new():
                 dbreport = None
 
             known = bool(dbreport)
-            fname = str(uuid.uuid4())
-            fpath = os.path.join(paths["reports_incoming"], fname)
-            with open(fpath, 'w') as file:
-                file.write(raw_data)
+
+            report2 = ureport2(report)
+            try:
+                report_hash = ureport.get_report_hash(report2)
+            except Exception as e:
+                logging.exception(e)
+                report_hash = None
+
+            if report_hash is None:
+                record = [raw_data]
+            else:
+                # save-reports trusts the validation and the hash done here,
+                # the record is encoded while being written
+                record = iter_record(report2, report_hash,
+                                     ureport.get_version(report), time.time())
+
+            if coalesce:
+                if report_hash is None:
+                    raise _spool_busy()
+
+                key = ureport.get_dedupe_key(report2, datetime.datetime.now(),
+                                             report_hash)
+                merged = CoalescedReports().add(
+                    hashlib.sha1(repr(key)).hexdigest(), record,
+                    limit=SPOOL_COALESCE_LIMIT)
+                if merged is None:
+                    raise _spool_busy()
+            elif segment_spool_enabled():
+                SegmentSpool().append(record)
+            else:
+                fname = str(uuid.uuid4())
+                fpath = os.path.join(paths["reports_incoming"], fname)
+                with open(fpath, 'w') as file:
+                    for chunk in record:
+                        file.write(chunk)
+                spool_depth().add(1)
 
             if request_wants_json():
                 response = {'result': known}
-
-                try:
-                    report2 = ureport2(report)
-                except FafError:
-                    report2 = None
-
-                if report2 is not None:
-                    solution = find_solution(report2, db=db, osr=osr)
-                    if solution is not None:
-                        response["message"] = (
-                            "Your problem seems to be caused by {0}\n\n"
-                            "{1}".format(solution.cause, solution.note_text))
-
-                        if solution.url:
-                            response["message"] += (
-                                "\n\nYou can get more information at {0}"
-                                .format(solution.url))
-
-                        solution_dict = {"cause": solution.cause,
-                                         "note":  solution.note_text,
-                                         "url":   solution.url}
-                        if not solution_dict["url"]:
-                            del solution_dict["url"]
-                        response["solutions"] = [solution_dict]
-                        response["result"] = True
-
-                    try:
-                        problemplugin = problemtypes[
-                            report2["problem"]["type"]]
-                        response["bthash"] = problemplugin.hash_ureport(
-                            report2["problem"])
-                    except Exception as e:
-                        logging.exception(e)
-                        pass
+                if report_hash is not None:
+                    response["bthash"] = report_hash
+
+                solution = find_solution(report2, db=db, osr=osr)
+                if solution is not None:
+                    response["message"] = (
+                        "Your problem seems to be caused by {0}\n\n"
+                        "{1}".format(solution.cause, solution.note_text))
+
+                    if solution.url:
+                        response["message"] += (
+                            "\n\nYou can get more information at {0}"
+                            .format(solution.url))
+
+                    solution_dict = {"cause": solution.cause,
+                                     "note":  solution.note_text,
+                                     "url":   solution.url}
+                    if not solution_dict["url"]:
+                        del solution_dict["url"]
+                    response["solutions"] = [solution_dict]
+                    response["result"] = True
 
                 if known:
                     url = url_for('reports.item', report_id=dbreport.id,
@@ -933,14 +1015,16 @@ def new():
             if request_wants_json():
                 response = jsonify({"error": e.message})
                 response.status_code = e.status_code
+                response.headers.extend(e.headers)
                 return response
             else:
                 flash(e.message, "danger")
-                return render_template("reports/new.html",
-                                       form=form), e.status_code
+                return (render_template("reports/new.html",
+                                        form=form or NewReportForm()),
+                        e.status_code, e.headers)
 
     return render_template("reports/new.html",
-                           form=form)
+                           form=NewReportForm())
 
 @reports.route("/attach/", methods=("GET", "POST"))
 def attach():
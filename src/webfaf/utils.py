@@ -9,7 +9,9 @@ from urllib import urlencode
 
 from pyfaf.storage import GenericTable
 from pyfaf.storage.problem import Problem
-from pyfaf.storage.report import (Report,
+from pyfaf.storage.report import (LoadedBtFrame,
+                                  PackedBtFrame,
+                                  Report,
                                   ReportBtFrame,
                                   ReportComment,
                                   ReportHistoryDaily,
@@ -164,12 +166,14 @@ def date_iterator(first_date, time_unit='d', end_date=None):
 class InvalidUsage(Exception):
     status_code = 400
 
-    def __init__(self, message, status_code=None, payload=None):
+    def __init__(self, message, status_code=None, payload=None,
+                 headers=None):
         Exception.__init__(self)
         self.message = message
         if status_code is not None:
             self.status_code = status_code
         self.payload = payload
+        self.headers = headers or {}
 
     def to_dict(self):
         rv = dict(self.payload or ())
@@ -250,7 +254,7 @@ class WebfafJSONEncoder(JSONEncoder):
                  }
 
             return d
-        elif isinstance(obj, ReportBtFrame):
+        elif isinstance(obj, (ReportBtFrame, PackedBtFrame, LoadedBtFrame)):
             if obj.symbolsource.symbol is None:
                 name = " "
             else: